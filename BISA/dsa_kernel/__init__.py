@@ -1,11 +1,27 @@
 from .dsa import deepseek_sparse_attention
 from .dsa import deepseek_sparse_attention_warmup
 from .dsa import deepseek_sparse_attention_block_indexer
+from .dsa import deepseek_sparse_attention_with_indices, topk_overlap
+from .dsa import deepseek_sparse_attention_prefill_chunk
+from .dsa import prewarm_dsa_kernels
+from .dsa import routing_stats, reset_routing_stats
+from .registry import kernel_registry
+from .telemetry import IndexerTelemetry, indexer_telemetry, topk_recall
 from .index import prepare_cu_seqlens_from_position_ids
 
 __all__ = [
     "deepseek_sparse_attention",
     "deepseek_sparse_attention_warmup",
     "deepseek_sparse_attention_block_indexer",
+    "deepseek_sparse_attention_with_indices",
+    "topk_overlap",
+    "deepseek_sparse_attention_prefill_chunk",
     "prepare_cu_seqlens_from_position_ids",
+    "prewarm_dsa_kernels",
+    "kernel_registry",
+    "routing_stats",
+    "reset_routing_stats",
+    "IndexerTelemetry",
+    "indexer_telemetry",
+    "topk_recall",
 ]
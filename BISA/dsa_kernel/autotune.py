@@ -0,0 +1,205 @@
+import itertools
+import json
+import os
+from typing import Any, Callable, Optional
+
+import torch
+
+from .registry import KernelRegistry, kernel_registry
+
+# Tile parameters of the tilelang kernels: the default (used until a shape is tuned), the candidates swept per shape
+# key, and which candidates are valid for a key.
+TUNING_SPACES = {
+    "sparse_mla_fwd": {
+        "default": {"block_I": 32, "num_stages": 2, "threads": 128},
+        "space": {"block_I": [32, 64], "num_stages": [1, 2, 3], "threads": [128, 256]},
+        "valid": lambda key, config: key["topk"] % config["block_I"] == 0,
+    },
+    "dense_mla_fwd": {
+        "default": {"block_I": 32, "num_stages": 2, "threads": 128},
+        "space": {"block_I": [32, 64], "num_stages": [1, 2, 3], "threads": [128, 256]},
+        "valid": lambda key, config: True,
+    },
+    "sparse_mla_bwd": {
+        "default": {"block_size": 32, "num_stages": 0, "threads": 128},
+        "space": {"block_size": [32, 64], "num_stages": [0], "threads": [128, 256]},
+        "valid": lambda key, config: key["topk"] % config["block_size"] == 0,
+    },
+    "sparse_mla_topk_reducesum": {
+        "default": {"block_I": 32, "num_stages": 2, "threads": 128},
+        "space": {"block_I": [32, 64], "num_stages": [1, 2, 3], "threads": [128, 256]},
+        "valid": lambda key, config: key["topk"] % config["block_I"] == 0,
+    },
+    "indexer_bwd": {
+        # the kernel is not pipelined
+        "default": {"block_I": 32, "num_stages": 0, "num_threads": 128},
+        "space": {"block_I": [32, 64, 128], "num_stages": [0], "num_threads": [128, 256]},
+        "valid": lambda key, config: key["topk"] % config["block_I"] == 0,
+    },
+    "gather_qk_reducesum": {
+        "default": {"block_I": 32, "num_stages": 2, "threads": 128},
+        "space": {"block_I": [32, 64], "num_stages": [1, 2, 3], "threads": [128, 256]},
+        "valid": lambda key, config: key["num_candidates"] % config["block_I"] == 0,
+    },
+}
+
+
+def default_cache_path() -> str:
+    return os.environ.get(
+        "DSA_AUTOTUNE_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "dsa_kernel", "autotune.json"),
+    )
+
+
+def format_key(key: dict) -> str:
+    # JSON key of a shape key, e.g. "dim=512,dtype=torch.bfloat16,heads=64,tail_dim=64,topk=2048"
+    return ",".join(f"{k}={v}" for k, v in sorted(key.items()))
+
+
+class TilelangBackend:
+    """Compiles with the tilelang.jit factories and times the kernels on the current CUDA device."""
+
+    def __init__(self, warmup: int = 3, repeats: int = 10):
+        self.warmup = warmup
+        self.repeats = repeats
+
+    def device_name(self) -> str:
+        return torch.cuda.get_device_name() if torch.cuda.is_available() else "cpu"
+
+    def compile(self, name: str, factory: Callable, args: tuple, config: dict):
+        return factory(*args, **config)
+
+    def benchmark(self, kernel, run: Callable) -> float:
+        for _ in range(self.warmup):
+            run(kernel)
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        torch.cuda.synchronize()
+        start.record()
+        for _ in range(self.repeats):
+            run(kernel)
+        end.record()
+        torch.cuda.synchronize()
+        return start.elapsed_time(end) / self.repeats
+
+
+class MockKernel:
+
+    def __init__(self, name: str, args: tuple, config: dict, elapsed: float):
+        self.name = name
+        self.args = args
+        self.config = config
+        self.elapsed = elapsed
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+
+class MockBackend:
+    """
+    CPU stand-in for the tilelang backend. `cost(name, args, config)` gives the time in ms of a config, and a config
+    for which it raises fails to compile. Kernels are never launched; `compiled` records every compilation.
+    """
+
+    def __init__(self, cost: Callable[[str, tuple, dict], float]):
+        self.cost = cost
+        self.compiled = []
+
+    def device_name(self) -> str:
+        return "mock"
+
+    def compile(self, name: str, factory: Callable, args: tuple, config: dict):
+        elapsed = self.cost(name, args, config)
+        self.compiled.append((name, args, dict(config)))
+        return MockKernel(name, args, dict(config), elapsed)
+
+    def benchmark(self, kernel, run: Callable) -> float:
+        return kernel.elapsed
+
+
+class Autotuner:
+    """
+    Tile parameters and compiled kernels per shape.
+
+    `get_kernel` returns the compiled kernel of `factory(*args, **config)`, memoized in `registry`. The config is the
+    explicit parameters if any is given, else the winner stored in the JSON cache for this device and shape key, else,
+    with tuning enabled and a `run(kernel)` to time it, the fastest valid config of the tuning space, which is written
+    to the cache. Without a winner and without tuning it is the default config. Tuning is enabled by `tune=True` or
+    DSA_AUTOTUNE=1; `run` must not write to tensors the caller uses afterwards.
+    """
+
+    def __init__(self, backend=None, cache_path: Optional[str] = None, tune: Optional[bool] = None,
+                 registry: Optional[KernelRegistry] = None):
+        self.backend = backend if backend is not None else TilelangBackend()
+        self.cache_path = cache_path if cache_path is not None else default_cache_path()
+        self.tune = os.environ.get("DSA_AUTOTUNE", "0") == "1" if tune is None else tune
+        self.registry = registry if registry is not None else KernelRegistry()
+        self.winners = self.load()
+
+    def load(self) -> dict:
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self) -> None:
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.winners, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def compile(self, name: str, factory: Callable, args: tuple, config: dict):
+        return self.registry.get(name, lambda: self.backend.compile(name, factory, args, config), args, config)
+
+    def candidates(self, name: str, key: dict) -> list[dict]:
+        space = TUNING_SPACES[name]
+        params = list(space["space"])
+        configs = [dict(zip(params, values)) for values in itertools.product(*space["space"].values())]
+        return [config for config in configs if space["valid"](key, config)]
+
+    def search(self, name: str, factory: Callable, args: tuple, key: dict, run: Callable) -> tuple[Optional[dict], float]:
+        best, best_time = None, float("inf")
+        for config in self.candidates(name, key):
+            try:
+                elapsed = self.backend.benchmark(self.compile(name, factory, args, config), run)
+            except Exception as e:
+                print(f"autotune {name} [{format_key(key)}]: {config} failed ({type(e).__name__}: {e})")
+                continue
+            if elapsed < best_time:
+                best, best_time = config, elapsed
+        return best, best_time
+
+    def config(self, name: str, factory: Callable, args: tuple, key: dict, run: Optional[Callable] = None,
+               **params: Any) -> dict:
+        fixed = {p: v for p, v in params.items() if v is not None}
+        default = TUNING_SPACES[name]["default"]
+        if fixed:
+            return {**default, **fixed}
+        winners = self.winners.setdefault(self.backend.device_name(), {}).setdefault(name, {})
+        entry = winners.get(format_key(key))
+        if entry is not None:
+            return entry["config"]
+        if self.tune and run is not None:
+            best, best_time = self.search(name, factory, args, key, run)
+            if best is not None:
+                print(f"autotune {name} [{format_key(key)}]: {best} ({best_time:.3f} ms)")
+                winners[format_key(key)] = {"config": best, "ms": best_time}
+                self.save()
+                return best
+        return dict(default)
+
+    def get_kernel(self, name: str, factory: Callable, args: tuple, key: dict, run: Optional[Callable] = None,
+                   **params: Any):
+        return self.compile(name, factory, args, self.config(name, factory, args, key, run, **params))
+
+
+autotuner = Autotuner(registry=kernel_registry)
+
+
+def get_kernel(name: str, factory: Callable, args: tuple, key: dict, run: Optional[Callable] = None, **params: Any):
+    """`Autotuner.get_kernel` of the process-wide autotuner."""
+    return autotuner.get_kernel(name, factory, args, key, run, **params)
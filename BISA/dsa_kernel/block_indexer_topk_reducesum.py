@@ -8,6 +8,7 @@ import tilelang.language as T
 from typing import Optional
 
 from .index import prepare_token_indices
+from .autotune import get_kernel
 
 BF16 = "bfloat16"
 FP32 = "float32"
@@ -147,6 +148,18 @@ def tl_gather_qk_reducesum_impl(
     return gather_qk_reducesum_kernel
 
 
+def get_gather_qk_reducesum_kernel(heads, dim, num_candidates, sm_scale=None, dtype=torch.bfloat16, run=None, **params):
+    # compiled kernel from the registry, tile parameters left as None come from the autotune cache
+    return get_kernel(
+        "gather_qk_reducesum",
+        tl_gather_qk_reducesum_impl,
+        (heads, dim, num_candidates, sm_scale),
+        dict(heads=heads, dim=dim, num_candidates=num_candidates, dtype=dtype),
+        run=run,
+        **params,
+    )
+
+
 def gather_qk_reducesum_interface(
         q: torch.Tensor,
         k: torch.Tensor,
@@ -154,9 +167,9 @@ def gather_qk_reducesum_interface(
         token_indices: torch.Tensor,
         offsets: torch.Tensor,
         sm_scale: float = None,
-        block_I: int = 32,
-        num_stages: int = 2,
-        threads: int = 128,
+        block_I: Optional[int] = None,
+        num_stages: Optional[int] = None,
+        threads: Optional[int] = None,
 ) -> torch.Tensor:
     """
     Fused gather-K + QK-matmul + ReLU + weighted-reducesum interface.
@@ -171,6 +184,7 @@ def gather_qk_reducesum_interface(
         block_I: tile size for candidates dimension
         num_stages: pipeline stages
         threads: threads per block
+        (tile parameters left as None come from the autotune cache)
 
     Returns:
         score: [total_seq_len, num_candidates] float32 weighted scores
@@ -192,11 +206,13 @@ def gather_qk_reducesum_interface(
     score = torch.zeros(seq_len, num_candidates, dtype=torch.float32, device=q.device)
 
     # Get compiled kernel
-    kernel = tl_gather_qk_reducesum_impl(
-        heads=H,
-        dim=D,
-        num_candidates=num_candidates,
-        sm_scale=sm_scale,
+    kernel = get_gather_qk_reducesum_kernel(
+        H,
+        D,
+        num_candidates,
+        sm_scale,
+        q.dtype,
+        run=lambda kernel: kernel(q, k, weights, token_indices, offsets, seq_token_indices, torch.zeros_like(score)),
         block_I=block_I,
         num_stages=num_stages,
         threads=threads,
@@ -309,9 +325,6 @@ def indexer_topk_reducesum_interface(
                 token_indices.to(torch.int32),
                 chunk_offsets,
                 sm_scale=softmax_scale,
-                block_I=32,
-                num_stages=2,
-                threads=128,
             )  # [chunk_len, num_candidates]
             token_scores = torch.where(token_indices >= 0, token_scores, torch.tensor(float('-inf'), device=device))
 
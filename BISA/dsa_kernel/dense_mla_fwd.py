@@ -3,6 +3,7 @@ import torch
 import tilelang
 from tilelang import language as T
 from .index import prepare_token_indices
+from .autotune import get_kernel
 
 
 @tilelang.jit(
@@ -174,15 +175,26 @@ def dense_mla_fwd(
     return main
 
 
+def get_dense_mla_fwd_kernel(heads, dim, tail_dim, kv_group=1, sm_scale=None, dtype=torch.bfloat16, run=None, **params):
+    # compiled kernel from the registry, tile parameters left as None come from the autotune cache
+    return get_kernel(
+        "dense_mla_fwd",
+        dense_mla_fwd,
+        (heads, dim, tail_dim, kv_group, sm_scale, True),
+        dict(heads=heads, dim=dim, tail_dim=tail_dim, kv_group=kv_group, dtype=dtype),
+        run=run,
+        **params)
+
+
 def dense_mla_fwd_interface(q,
                              kv,
                              offsets,
                              sm_scale=None,
                              return_p_sum: bool = False,
                              d_v=512,
-                             block_I=32,
-                             num_stages=2,
-                             threads=128):
+                             block_I=None,
+                             num_stages=None,
+                             threads=None):
     is_casual = True
     assert return_p_sum == False, "This kernel file is for fwd only"
     assert q.is_contiguous() and kv.is_contiguous()
@@ -198,13 +210,14 @@ def dense_mla_fwd_interface(q,
 
     token_indices = prepare_token_indices(offsets)
 
-    kernel = dense_mla_fwd(
+    kernel = get_dense_mla_fwd_kernel(
         heads,
         dim,
         tail_dim,
         kv_group,
         sm_scale,
-        is_casual,
+        q.dtype,
+        run=lambda kernel: kernel(q, kv, offsets, token_indices),
         block_I=block_I,
         num_stages=num_stages,
         threads=threads)
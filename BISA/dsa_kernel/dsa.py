@@ -1,14 +1,18 @@
 from typing import Optional
 import torch
 import torch.nn.functional as F
-from .indexer_topk_reducesum import indexer_topk_reducesum_interface
+from .indexer_topk_reducesum import indexer_topk_reducesum_interface, indexer_topk_reducesum_chunk
 from .block_indexer_topk_reducesum import indexer_topk_reducesum_interface as block_indexer_topk_reducesum_interface
 from .indexer_bwd import indexer_bwd_interface
-from .full_indexer_bwd import full_indexer_bwd_interface
-from .sparse_mla_fwd import sparse_mla_fwd_interface
-from .sparse_mla_bwd import sparse_mla_bwd
-from .sparse_mla_topk_reducesum import sparse_mla_topk_reducesum_interface
-from .dense_mla_fwd import dense_mla_fwd_interface
+from .full_indexer_bwd import streaming_full_indexer_bwd_interface
+from .block_indexer_topk_reducesum import get_gather_qk_reducesum_kernel
+from .indexer_bwd import get_indexer_bwd_kernel
+from .sparse_mla_fwd import sparse_mla_fwd_interface, get_sparse_mla_fwd_kernel
+from .sparse_mla_bwd import sparse_mla_bwd, get_sparse_mla_bwd_kernels
+from .sparse_mla_topk_reducesum import sparse_mla_topk_reducesum_interface, get_sparse_mla_topk_reducesum_kernel
+from .dense_mla_fwd import dense_mla_fwd_interface, get_dense_mla_fwd_kernel
+from .registry import kernel_registry
+from .index import prepare_lens, prepare_position_ids
 from einops import einsum, repeat
 
 class DSAFunction(torch.autograd.Function):
@@ -25,14 +29,18 @@ class DSAFunction(torch.autograd.Function):
         topk: int,
         dim_v: int,
         sm_scale: Optional[float] = None,
+        num_sinks: int = 0,
+        window: int = 0,
     ):
         # topk_indices, index_score = ref_index_score(index_q, weights, index_k, topk)
-        topk_indices, index_score = indexer_topk_reducesum_interface(index_q, weights, index_k, topk, offsets)
+        topk_indices, index_score = indexer_topk_reducesum_interface(
+            index_q, weights, index_k, topk, offsets, num_sinks=num_sinks, window=window)
         o, lse = sparse_mla_fwd_interface(q, kv.unsqueeze(-2), topk_indices.unsqueeze(-2), offsets, sm_scale=sm_scale, d_v=dim_v)
         ctx.save_for_backward(q, kv, index_q, index_k, weights, topk_indices, index_score, o, lse, offsets)
         ctx.topk = topk
         ctx.dim_v = dim_v
         ctx.sm_scale = sm_scale
+        ctx.num_forced = num_sinks + window
         return o, topk_indices
 
     @staticmethod
@@ -45,6 +53,10 @@ class DSAFunction(torch.autograd.Function):
         attn_score = sparse_mla_topk_reducesum_interface(
             q, kv.unsqueeze(-2), topk_indices.unsqueeze(-2), lse, offsets,
             dim_v=ctx.dim_v).squeeze(-2)
+        if ctx.num_forced > 0:
+            # the indexer does not score the sink and window slots: it learns the attention over the other slots
+            attn_score[:, :ctx.num_forced] = 0
+            attn_score = attn_score / attn_score.sum(dim=-1, keepdim=True).clamp(min=1e-12)
         dq, dkv = sparse_mla_bwd(
             q,
             kv.unsqueeze(-2),
@@ -56,10 +68,91 @@ class DSAFunction(torch.autograd.Function):
             sm_scale=ctx.sm_scale)
         dindex_q, dweights, dindex_k = indexer_bwd_interface(index_q, weights, index_k, attn_score,
                                                              index_score, topk_indices, offsets)
-        return dq, dkv.squeeze(-2), dindex_q, dindex_k, dweights, None, None, None, None
+        return dq, dkv.squeeze(-2), dindex_q, dindex_k, dweights, None, None, None, None, None, None
         # return dq, dkv.squeeze(-2), None, None, None, None, None, None, None
 
 
+# tokens and sequences routed to each path by deepseek_sparse_attention
+routing_stats = {"dense_tokens": 0, "sparse_tokens": 0, "dense_sequences": 0, "sparse_sequences": 0}
+
+
+def reset_routing_stats() -> None:
+    for key in routing_stats:
+        routing_stats[key] = 0
+
+
+def torch_dense_mla_fwd(
+    q: torch.Tensor,
+    kv: torch.Tensor,
+    offsets: torch.Tensor,
+    dim_v: int,
+    sm_scale: Optional[float] = None,
+):
+    # causal attention per sequence for devices without the tilelang kernels
+    sm_scale = q.shape[-1] ** -0.5 if sm_scale is None else sm_scale
+    o = q.new_empty(q.shape[0], q.shape[1], dim_v)
+    for bos, eos in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        scores = einsum(q[bos:eos].float(), kv[bos:eos].float(), "i h d, j d -> h i j") * sm_scale
+        causal = torch.ones(eos - bos, eos - bos, dtype=torch.bool, device=q.device).tril()
+        probs = scores.masked_fill(~causal, float("-inf")).softmax(dim=-1)
+        o[bos:eos] = einsum(probs, kv[bos:eos, :dim_v].float(), "h i j, j d -> i h d").to(o.dtype)
+    return o
+
+
+def dense_fallback_attention(
+    q: torch.Tensor,
+    kv: torch.Tensor,
+    index_q: torch.Tensor,
+    index_k: torch.Tensor,
+    weights: torch.Tensor,
+    offsets: torch.Tensor,
+    topk: int,
+    dim_v: int,
+    sm_scale: Optional[float] = None,
+    num_sinks: int = 0,
+    window: int = 0,
+):
+    """
+    deepseek_sparse_attention with the sequences of at most `topk` tokens, which select every key they can see,
+    computed by dense attention without the indexer, and only the longer ones by DSAFunction. The returned indices
+    of a short sequence are all its causal keys, padded with -1 like the indexer's.
+    """
+    lens = prepare_lens(offsets)
+    short = lens <= topk
+    token_short = torch.repeat_interleave(short, lens, output_size=q.shape[0])
+    num_short = int(token_short.sum())
+    num_short_sequences = int(short.sum())
+    routing_stats["dense_tokens"] += num_short
+    routing_stats["sparse_tokens"] += q.shape[0] - num_short
+    routing_stats["dense_sequences"] += num_short_sequences
+    routing_stats["sparse_sequences"] += lens.numel() - num_short_sequences
+    if num_short == 0:
+        return DSAFunction.apply(q, kv, index_q, index_k, weights, offsets, topk, dim_v, sm_scale, num_sinks, window)
+
+    o = q.new_empty(q.shape[0], q.shape[1], dim_v)
+    topk_indices = torch.full((q.shape[0], topk), -1, dtype=torch.int32, device=q.device)
+
+    short_offsets = F.pad(lens[short].cumsum(0), (1, 0)).to(offsets.dtype)
+    q_short, kv_short = q[token_short].contiguous(), kv[token_short].contiguous()
+    if q.is_cuda:
+        o[token_short], _ = dense_mla_fwd_interface(q_short, kv_short.unsqueeze(-2), short_offsets, sm_scale=sm_scale, d_v=dim_v)
+    else:
+        o[token_short] = torch_dense_mla_fwd(q_short, kv_short, short_offsets, dim_v, sm_scale)
+    keys = torch.arange(topk, dtype=torch.int32, device=q.device)
+    positions = prepare_position_ids(short_offsets)
+    topk_indices[token_short] = torch.where(keys <= positions[:, None], keys, -1)
+
+    if num_short < q.shape[0]:
+        token_long = ~token_short
+        long_offsets = F.pad(lens[~short].cumsum(0), (1, 0)).to(offsets.dtype)
+        o[token_long], topk_indices[token_long] = DSAFunction.apply(
+            q[token_long].contiguous(), kv[token_long].contiguous(), index_q[token_long].contiguous(),
+            index_k[token_long].contiguous(), weights[token_long].contiguous(), long_offsets, topk, dim_v, sm_scale,
+            num_sinks, window)
+
+    return o, topk_indices
+
+
 def deepseek_sparse_attention(
     q: torch.Tensor,
     kv: torch.Tensor,
@@ -70,8 +163,130 @@ def deepseek_sparse_attention(
     topk: int,
     dim_v: int,
     sm_scale: Optional[float] = None,
+    dense_fallback: bool = True,
+    num_sinks: int = 0,
+    window: int = 0,
 ):
-    return DSAFunction.apply(q, kv, index_q, index_k, weights, offsets, topk, dim_v, sm_scale)
+    # without gradients, sequences no longer than topk take the dense path (dense_fallback_attention); with
+    # gradients every sequence stays sparse, so that the indexer is trained on all of them. With num_sinks or window,
+    # every query always attends to the first num_sinks keys and its window last keys, and the indexer only fills the
+    # other topk - num_sinks - window slots, scoring only the keys between them
+    requires_grad = torch.is_grad_enabled() and any(x.requires_grad for x in (q, kv, index_q, index_k, weights))
+    if dense_fallback and not requires_grad:
+        return dense_fallback_attention(
+            q, kv, index_q, index_k, weights, offsets, topk, dim_v, sm_scale, num_sinks, window)
+    routing_stats["sparse_tokens"] += q.shape[0]
+    routing_stats["sparse_sequences"] += offsets.shape[0] - 1
+    return DSAFunction.apply(q, kv, index_q, index_k, weights, offsets, topk, dim_v, sm_scale, num_sinks, window)
+
+class SparseMLAFunction(torch.autograd.Function):
+    # sparse MLA over given top-k indices, e.g. those of an earlier layer: no indexer and no indexer gradients
+
+    @staticmethod
+    def forward(
+        ctx,
+        q: torch.Tensor,
+        kv: torch.Tensor,
+        topk_indices: torch.Tensor,
+        offsets: torch.Tensor,
+        dim_v: int,
+        sm_scale: Optional[float] = None,
+    ):
+        topk_indices = topk_indices.to(torch.int32).contiguous()
+        o, lse = sparse_mla_fwd_interface(q, kv.unsqueeze(-2), topk_indices.unsqueeze(-2), offsets, sm_scale=sm_scale, d_v=dim_v)
+        ctx.save_for_backward(q, kv, topk_indices, o, lse, offsets)
+        ctx.sm_scale = sm_scale
+        return o
+
+    @staticmethod
+    def backward(
+        ctx,
+        do: torch.Tensor,
+    ):
+        q, kv, topk_indices, o, lse, offsets = ctx.saved_tensors
+        dq, dkv = sparse_mla_bwd(
+            q,
+            kv.unsqueeze(-2),
+            o,
+            do,
+            topk_indices.unsqueeze(-2),
+            lse,
+            offsets,
+            sm_scale=ctx.sm_scale)
+        return dq, dkv.squeeze(-2), None, None, None, None
+
+
+def deepseek_sparse_attention_with_indices(
+    q: torch.Tensor,
+    kv: torch.Tensor,
+    topk_indices: torch.Tensor,
+    offsets: torch.Tensor,
+    dim_v: int,
+    sm_scale: Optional[float] = None,
+):
+    return SparseMLAFunction.apply(q, kv, topk_indices, offsets, dim_v, sm_scale)
+
+
+def topk_overlap(topk_indices: torch.Tensor, ref_indices: torch.Tensor) -> tuple[int, int]:
+    """
+    Number of the valid (not -1) indices of every row of `ref_indices` [S, topk] also in the same row of
+    `topk_indices` [S, topk'], and the number of valid indices of `ref_indices`.
+    """
+    ref_sorted = ref_indices.long().sort(dim=-1).values
+    pos = torch.searchsorted(ref_sorted, topk_indices.long().contiguous()).clamp(max=ref_sorted.shape[-1] - 1)
+    found = (ref_sorted.gather(-1, pos) == topk_indices.long()) & (topk_indices >= 0)
+    return int(found.sum()), int((ref_indices >= 0).sum())
+
+
+def torch_sparse_mla_fwd(
+    q: torch.Tensor,
+    kv: torch.Tensor,
+    topk_indices: torch.Tensor,
+    dim_v: int,
+    sm_scale: Optional[float] = None,
+    block_size: int = 64,
+):
+    # attention of the queries q [S, H, D], the last S tokens of a sequence, over the rows topk_indices [S, topk] of
+    # its keys kv [S', D], gathered for block_size queries at a time; like the kernel, -1 and non-causal indices are
+    # skipped
+    sm_scale = q.shape[-1] ** -0.5 if sm_scale is None else sm_scale
+    o = q.new_empty(q.shape[0], q.shape[1], dim_v)
+    positions = torch.arange(kv.shape[0] - q.shape[0], kv.shape[0], device=q.device)
+    for start in range(0, q.shape[0], block_size):
+        indices = topk_indices[start:start + block_size].long()
+        kv_selected = kv[indices.clamp(min=0)].float()
+        scores = einsum(q[start:start + block_size].float(), kv_selected, "i h d, i k d -> i h k") * sm_scale
+        invalid = (indices < 0) | (indices > positions[start:start + block_size, None])
+        probs = scores.masked_fill(invalid[:, None, :], float("-inf")).softmax(dim=-1)
+        o[start:start + block_size] = einsum(probs, kv_selected[..., :dim_v], "i h k, i k d -> i h d").to(o.dtype)
+    return o
+
+
+def deepseek_sparse_attention_prefill_chunk(
+    q: torch.Tensor,
+    kv: torch.Tensor,
+    index_q: torch.Tensor,
+    index_k: torch.Tensor,
+    weights: torch.Tensor,
+    topk: int,
+    dim_v: int,
+    sm_scale: Optional[float] = None,
+    topk_indices: Optional[torch.Tensor] = None,
+    num_sinks: int = 0,
+    window: int = 0,
+):
+    """
+    Sparse attention of one prompt chunk, the last q.shape[0] tokens of a sequence, over the keys kv [S, D] and
+    index_k [S, D'] of the whole sequence so far (cached prefix and chunk). The indexer logits and the gathered keys
+    are at most chunk x context. Given `topk_indices`, e.g. of an earlier layer, the indexer is skipped. Returns the
+    output and the top-k indices, positions in the sequence.
+    """
+    chunk_start = kv.shape[0] - q.shape[0]
+    if topk_indices is None:
+        topk_indices, _ = indexer_topk_reducesum_chunk(index_q, weights, index_k, topk, chunk_start, num_sinks, window)
+        topk_indices = topk_indices.to(torch.int32)
+    return torch_sparse_mla_fwd(q, kv, topk_indices, dim_v, sm_scale), topk_indices
+
 
 class DSAFunctionBlockIndexer(torch.autograd.Function):
 
@@ -162,7 +377,8 @@ class DSAFunctionWarmup(torch.autograd.Function):
     ):
         q, kv, index_q, index_k, weights, offsets = ctx.saved_tensors
 
-        dindex_q, dweights, dindex_k = full_indexer_bwd_interface(q, kv, index_q, weights, index_k, offsets)
+        # tiled over queries and keys, the memory does not grow with the warmup sequence length
+        dindex_q, dweights, dindex_k = streaming_full_indexer_bwd_interface(q, kv, index_q, weights, index_k, offsets)
 
         return None, None, dindex_q, dindex_k, dweights, None, None, None, None
 
@@ -179,3 +395,35 @@ def deepseek_sparse_attention_warmup(
     sm_scale: Optional[float] = None,
 ):
     return DSAFunctionWarmup.apply(q, kv, index_q, index_k, weights, offsets, topk, dim_v, sm_scale)
+
+
+def prewarm_dsa_kernels(
+    heads: int,
+    dim_v: int,
+    tail_dim: int,
+    topk: int,
+    index_heads: int,
+    index_dim: int,
+    sm_scale: Optional[float] = None,
+    dtype: torch.dtype = torch.bfloat16,
+    backward: bool = True,
+    warmup: bool = False,
+    block_indexer: bool = False,
+    block_size: int = 128,
+    block_topk: int = 64,
+):
+    """
+    Compile the kernels of deepseek_sparse_attention for these shapes into the kernel registry, e.g. at model load,
+    so that the first step does not compile them in every layer. `warmup` and `block_indexer` add the kernels of
+    deepseek_sparse_attention_warmup and deepseek_sparse_attention_block_indexer. Returns the registry stats.
+    """
+    get_sparse_mla_fwd_kernel(heads, dim_v, tail_dim, topk, 1, sm_scale, dtype)
+    if backward:
+        get_sparse_mla_topk_reducesum_kernel(heads, dim_v, tail_dim, topk, dtype)
+        get_sparse_mla_bwd_kernels(heads, dim_v, tail_dim, topk, 1, sm_scale, dtype)
+        get_indexer_bwd_kernel(index_heads, index_dim, topk, dtype)
+    if warmup:
+        get_dense_mla_fwd_kernel(heads, dim_v, tail_dim, 1, sm_scale, dtype)
+    if block_indexer:
+        get_gather_qk_reducesum_kernel(index_heads, index_dim, block_topk * block_size, index_dim ** -0.5, dtype)
+    return kernel_registry.stats()
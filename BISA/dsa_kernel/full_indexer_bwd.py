@@ -1,10 +1,5 @@
 import torch
-import torch.nn.functional as F
-from einops import einsum, repeat
-
-import tilelang as tl
-import tilelang.language as T
-from typing import Optional
+from einops import einsum
 
 
 @torch.no_grad()
@@ -105,4 +100,123 @@ def full_indexer_bwd_interface(
             dindexk[start:start + chunk_end] += dIK.to(dindexk.dtype)
     
     return dindexq, dweights, dindexk
-    
+
+
+@torch.no_grad()
+def streaming_full_indexer_bwd_interface(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    indexq: torch.Tensor,
+    weights: torch.Tensor,
+    indexk: torch.Tensor,
+    offsets: torch.Tensor,
+    chunk_size: int = 512,
+    key_chunk_size: int = 512,
+    eps: float = 1e-9,
+):
+    """
+    Gradients of the warmup KL(p || q) between the head-summed attention distribution p and the indexer
+    distribution q, like `full_indexer_bwd_interface`, tiled over queries and keys. The temporaries are
+    [chunk_size, heads, key_chunk_size] whatever the sequence length, and run on any device, CPU included.
+
+    With dU = g - qhat * sum_j(g), g = -p (clipped like the reference) on the causal keys, three sweeps over the keys:
+    1. online log-sum-exp of the attention logits of every head and of the indexer logits;
+    2. p and g from the attention logits, the g part of the gradients and sum_j(g);
+    3. the qhat * sum_j(g) part of the gradients, from the indexer logits only.
+    The dense attention logits are thus computed twice, the (much cheaper) indexer logits three times.
+    """
+    device = q.device
+    softmax_scale = q.shape[-1] ** -0.5
+    H = q.shape[1]
+
+    dindexq = torch.zeros_like(indexq)
+    dweights = torch.zeros_like(weights)
+    dindexk = torch.zeros_like(indexk)
+
+    B = offsets.numel() - 1
+    for bi in range(B):
+        start = int(offsets[bi].item())
+        end = int(offsets[bi + 1].item())
+        seq_len = end - start
+        if seq_len <= 0:
+            continue
+
+        q_batch = q[start:end]
+        k_batch = k[start:end]
+        indexq_batch = indexq[start:end]
+        weights_batch = weights[start:end]
+        indexk_batch = indexk[start:end]
+        dIK = torch.zeros(seq_len, indexk.shape[-1], device=device, dtype=torch.float32)
+
+        for chunk_start in range(0, seq_len, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, seq_len)
+
+            q_chunk = q_batch[chunk_start:chunk_end]
+            IQ = indexq_batch[chunk_start:chunk_end]
+            W = weights_batch[chunk_start:chunk_end].to(torch.float32)
+            IQ_f = IQ.to(torch.float32)
+            qp = torch.arange(chunk_start, chunk_end, device=device)[:, None]
+            key_tiles = [(ks, min(ks + key_chunk_size, chunk_end)) for ks in range(0, chunk_end, key_chunk_size)]
+
+            def attention_logits(ks, ke, causal_2d):
+                logits = einsum(q_chunk, k_batch[ks:ke], 'q h d, k d -> q h k').to(torch.float32) * softmax_scale
+                return logits.masked_fill(~causal_2d.unsqueeze(1), float('-inf'))
+
+            def index_logits(ks, ke, causal_2d):
+                T = einsum(IQ, indexk_batch[ks:ke], 'i h k, j k -> i h j').to(torch.float32) * softmax_scale
+                R = torch.relu(T)
+                Sij = (R * W.unsqueeze(-1)).sum(dim=1)
+                return T, R, Sij.masked_fill(~causal_2d, float('-inf'))
+
+            def accumulate(dU, ks, ke, T, R):
+                # dW, dIQ and dIK of a [chunk, keys] gradient dU of the indexer logits
+                dW_chunk.add_((dU.unsqueeze(1) * R).sum(dim=-1))
+                dT = dU.unsqueeze(1) * W.unsqueeze(-1) * (T > 0)
+                dIQ_chunk.add_(softmax_scale * einsum(dT, indexk_batch[ks:ke].to(torch.float32), 'i h j, j k -> i h k'))
+                dIK[ks:ke] += softmax_scale * einsum(dT, IQ_f, 'i h j, i h k -> j k')
+
+            # 1. running max / sum of exp, key tile 0 makes every row finite
+            m_attn = torch.full(q_chunk.shape[:2], float('-inf'), device=device)
+            l_attn = torch.zeros(q_chunk.shape[:2], device=device)
+            m_index = torch.full(q_chunk.shape[:1], float('-inf'), device=device)
+            l_index = torch.zeros(q_chunk.shape[:1], device=device)
+            for ks, ke in key_tiles:
+                causal_2d = qp >= torch.arange(ks, ke, device=device)[None, :]
+                logits = attention_logits(ks, ke, causal_2d)
+                m_new = torch.maximum(m_attn, logits.amax(dim=-1))
+                l_attn = l_attn * torch.exp(m_attn - m_new) + torch.exp(logits - m_new.unsqueeze(-1)).sum(dim=-1)
+                m_attn = m_new
+                _, _, Sij = index_logits(ks, ke, causal_2d)
+                m_new = torch.maximum(m_index, Sij.amax(dim=-1))
+                l_index = l_index * torch.exp(m_index - m_new) + torch.exp(Sij - m_new.unsqueeze(-1)).sum(dim=-1)
+                m_index = m_new
+            lse_attn = m_attn + l_attn.log()
+            lse_index = m_index + l_index.log()
+
+            # 2. p, g and the g part of the gradients; sum_j p over the heads is H
+            dW_chunk = torch.zeros(W.shape, device=device)
+            dIQ_chunk = torch.zeros(IQ.shape, device=device)
+            g_sum = torch.zeros(q_chunk.shape[:1], device=device)
+            for ks, ke in key_tiles:
+                causal_2d = qp >= torch.arange(ks, ke, device=device)[None, :]
+                p = torch.exp(attention_logits(ks, ke, causal_2d) - lse_attn.unsqueeze(-1)).sum(dim=1) / (H + eps)
+                p_used = p.clamp_min(eps).log().clamp(-100.0, 0.0).exp()
+                T, R, Sij = index_logits(ks, ke, causal_2d)
+                in_range = (Sij - lse_index.unsqueeze(-1)) > -100.0
+                g = (-p_used * in_range).masked_fill(~causal_2d, 0.0)
+                g_sum += g.sum(dim=-1)
+                accumulate(g, ks, ke, T, R)
+
+            # 3. the -qhat * sum_j(g) part
+            for ks, ke in key_tiles:
+                causal_2d = qp >= torch.arange(ks, ke, device=device)[None, :]
+                T, R, Sij = index_logits(ks, ke, causal_2d)
+                qhat = torch.exp(Sij - lse_index.unsqueeze(-1))
+                accumulate(-qhat * g_sum.unsqueeze(-1), ks, ke, T, R)
+
+            dindexq[start + chunk_start:start + chunk_end] = dIQ_chunk.to(dindexq.dtype)
+            dweights[start + chunk_start:start + chunk_end] = dW_chunk.to(dweights.dtype)
+
+        dindexk[start:end] = dIK.to(dindexk.dtype)
+
+    return dindexq, dweights, dindexk
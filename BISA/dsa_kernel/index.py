@@ -2,43 +2,74 @@
 import torch
 import torch.nn.functional as F
 import functools
-from typing import Callable, Any
+from collections import OrderedDict, namedtuple
+from typing import Callable, Any, Optional
 
 
-def tensor_cache(fn: Callable[..., torch.Tensor],) -> Callable[..., torch.Tensor]:
-    """
-    A decorator that caches the most recent result of a function with tensor inputs.
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+def tensor_key(x: Any) -> Any:
+    # tensors are identified by their memory, version and layout, other arguments by value
+    if isinstance(x, torch.Tensor):
+        return (x.data_ptr(), x._version, tuple(x.shape), x.stride(), x.dtype, x.device)
+    return x
 
-    This decorator will store the output of the decorated function for the most recent set of input tensors.
-    If the function is called again with the same input tensors, it will return the cached result.
 
+def tensor_cache(fn: Optional[Callable[..., torch.Tensor]] = None, maxsize: int = 8) -> Callable[..., torch.Tensor]:
+    """
+    A decorator that caches the results of a function with tensor inputs in a small LRU.
+
+    Tensor arguments are keyed on (data_ptr, _version, shape, stride, dtype, device), so calls with the same tensor
+    (or a fresh view of the same memory, e.g. `position_ids.view(-1)` in every layer) hit the cache, and an in-place
+    update of an input is a miss. Each entry holds on to its input tensors, so their memory cannot be reused by
+    another tensor while the entry is cached; the LRU bounds what is kept alive.
 
     Args:
         fn (Callable[..., torch.Tensor]):
             The function to be decorated. It should take tensor inputs and return tensor outputs.
+        maxsize (int):
+            The number of results kept, the least recently used is dropped first.
 
     Returns:
         Callable[..., torch.Tensor]:
-            A wrapped version of the input function with single-entry caching.
+            A wrapped version of the input function, with `cache_info()` (hits, misses, maxsize, currsize) and
+            `cache_clear()` like `functools.lru_cache`.
     """
-    last_args: tuple | None = None
-    last_kwargs: dict | None = None
-    last_result: Any = None
+    if fn is None:
+        return functools.partial(tensor_cache, maxsize=maxsize)
+    cache: OrderedDict = OrderedDict()
+    hits = misses = 0
 
     @functools.wraps(fn)
     def wrapper(*args: Any, **kwargs: Any) -> Any:
-        nonlocal last_args, last_kwargs, last_result
-
-        if (last_args is not None and last_kwargs is not None) and \
-            (len(args) == len(last_args) and len(kwargs) == len(last_kwargs)) and \
-                all(a is b for a, b in zip(args, last_args, strict=False)) and \
-                    all(k in last_kwargs and v is last_kwargs[k] for k, v in kwargs.items()):
-            return last_result
-
+        nonlocal hits, misses
+        key = (tuple(tensor_key(a) for a in args), tuple((k, tensor_key(v)) for k, v in sorted(kwargs.items())))
+        entry = cache.get(key)
+        if entry is not None:
+            cache.move_to_end(key)
+            hits += 1
+            return entry[1]
+
+        misses += 1
         result = fn(*args, **kwargs)
-        last_args, last_kwargs, last_result = args, kwargs, result
+        inputs = [x for x in (*args, *kwargs.values()) if isinstance(x, torch.Tensor)]
+        cache[key] = (inputs, result)
+        cache.move_to_end(key)
+        while len(cache) > maxsize:
+            cache.popitem(last=False)
         return result
 
+    def cache_info() -> CacheInfo:
+        return CacheInfo(hits, misses, maxsize, len(cache))
+
+    def cache_clear() -> None:
+        nonlocal hits, misses
+        cache.clear()
+        hits = misses = 0
+
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
     return wrapper
 
 
@@ -62,15 +93,16 @@ def prepare_lens_from_cu_seqlens(cu_seqlens: torch.LongTensor,) -> torch.LongTen
 
 @tensor_cache
 def prepare_position_ids(cu_seqlens: torch.LongTensor) -> torch.LongTensor:
-    return torch.cat([
-        torch.arange(n, dtype=cu_seqlens.dtype, device=cu_seqlens.device)
-        for n in prepare_lens(cu_seqlens).unbind()
-    ])
+    # offset of every token minus the offset of its sequence, without a loop over the sequences
+    bos, eos = cu_seqlens[[0, -1]].tolist()
+    starts = torch.repeat_interleave(cu_seqlens[:-1], prepare_lens(cu_seqlens), output_size=eos - bos)
+    return torch.arange(bos, eos, dtype=cu_seqlens.dtype, device=cu_seqlens.device) - starts
 
 
 @tensor_cache
 def prepare_sequence_ids(cu_seqlens: torch.LongTensor) -> torch.LongTensor:
-    return prepare_position_ids(cu_seqlens).eq(0).cumsum(0) - 1
+    lens = prepare_lens(cu_seqlens)
+    return torch.repeat_interleave(torch.arange(lens.numel(), dtype=cu_seqlens.dtype, device=cu_seqlens.device), lens)
 
 
 @tensor_cache
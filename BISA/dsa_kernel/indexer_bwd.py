@@ -6,6 +6,7 @@ import tilelang as tl
 import tilelang.language as T
 from typing import Optional
 from .index import prepare_token_indices
+from .autotune import get_kernel
 
 
 BF16 = "bfloat16"
@@ -168,6 +169,18 @@ def tl_indexer_bwd_impl(
     return tl_indexer_bwd_kernel
 
 
+def get_indexer_bwd_kernel(heads: int, dim: int, topk: int, dtype: torch.dtype = torch.bfloat16, run=None, **params):
+    # compiled kernel from the registry, tile parameters left as None come from the autotune cache
+    return get_kernel(
+        "indexer_bwd",
+        tl_indexer_bwd_impl,
+        (heads, dim, topk),
+        dict(heads=heads, dim=dim, topk=topk, dtype=dtype),
+        run=run,
+        **params,
+    )
+
+
 def indexer_bwd_interface(
     q: torch.Tensor,
     weights: torch.Tensor,
@@ -176,13 +189,25 @@ def indexer_bwd_interface(
     index_score: torch.Tensor,
     topk_indices: torch.Tensor,
     offsets: torch.Tensor,
+    block_I: Optional[int] = None,
+    num_threads: Optional[int] = None,
 ):
     _, heads, dim, topk = *q.shape, topk_indices.shape[-1]
     token_indices = prepare_token_indices(offsets)
     dq = torch.zeros_like(q)
     dweights = torch.zeros_like(weights)
     dk = torch.zeros(k.shape, dtype=torch.float32, device=k.device)
-    kernel = tl_indexer_bwd_impl(heads, dim, topk)
+    kernel = get_indexer_bwd_kernel(
+        heads,
+        dim,
+        topk,
+        q.dtype,
+        run=lambda kernel: kernel(q, weights, k, torch.zeros_like(q), torch.zeros_like(weights),
+                                  torch.zeros_like(dk), attn_score, index_score, topk_indices, offsets,
+                                  token_indices),
+        block_I=block_I,
+        num_threads=num_threads,
+    )
     kernel(q, weights, k, dq, dweights, dk, attn_score, index_score, topk_indices, offsets,
            token_indices)
     return dq, dweights, dk.to(q.dtype)
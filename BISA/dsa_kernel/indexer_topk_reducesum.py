@@ -13,6 +13,74 @@ BF16 = "bfloat16"
 FP32 = "float32"
 INT32 = "int32"
 
+def forced_topk_indices(positions: torch.Tensor, num_sinks: int, window: int) -> torch.Tensor:
+    # per query position, the first num_sinks keys and the window keys ending at the query, -1 where a key is not
+    # causal or is already a sink
+    sinks = torch.arange(num_sinks, device=positions.device)[None, :]
+    sinks = torch.where(sinks <= positions[:, None], sinks, -1)
+    recent = positions[:, None] - window + 1 + torch.arange(window, device=positions.device)[None, :]
+    recent = torch.where(recent >= num_sinks, recent, -1)
+    return torch.cat([sinks, recent], dim=-1)
+
+
+def indexer_topk_reducesum_chunk(
+    q_chunk: torch.Tensor,
+    weights_chunk: torch.Tensor,
+    k_visible: torch.Tensor,
+    topk: int,
+    chunk_start: int,
+    num_sinks: int = 0,
+    window: int = 0,
+):
+    """
+    Top-k of the queries at positions [chunk_start, chunk_start + len(q_chunk)) of a sequence over its keys
+    `k_visible` [0, chunk_start + len(q_chunk)), with their softmax scores. The logits are chunk x heads x visible
+    keys, so the chunk size bounds the memory. Indices are positions in the sequence, -1 past the causal keys.
+
+    With `num_sinks` or `window`, the first num_sinks + window slots always hold the first num_sinks keys and the
+    window keys ending at the query (score 0), and only the other slots are chosen by score, among the keys between
+    them: the sinks and the window of the chunk are not scored at all.
+    """
+    device = q_chunk.device
+    softmax_scale = q_chunk.shape[-1] ** -0.5
+    chunk_end = chunk_start + q_chunk.shape[0]
+    num_forced = num_sinks + window
+    scored_topk = topk - num_forced
+    assert scored_topk > 0, f"topk {topk} leaves no slot to score after {num_sinks} sinks and a window of {window}"
+
+    # the keys some query of the chunk may score: after the sinks and before the window of the last query
+    key_start, key_end = num_sinks, max(chunk_end - window, num_sinks)
+    num_keys = key_end - key_start
+
+    logits = einsum(q_chunk, k_visible[key_start:key_end], 's1 h d, s2 d -> s1 h s2')
+    logits = F.relu(logits)
+
+    logits = (logits * weights_chunk.unsqueeze(-1)).sum(dim=-2, dtype=torch.float32) * softmax_scale
+
+    row_indices = torch.arange(chunk_start, chunk_end, device=device)[:, None]
+    col_indices = torch.arange(key_start, key_end, device=device)[None, :]
+    mask = row_indices - window >= col_indices
+
+    logits = torch.where(mask, logits, torch.tensor(float('-inf'), device=device))
+
+    if num_keys < scored_topk:
+        pad_size = scored_topk - num_keys
+        logits = F.pad(logits, (0, pad_size), value=float('-inf'))
+
+    topk_logits, topk_indices = torch.topk(logits, k=scored_topk, dim=-1)
+    topk_scores = F.softmax(topk_logits, dim=-1, dtype=torch.float32)
+
+    # masked and padded slots, all of them for a query with nothing to score
+    valid_mask = topk_logits > float('-inf')
+    topk_indices = torch.where(valid_mask, topk_indices + key_start, -1)
+    topk_scores = torch.where(valid_mask, topk_scores, 0.0)
+    if num_forced > 0:
+        forced = forced_topk_indices(row_indices[:, 0], num_sinks, window)
+        topk_indices = torch.cat([forced, topk_indices], dim=-1)
+        topk_scores = F.pad(topk_scores, (num_forced, 0), value=0.0)
+    return topk_indices, topk_scores
+
+
 def indexer_topk_reducesum_interface(
     q: torch.Tensor,
     weights: torch.Tensor,
@@ -21,10 +89,12 @@ def indexer_topk_reducesum_interface(
     offsets: torch.Tensor,
     dtype: str = BF16,
     chunk_size: int = 256,
+    num_sinks: int = 0,
+    window: int = 0,
 ):
+    # num_sinks and window: see indexer_topk_reducesum_chunk
     total_seq_len = q.shape[0]
     device = q.device
-    softmax_scale = q.shape[-1] ** -0.5
     
     all_topk_indices = torch.full((total_seq_len, topk), -1, dtype=torch.int32, device=device)
     all_topk_score = torch.full((total_seq_len, topk), float('-inf'), dtype=torch.float32, device=device)
@@ -40,35 +110,10 @@ def indexer_topk_reducesum_interface(
         
         for chunk_start in range(0, seq_len, chunk_size):
             chunk_end = min(chunk_start + chunk_size, seq_len)
-            chunk_len = chunk_end - chunk_start
-            
-            q_chunk = q_batch[chunk_start:chunk_end]
-            weights_chunk = weights_batch[chunk_start:chunk_end]
-            
-            k_visible = k_batch[:chunk_end]
-            
-            logits = einsum(q_chunk, k_visible, 's1 h d, s2 d -> s1 h s2')
-            logits = F.relu(logits)
-            
-            logits = (logits * weights_chunk.unsqueeze(-1)).sum(dim=-2, dtype=torch.float32) * softmax_scale
-            
-            row_indices = torch.arange(chunk_start, chunk_end, device=device)[:, None]
-            col_indices = torch.arange(chunk_end, device=device)[None, :]
-            mask = row_indices >= col_indices
-            
-            logits = torch.where(mask, logits, torch.tensor(float('-inf'), device=device))
-            
-            if chunk_end < topk:
-                pad_size = topk - chunk_end
-                logits = F.pad(logits, (0, pad_size), value=float('-inf'))
-            
-            topk_logits, topk_indices = torch.topk(logits, k=topk, dim=-1)
-            topk_scores = F.softmax(topk_logits, dim=-1, dtype=torch.float32)
             
-            if chunk_end < topk:
-                valid_mask = topk_indices < chunk_end
-                topk_indices = torch.where(valid_mask, topk_indices, torch.tensor(-1, dtype=torch.int32, device=device))
-                topk_scores = torch.where(valid_mask, topk_scores, torch.tensor(float(0.0), device=device))
+            topk_indices, topk_scores = indexer_topk_reducesum_chunk(
+                q_batch[chunk_start:chunk_end], weights_batch[chunk_start:chunk_end], k_batch[:chunk_end], topk, chunk_start,
+                num_sinks, window)
             
             global_start = start_idx + chunk_start
             global_end = start_idx + chunk_end
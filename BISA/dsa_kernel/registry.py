@@ -0,0 +1,54 @@
+import time
+from typing import Any, Callable, Optional
+
+
+class KernelRegistry:
+    """
+    Compiled kernels by (name, args, params), the full parameter tuple of the tilelang factory, so that every layer
+    and step after the first reuses the same kernel object. Counts hits, misses, compilations and compile time.
+    """
+
+    def __init__(self):
+        self.kernels = {}
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.compiles = 0
+        self.compile_time = 0.0
+
+    def get(self, name: str, build: Callable[[], Any], args: tuple, params: Optional[dict] = None):
+        # `build()` compiles the kernel of (name, args, params) on a miss
+        key = (name, tuple(args), tuple(sorted((params or {}).items())))
+        kernel = self.kernels.get(key)
+        if kernel is not None:
+            self.hits += 1
+            return kernel
+        self.misses += 1
+        start = time.perf_counter()
+        kernel = build()
+        self.compile_time += time.perf_counter() - start
+        self.compiles += 1
+        self.kernels[key] = kernel
+        return kernel
+
+    def kernel(self, name: str, factory: Callable, *args: Any, **params: Any):
+        """The kernel of `factory(*args, **params)`."""
+        return self.get(name, lambda: factory(*args, **params), args, params)
+
+    def stats(self) -> dict:
+        return {
+            "kernels": len(self.kernels),
+            "compiles": self.compiles,
+            "compile_time": self.compile_time,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def clear(self) -> None:
+        self.kernels.clear()
+        self.reset_stats()
+
+
+kernel_registry = KernelRegistry()
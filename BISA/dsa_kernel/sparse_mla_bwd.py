@@ -3,6 +3,8 @@ import tilelang
 from tilelang import language as T
 import torch
 from .index import prepare_token_indices
+from .autotune import get_kernel
+from .registry import kernel_registry
 
 
 
@@ -289,6 +291,22 @@ def bwd(
     return sparse_mla_bwd_kernel
 
 
+def get_sparse_mla_bwd_kernels(heads, dim, tail_dim, topk, kv_group=1, sm_scale=None, dtype=torch.bfloat16,
+                               is_causal=True, run=None, **params):
+    # (preprocess, bwd, postprocess) compiled kernels from the registry, the tile parameters of bwd left as None
+    # come from the autotune cache
+    bwd_kernel = get_kernel(
+        "sparse_mla_bwd",
+        bwd,
+        (heads, dim, tail_dim, topk, kv_group, sm_scale, is_causal),
+        dict(heads=heads, dim=dim, tail_dim=tail_dim, topk=topk, kv_group=kv_group, is_causal=is_causal, dtype=dtype),
+        run=run,
+        **params)
+    preprocess_kernel = kernel_registry.kernel("sparse_mla_bwd_preprocess", preprocess, heads, dim)
+    postprocess_kernel = kernel_registry.kernel("sparse_mla_bwd_postprocess", postprocess, dim, tail_dim, kv_group)
+    return preprocess_kernel, bwd_kernel, postprocess_kernel
+
+
 def sparse_mla_bwd(q,
                    kv,
                    o,
@@ -299,7 +317,10 @@ def sparse_mla_bwd(q,
                    sm_scale=None,
                    is_casual=True,
                    return_kernel=False,
-                   delta=None):
+                   delta=None,
+                   block_size=None,
+                   num_stages=None,
+                   threads=None):
     assert q.is_contiguous()
     assert kv.is_contiguous()
     assert indices.is_contiguous()
@@ -319,14 +340,26 @@ def sparse_mla_bwd(q,
     token_indices = prepare_token_indices(offsets)
 
     # Get kernels
-    preprocess_kernel = preprocess(H, D)
-    bwd_kernel = bwd(H, D, D_tail, topk, kv_group, sm_scale, is_casual)
-    postprocess_kernel = postprocess(D, D_tail, kv_group)
-    
+    preprocess_kernel = kernel_registry.kernel("sparse_mla_bwd_preprocess", preprocess, H, D)
     if delta is None:
         o = o.contiguous()
         do = do.contiguous()
         delta = preprocess_kernel(o, do)
+
+    _, bwd_kernel, postprocess_kernel = get_sparse_mla_bwd_kernels(
+        H,
+        D,
+        D_tail,
+        topk,
+        kv_group,
+        sm_scale,
+        q.dtype,
+        is_casual,
+        run=lambda kernel: kernel(q, kv, do, indices, lse, delta, offsets, token_indices,
+                                  torch.zeros_like(kv, dtype=torch.float32)),
+        block_size=block_size,
+        num_stages=num_stages,
+        threads=threads)
     dkv = torch.zeros_like(kv, dtype=torch.float32)
     dq = bwd_kernel(q, kv, do, indices, lse, delta, offsets, token_indices, dkv)
     dkv = postprocess_kernel(dkv)
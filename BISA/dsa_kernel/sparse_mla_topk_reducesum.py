@@ -6,6 +6,7 @@ import tilelang
 from tilelang import language as T
 from einops import repeat, rearrange, einsum
 from .index import prepare_token_indices
+from .autotune import get_kernel
 
 BF16 = "bfloat16"
 FP32 = "float32"
@@ -154,6 +155,17 @@ def tl_sparse_mla_topk_reducesum_impl(
     return tl_sparse_mla_topk_reducesum_kernel
 
 
+def get_sparse_mla_topk_reducesum_kernel(heads, dim, tail_dim, topk, dtype=torch.bfloat16, run=None, **params):
+    # compiled kernel from the registry, tile parameters left as None come from the autotune cache
+    return get_kernel(
+        "sparse_mla_topk_reducesum",
+        tl_sparse_mla_topk_reducesum_impl,
+        (heads, dim, tail_dim, topk),
+        dict(heads=heads, dim=dim, tail_dim=tail_dim, topk=topk, dtype=dtype),
+        run=run,
+        **params)
+
+
 def sparse_mla_topk_reducesum_interface(
     q: torch.Tensor,
     kv: torch.Tensor,
@@ -161,6 +173,9 @@ def sparse_mla_topk_reducesum_interface(
     lse: torch.Tensor,
     offsets: torch.Tensor,
     dim_v: int,
+    block_I=None,
+    num_stages=None,
+    threads=None,
 ):
     assert kv.shape[-2] == 1
     seq_len, heads, dim_plus_tail_dim, topk = *q.shape, topk_indices.shape[-1]
@@ -169,7 +184,16 @@ def sparse_mla_topk_reducesum_interface(
     token_indices = prepare_token_indices(offsets)
 
     reducesum = torch.zeros([seq_len, 1, REPLICATE_H, topk], dtype=torch.float32, device=q.device)
-    kernel = tl_sparse_mla_topk_reducesum_impl(heads=heads, dim=dim_v, tail_dim=tail_dim, topk=topk)
+    kernel = get_sparse_mla_topk_reducesum_kernel(
+        heads,
+        dim_v,
+        tail_dim,
+        topk,
+        q.dtype,
+        run=lambda kernel: kernel(q, kv, topk_indices, lse, offsets, token_indices, torch.zeros_like(reducesum)),
+        block_I=block_I,
+        num_stages=num_stages,
+        threads=threads)
     kernel(q, kv, topk_indices, lse, offsets, token_indices, reducesum)
     reducesum = reducesum.sum(dim=-2)  # [batch, seq_len, 1, RH, topk] -> [batch, seq_len, 1, topk]
     attn_score = reducesum / reducesum.sum(dim=-1, keepdim=True)
@@ -0,0 +1,169 @@
+import json
+from typing import Optional
+
+import torch
+from einops import einsum
+
+
+def topk_recall(topk_indices: torch.Tensor, ref_indices: torch.Tensor, ref_mask: Optional[torch.Tensor] = None):
+    """
+    Per row, the number of the reference indices `ref_indices` [S, k] (those with `ref_mask`, else those >= 0) that
+    are also in the same row of `topk_indices` [S, k'], and the number of reference indices.
+    """
+    ref_mask = ref_indices >= 0 if ref_mask is None else ref_mask
+    selected = topk_indices.long().sort(dim=-1).values
+    pos = torch.searchsorted(selected, ref_indices.long().contiguous()).clamp(max=selected.shape[-1] - 1)
+    found = (selected.gather(-1, pos) == ref_indices.long()) & ref_mask
+    return found.sum(-1), ref_mask.sum(-1)
+
+
+def distance_bins(num_bins: int) -> list[int]:
+    # lower edges of the distance histogram: 0, 1, 2, 4, ..., the last bin is open-ended
+    return [0] + [2 ** b for b in range(num_bins - 1)]
+
+
+def indexer_telemetry(
+    q: torch.Tensor,
+    kv: torch.Tensor,
+    topk_indices: torch.Tensor,
+    offsets: torch.Tensor,
+    sm_scale: Optional[float] = None,
+    topk: Optional[int] = None,
+    local_window: int = 128,
+    num_distance_bins: int = 16,
+    chunk_size: int = 64,
+) -> dict:
+    """
+    How well the indexer's top-k `topk_indices` [S, topk] covers the dense attention of q [S, H, D] over kv [S, D],
+    counted over the tokens of the sequences in `offsets`. Queries are scored against their causal keys `chunk_size`
+    at a time, so the scores are at most chunk_size x H x sequence length.
+
+    Returns sums, as tensors on the device so that nothing synchronizes:
+        tokens: query tokens.
+        recall_hits [H]: entries of each head's dense top-k (of `topk` keys, default topk_indices.shape[-1]) that the
+            indexer selected; recall_total: entries of a dense top-k, the same for every head.
+        mass [H]: dense attention probability on the selected keys, summed over the tokens.
+        selected: valid selected indices; local: those less than `local_window` tokens before the query.
+        distance_hist [num_distance_bins]: selected indices by distance to the query, bins from `distance_bins`.
+    """
+    sm_scale = q.shape[-1] ** -0.5 if sm_scale is None else sm_scale
+    topk = topk_indices.shape[-1] if topk is None else topk
+    device = q.device
+    zero = torch.zeros((), dtype=torch.long, device=device)
+    stats = {
+        "tokens": zero.clone(),
+        "recall_hits": torch.zeros(q.shape[1], dtype=torch.long, device=device),
+        "recall_total": zero.clone(),
+        "mass": torch.zeros(q.shape[1], dtype=torch.float32, device=device),
+        "selected": zero.clone(),
+        "local": zero.clone(),
+        "distance_hist": torch.zeros(num_distance_bins, dtype=torch.long, device=device),
+    }
+    for bos, eos in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        for start in range(bos, eos, chunk_size):
+            end = min(start + chunk_size, eos)
+            visible = end - bos
+            positions = torch.arange(start - bos, end - bos, device=device)
+            keys = torch.arange(visible, device=device)
+
+            scores = einsum(q[start:end].float(), kv[bos:end].float(), "i h d, j d -> i h j") * sm_scale
+            causal = keys[None, :] <= positions[:, None]
+            probs = scores.masked_fill(~causal[:, None, :], float("-inf")).softmax(dim=-1)
+
+            # the selected keys of every query as a mask over its visible keys, invalid indices go to a spare column
+            indices = topk_indices[start:end].long()
+            valid = (indices >= 0) & (indices <= positions[:, None])
+            selected = torch.zeros(end - start, visible + 1, dtype=torch.bool, device=device)
+            selected.scatter_(1, torch.where(valid, indices, visible), True)
+            selected = selected[:, :-1]
+
+            stats["mass"] += (probs * selected[:, None, :]).sum(dim=(0, 2))
+            _, dense_indices = probs.topk(min(topk, visible), dim=-1)
+            dense_valid = dense_indices <= positions[:, None, None]
+            dense_hits = selected.gather(1, dense_indices.flatten(1)).view_as(dense_indices) & dense_valid
+            stats["recall_hits"] += dense_hits.sum(dim=(0, 2))
+            stats["recall_total"] += dense_valid[:, 0].sum()
+
+            distances = (positions[:, None] - indices)[valid]
+            bins = torch.floor(torch.log2(distances.clamp(min=1).float())).long() + 1
+            bins = torch.where(distances > 0, bins, 0).clamp(max=num_distance_bins - 1)
+            stats["distance_hist"] += torch.bincount(bins, minlength=num_distance_bins)
+            stats["selected"] += valid.sum()
+            stats["local"] += (distances < local_window).sum()
+            stats["tokens"] += end - start
+    return stats
+
+
+class IndexerTelemetry:
+    """
+    indexer_telemetry accumulated per layer. `record` is called by the attention of every layer with its queries,
+    keys and top-k indices, and only measures every `every`-th call of a layer. `stats()` gives per layer the recall
+    of each head's dense top-k, the attention mass covered per head, the local fraction and the distance histogram,
+    `summary()` their means over layers and heads, and `log(path, **fields)` appends both as one JSON line.
+    """
+
+    def __init__(self, topk: Optional[int] = None, local_window: int = 128, num_distance_bins: int = 16,
+                 every: int = 1, chunk_size: int = 64):
+        self.topk = topk
+        self.local_window = local_window
+        self.num_distance_bins = num_distance_bins
+        self.every = every
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self) -> None:
+        self.layers = {}
+        self.calls = {}
+
+    def record(self, layer_idx: int, q: torch.Tensor, kv: torch.Tensor, topk_indices: torch.Tensor,
+               offsets: torch.Tensor, sm_scale: Optional[float] = None) -> None:
+        calls = self.calls.get(layer_idx, 0)
+        self.calls[layer_idx] = calls + 1
+        if calls % self.every != 0:
+            return
+        with torch.no_grad():
+            stats = indexer_telemetry(q, kv, topk_indices, offsets, sm_scale, self.topk, self.local_window,
+                                      self.num_distance_bins, self.chunk_size)
+        total = self.layers.get(layer_idx)
+        if total is None:
+            self.layers[layer_idx] = stats
+        else:
+            for key, value in stats.items():
+                total[key] += value
+
+    def stats(self) -> dict:
+        result = {}
+        for layer_idx, total in sorted(self.layers.items()):
+            tokens, selected = max(int(total["tokens"]), 1), max(int(total["selected"]), 1)
+            result[layer_idx] = {
+                "tokens": int(total["tokens"]),
+                "recall": (total["recall_hits"].double() / max(int(total["recall_total"]), 1)).tolist(),
+                "mass": (total["mass"].double() / tokens).tolist(),
+                "local": int(total["local"]) / selected,
+                "distance_hist": (total["distance_hist"].double() / selected).tolist(),
+            }
+        return result
+
+    def summary(self, stats: Optional[dict] = None) -> dict:
+        stats = self.stats() if stats is None else stats
+        if not stats:
+            return {"recall": 0.0, "mass": 0.0, "local": 0.0}
+        return {
+            "recall": sum(sum(s["recall"]) / len(s["recall"]) for s in stats.values()) / len(stats),
+            "mass": sum(sum(s["mass"]) / len(s["mass"]) for s in stats.values()) / len(stats),
+            "local": sum(s["local"] for s in stats.values()) / len(stats),
+        }
+
+    def log(self, path: str, **fields) -> dict:
+        stats = self.stats()
+        record = {
+            **fields,
+            "topk": self.topk,
+            "local_window": self.local_window,
+            "distance_bins": distance_bins(self.num_distance_bins),
+            "summary": self.summary(stats),
+            "layers": {str(layer_idx): s for layer_idx, s in stats.items()},
+        }
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return record
@@ -0,0 +1,71 @@
+# the autotuner lives in dsa_kernel/autotune.py, this file only holds its tests
+import json
+import os
+
+import torch
+
+from dsa_kernel.autotune import TUNING_SPACES, Autotuner, MockBackend, format_key
+
+
+def test_autotune():
+    import tempfile
+
+    def cost(name, args, config):
+        # larger tiles are faster, 256 threads with 3 stages runs out of shared memory
+        if config["threads"] == 256 and config["num_stages"] == 3:
+            raise RuntimeError("shared memory exceeded")
+        return 1.0 / config["block_I"] + config["num_stages"] * 0.01 + config["threads"] * 1e-4
+
+    def factory(*args, **config):
+        raise AssertionError("the mock backend never calls the factory")
+
+    def run(kernel):
+        raise AssertionError("the mock backend never launches a kernel")
+
+    with tempfile.TemporaryDirectory() as root:
+        cache_path = os.path.join(root, "autotune.json")
+        args = (64, 512, 64, 2048, 1, None, True)
+        key = dict(heads=64, dim=512, tail_dim=64, topk=2048, kv_group=1, dtype=torch.bfloat16)
+
+        # without tuning an untuned shape gets the default config
+        backend = MockBackend(cost)
+        tuner = Autotuner(backend, cache_path, tune=False)
+        kernel = tuner.get_kernel("sparse_mla_fwd", factory, args, key, run)
+        assert kernel.config == TUNING_SPACES["sparse_mla_fwd"]["default"]
+        assert len(backend.compiled) == 1 and not os.path.exists(cache_path)
+
+        # tuning compiles every valid candidate once, skips the failing ones and stores the winner
+        backend = MockBackend(cost)
+        tuner = Autotuner(backend, cache_path, tune=True)
+        kernel = tuner.get_kernel("sparse_mla_fwd", factory, args, key, run)
+        assert kernel.config == {"block_I": 64, "num_stages": 1, "threads": 128}, kernel.config
+        assert len(tuner.candidates("sparse_mla_fwd", key)) == 12 and len(backend.compiled) == 10
+        with open(cache_path) as f:
+            stored = json.load(f)["mock"]["sparse_mla_fwd"][format_key(key)]
+        assert stored["config"] == kernel.config
+
+        # repeated calls return the memoized kernel
+        assert tuner.get_kernel("sparse_mla_fwd", factory, args, key, run) is kernel
+        assert len(backend.compiled) == 10
+        assert tuner.registry.stats()["compiles"] == 10 and tuner.registry.hits == 2
+
+        # a new process reads the winner and compiles only that config
+        backend = MockBackend(cost)
+        tuner = Autotuner(backend, cache_path, tune=True)
+        assert tuner.get_kernel("sparse_mla_fwd", factory, args, key, run).config == kernel.config
+        assert len(backend.compiled) == 1
+
+        # explicit parameters bypass the cache
+        kernel = tuner.get_kernel("sparse_mla_fwd", factory, args, key, run, block_I=32)
+        assert kernel.config == {"block_I": 32, "num_stages": 2, "threads": 128}
+
+        # candidates are filtered per shape: topk = 32 cannot use 64-wide tiles
+        small_key = dict(key, topk=32)
+        kernel = tuner.get_kernel("sparse_mla_fwd", factory, args[:3] + (32,) + args[4:], small_key, run)
+        assert kernel.config["block_I"] == 32
+        assert len(tuner.candidates("sparse_mla_fwd", small_key)) == 6
+    print("autotune tests passed")
+
+
+if __name__ == "__main__":
+    test_autotune()
@@ -26,6 +26,26 @@ class RegsiterLossFunction(torch.autograd.Function):
 register_loss = RegsiterLossFunction.apply
 
 
+# code dtype and largest code of the latent kv cache formats; fp8 is emulated by rounding through float8_e4m3fn
+KV_CACHE_DTYPES = {"int8": (torch.int8, 127.0), "fp8": (torch.float8_e4m3fn, 448.0)}
+
+
+def fake_quantize_kv(kv: torch.Tensor, dim_v: int, kv_cache_dtype: str = "int8", group_size: int = 64):
+    """
+    Round kv [..., dim_v + rope_dim] the way a quantized latent cache stores it: the latent kv[..., :dim_v] with one
+    scale per token and group of `group_size` channels, the rope part kv[..., dim_v:] untouched.
+    """
+    code_dtype, qmax = KV_CACHE_DTYPES[kv_cache_dtype]
+    latent, rope = kv[..., :dim_v], kv[..., dim_v:]
+    x = latent.float().unflatten(-1, (-1, group_size))
+    scales = (x.abs().amax(dim=-1, keepdim=True) / qmax).clamp(min=1e-8).to(kv.dtype).float()
+    x = (x / scales).clamp(-qmax, qmax)
+    if code_dtype == torch.int8:
+        x = x.round()
+    latent = (x.to(code_dtype).float() * scales).flatten(-2)
+    return torch.cat([latent.to(kv.dtype), rope], dim=-1)
+
+
 def ref_deepseek_sparse_attention_innner(
     q: torch.Tensor,
     kv: torch.Tensor,
@@ -36,6 +56,8 @@ def ref_deepseek_sparse_attention_innner(
     dim_v: int,
     sm_scale: Optional[float] = None,
     index_sm_scale: Optional[float] = None,
+    kv_cache_dtype: Optional[str] = None,
+    kv_cache_group_size: int = 64,
 ):
     dtype = q.dtype
     q, kv, index_q, index_k, weights = map(lambda x: x.to(torch.float32),
@@ -63,9 +85,14 @@ def ref_deepseek_sparse_attention_innner(
         sm_scale = kv.shape[-1]**-0.5
 
     h = q.shape[-2]
-    index_mask = torch.zeros((b, s, s + 1), dtype=torch.bool, device="cuda")\
+    index_mask = torch.zeros((b, s, s + 1), dtype=torch.bool, device=q.device)\
         .scatter_(dim=-1, index=topk_indices, src=torch.ones_like(topk_indices, dtype=torch.bool))[:, :, :-1]
     mask = repeat(casual_mask & index_mask, 'b s1 s2 -> b s1 h s2', h=h)
+    if kv_cache_dtype is not None:
+        # attention reads k and v back from the quantized latent cache, the indexer keys are not cached there.
+        # The scales are per token, so rounding all tokens here equals dequantizing each one as it is read.
+        # Forward only: the rounding has no gradient.
+        kv = fake_quantize_kv(kv, dim_v, kv_cache_dtype, kv_cache_group_size)
     k, v = kv, kv[..., :dim_v]
     logits = einsum(q, k, 'b s1 h d, b s2 d -> b s1 h s2') * sm_scale
     logits = torch.where(mask, logits, float('-inf'))
@@ -97,6 +124,8 @@ def ref_deepseek_sparse_attention(
     dim_v: int,
     sm_scale: Optional[float] = None,
     index_sm_scale: Optional[float] = None,
+    kv_cache_dtype: Optional[str] = None,
+    kv_cache_group_size: int = 64,
 ):
     all_o, all_topk_indices = [], []
     for i in range(offsets.shape[0] - 1):
@@ -110,6 +139,8 @@ def ref_deepseek_sparse_attention(
             dim_v,
             sm_scale,
             index_sm_scale,
+            kv_cache_dtype,
+            kv_cache_group_size,
         )
         all_o.append(o.squeeze(0))
         all_topk_indices.append(topk_indices.squeeze(0))
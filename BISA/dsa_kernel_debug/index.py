@@ -1,79 +1,93 @@
-# Modified from: https://github.com/fla-org/flash-linear-attention/blob/main/fla/ops/utils/index.py
+# tensor_cache and the prepare_* helpers live in dsa_kernel/index.py, this file only holds their tests and
+# benchmarks (and re-exports prepare_token_indices for the debug kernels)
 import torch
 import torch.nn.functional as F
-import functools
-from typing import Callable, Any
 
-
-def tensor_cache(fn: Callable[..., torch.Tensor],) -> Callable[..., torch.Tensor]:
-    """
-    A decorator that caches the most recent result of a function with tensor inputs.
-
-    This decorator will store the output of the decorated function for the most recent set of input tensors.
-    If the function is called again with the same input tensors, it will return the cached result.
-
-
-    Args:
-        fn (Callable[..., torch.Tensor]):
-            The function to be decorated. It should take tensor inputs and return tensor outputs.
-
-    Returns:
-        Callable[..., torch.Tensor]:
-            A wrapped version of the input function with single-entry caching.
-    """
-    last_args: tuple | None = None
-    last_kwargs: dict | None = None
-    last_result: Any = None
-
-    @functools.wraps(fn)
-    def wrapper(*args: Any, **kwargs: Any) -> Any:
-        nonlocal last_args, last_kwargs, last_result
-
-        if (last_args is not None and last_kwargs is not None) and \
-            (len(args) == len(last_args) and len(kwargs) == len(last_kwargs)) and \
-                all(a is b for a, b in zip(args, last_args, strict=False)) and \
-                    all(k in last_kwargs and v is last_kwargs[k] for k, v in kwargs.items()):
-            return last_result
-
-        result = fn(*args, **kwargs)
-        last_args, last_kwargs, last_result = args, kwargs, result
-        return result
-
-    return wrapper
-
-
-@tensor_cache
-def prepare_lens(cu_seqlens: torch.LongTensor) -> torch.LongTensor:
-    return torch.diff(cu_seqlens)
-
-
-@tensor_cache
-def prepare_cu_seqlens_from_lens(
-    lens: torch.LongTensor,
-    dtype: torch.dtype | None = torch.int32,
-) -> torch.LongTensor:
-    return F.pad(lens.cumsum(dim=0, dtype=dtype), (1, 0))
-
-
-@tensor_cache
-def prepare_lens_from_cu_seqlens(cu_seqlens: torch.LongTensor,) -> torch.LongTensor:
-    return torch.diff(cu_seqlens)
-
-
-@tensor_cache
-def prepare_position_ids(cu_seqlens: torch.LongTensor) -> torch.LongTensor:
-    return torch.cat([
+from dsa_kernel.index import prepare_lens, prepare_position_ids, prepare_sequence_ids, prepare_token_indices
+
+
+def test_tensor_cache(num_layers=32):
+    cache_fns = [prepare_lens, prepare_position_ids, prepare_sequence_ids, prepare_token_indices]
+    for fn in cache_fns:
+        fn.cache_clear()
+
+    # forward and backward of every layer interleave calls on the offsets of two micro-batches
+    offsets = torch.tensor([0, 5, 12, 20], dtype=torch.int32)
+    other = torch.tensor([0, 8, 20], dtype=torch.int32)
+    expected = prepare_token_indices.__wrapped__(offsets)
+    for _ in range(num_layers):
+        for cu_seqlens in (offsets, other):
+            prepare_lens(cu_seqlens)
+            token_indices = prepare_token_indices(cu_seqlens)
+    assert torch.equal(prepare_token_indices(offsets), expected)
+    # exactly one computation per distinct offsets
+    assert prepare_token_indices.cache_info().misses == 2
+    assert prepare_position_ids.cache_info().misses == 2
+
+    # an in-place update is a miss
+    offsets[1:] += 1
+    assert not torch.equal(prepare_token_indices(offsets), expected)
+    assert torch.equal(prepare_token_indices(offsets), prepare_token_indices.__wrapped__(offsets))
+    assert prepare_token_indices.cache_info().misses == 3
+
+    # a fresh view of the same tensor in every layer hits the cache
+    prepare_lens.cache_clear()
+    offsets = torch.tensor([[0, 3, 9]], dtype=torch.int32)
+    for _ in range(num_layers):
+        prepare_lens(offsets.view(-1))
+    assert prepare_lens.cache_info().misses == 1
+    assert prepare_lens.cache_info().hits == num_layers - 1
+
+    # a freed input cannot have its memory reused while its entry is cached
+    prepare_lens(torch.tensor([0, 3, 9], dtype=torch.int32))
+    offsets = torch.tensor([0, 4, 9], dtype=torch.int32)
+    assert torch.equal(prepare_lens(offsets), torch.tensor([4, 5], dtype=torch.int32))
+
+    # the cache is bounded
+    for n in range(20):
+        prepare_lens(torch.arange(n + 2, dtype=torch.int32))
+    assert prepare_lens.cache_info().currsize == prepare_lens.cache_info().maxsize
+    print({fn.__name__: fn.cache_info() for fn in cache_fns})
+    print("tensor_cache tests passed")
+
+
+def loop_token_indices(cu_seqlens: torch.LongTensor) -> torch.LongTensor:
+    # the previous implementation, one arange per sequence
+    position_ids = torch.cat([
         torch.arange(n, dtype=cu_seqlens.dtype, device=cu_seqlens.device)
-        for n in prepare_lens(cu_seqlens).unbind()
+        for n in torch.diff(cu_seqlens).unbind()
     ])
-
-
-@tensor_cache
-def prepare_sequence_ids(cu_seqlens: torch.LongTensor) -> torch.LongTensor:
-    return prepare_position_ids(cu_seqlens).eq(0).cumsum(0) - 1
-
-
-@tensor_cache
-def prepare_token_indices(cu_seqlens: torch.LongTensor) -> torch.LongTensor:
-    position_ids = prepare_position_ids(cu_seqlens)
-    return torch.stack([prepare_sequence_ids(cu_seqlens), position_ids], 1).to(cu_seqlens)
\ No newline at end of file
+    return torch.stack([position_ids.eq(0).cumsum(0) - 1, position_ids], 1).to(cu_seqlens)
+
+
+def vectorized_token_indices(cu_seqlens: torch.LongTensor) -> torch.LongTensor:
+    # prepare_token_indices from cold caches
+    for fn in (prepare_lens, prepare_position_ids, prepare_sequence_ids, prepare_token_indices):
+        fn.cache_clear()
+    return prepare_token_indices(cu_seqlens)
+
+
+def benchmark_token_indices(total_len=65536, doc_counts=(1, 16, 256, 4096), device="cpu", repeats=20):
+    import time
+    print(f"{'docs':>6} {'loop ms':>10} {'vectorized ms':>14} {'speedup':>8}")
+    for num_docs in doc_counts:
+        lens = torch.full((num_docs,), total_len // num_docs)
+        cu_seqlens = F.pad(lens.cumsum(0), (1, 0)).to(device=device, dtype=torch.int32)
+        assert torch.equal(loop_token_indices(cu_seqlens), vectorized_token_indices(cu_seqlens))
+        times = []
+        for fn in (loop_token_indices, vectorized_token_indices):
+            fn(cu_seqlens)
+            if device != "cpu":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                fn(cu_seqlens)
+            if device != "cpu":
+                torch.cuda.synchronize()
+            times.append((time.perf_counter() - start) / repeats * 1000)
+        print(f"{num_docs:>6} {times[0]:>10.3f} {times[1]:>14.3f} {times[0] / times[1]:>7.1f}x")
+
+
+if __name__ == "__main__":
+    test_tensor_cache()
+    benchmark_token_indices(device="cuda" if torch.cuda.is_available() else "cpu")
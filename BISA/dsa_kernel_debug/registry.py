@@ -0,0 +1,40 @@
+# KernelRegistry lives in dsa_kernel/registry.py, this file only holds its tests
+from dsa_kernel.registry import KernelRegistry
+
+
+def test_registry():
+    calls = []
+
+    def factory(heads, dim, block_I=32):
+        calls.append((heads, dim, block_I))
+        return object()
+
+    registry = KernelRegistry()
+    kernel = registry.kernel("fwd", factory, 64, 512, block_I=64)
+    assert registry.kernel("fwd", factory, 64, 512, block_I=64) is kernel
+    assert registry.kernel("fwd", factory, 64, 512, block_I=32) is not kernel
+    assert registry.kernel("bwd", factory, 64, 512, block_I=64) is not kernel
+    assert calls == [(64, 512, 64), (64, 512, 32), (64, 512, 64)]
+    stats = registry.stats()
+    assert stats["kernels"] == stats["compiles"] == stats["misses"] == 3 and stats["hits"] == 1
+    assert stats["compile_time"] >= 0
+
+    # a failed compilation is a miss that is not cached
+    def failing(*args, **params):
+        raise RuntimeError("compile error")
+
+    try:
+        registry.kernel("fwd", failing, 128, 512)
+    except RuntimeError:
+        pass
+    assert registry.misses == 4 and registry.compiles == 3 and len(registry.kernels) == 3
+
+    registry.reset_stats()
+    assert registry.stats()["hits"] == 0 and len(registry.kernels) == 3
+    registry.clear()
+    assert registry.stats()["kernels"] == 0
+    print("registry tests passed")
+
+
+if __name__ == "__main__":
+    test_registry()
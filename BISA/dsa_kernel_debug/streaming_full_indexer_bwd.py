@@ -0,0 +1,318 @@
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+from einops import einsum
+
+from util import get_abs_err, get_err_ratio
+
+
+@torch.no_grad()
+def chunked_full_indexer_bwd_interface(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    indexq: torch.Tensor,
+    weights: torch.Tensor,
+    indexk: torch.Tensor,
+    offsets: torch.Tensor,
+    chunk_size: int = 2048,
+    eps: float = 1e-9,
+):
+    device = q.device
+    softmax_scale = q.shape[-1] ** -0.5
+    S, H, _ = q.shape
+    d = indexq.shape[-1]
+
+    dindexq = torch.zeros_like(indexq)
+    dweights = torch.zeros_like(weights)
+    dindexk = torch.zeros_like(indexk)
+
+    total_loss = torch.zeros((), device=device, dtype=torch.float32)
+    B = offsets.numel() - 1
+
+    for bi in range(B):
+        start = int(offsets[bi].item())
+        end = int(offsets[bi + 1].item())
+        seq_len = end - start
+        if seq_len <= 0:
+            continue
+
+        q_batch = q[start:end]
+        k_batch = k[start:end]
+        indexq_batch = indexq[start:end]
+        weights_batch = weights[start:end]
+        indexk_batch = indexk[start:end]
+
+        for chunk_start in range(0, seq_len, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, seq_len)
+
+            q_chunk = q_batch[chunk_start:chunk_end]
+            k_full = k_batch[:chunk_end]
+            IQ = indexq_batch[chunk_start:chunk_end]
+            W = weights_batch[chunk_start:chunk_end]
+            IK = indexk_batch[:chunk_end]
+
+            s1 = chunk_end - chunk_start
+            s2 = chunk_end
+
+            qp = torch.arange(chunk_start, chunk_end, device=device)[:, None]
+            kp = torch.arange(chunk_end, device=device)[None, :]
+            causal_2d = (qp >= kp)
+
+            attn_logits = einsum(q_chunk, k_full, 'q h d, k d -> q h k') * softmax_scale
+            attn_logits = attn_logits.masked_fill(~causal_2d.unsqueeze(1), float('-inf'))
+            attn_prob_h = torch.softmax(attn_logits, dim=-1)
+
+            p = attn_prob_h.sum(dim=1)
+            p = p / (p.sum(dim=-1, keepdim=True) + eps)
+
+            logp_clip = (p.clamp_min(eps).log()).clamp(-100.0, 0.0)
+            p_used = logp_clip.exp().to(torch.float32)
+
+            T = einsum(IQ, IK, 'i h k, j k -> i h j') * softmax_scale
+            relu_mask = (T > 0)
+            R = torch.relu(T)
+        
+
+            Sij = (R * W.unsqueeze(-1)).sum(dim=1).to(torch.float32)
+            U = Sij.masked_fill(~causal_2d, float('-inf'))
+            logq = torch.log_softmax(U, dim=-1)
+            qhat = logq.exp()
+
+            in_range = (logq > -100.0).to(torch.float32)
+            logq_clip = torch.maximum(
+                logq,
+                torch.tensor(-100.0, device=device, dtype=logq.dtype),
+            )
+
+            loss = (p_used * (logp_clip.to(torch.float32) - logq_clip.to(torch.float32))).sum()
+            total_loss += loss
+
+            g = (-p_used * in_range).masked_fill(~causal_2d, 0.0)
+            g_sum = g.sum(dim=-1, keepdim=True)
+            dU = g - qhat.to(torch.float32) * g_sum
+            dSij = dU
+
+            dW = (dSij.unsqueeze(1) * R.to(torch.float32)).sum(dim=-1)
+            dR = dSij.unsqueeze(1) * W.to(torch.float32).unsqueeze(-1)
+            dT = dR * relu_mask.to(torch.float32)
+
+            dIQ = softmax_scale * einsum(dT, IK.to(torch.float32), 'i h j, j k -> i h k')
+            dIK = softmax_scale * einsum(dT, IQ.to(torch.float32), 'i h j, i h k -> j k')
+
+            dindexq[start + chunk_start:start + chunk_end] += dIQ.to(dindexq.dtype)
+            dweights[start + chunk_start:start + chunk_end] += dW.to(dweights.dtype)
+            dindexk[start:start + chunk_end] += dIK.to(dindexk.dtype)
+    
+    return dindexq, dweights, dindexk
+
+
+@torch.no_grad()
+def streaming_full_indexer_bwd_interface(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    indexq: torch.Tensor,
+    weights: torch.Tensor,
+    indexk: torch.Tensor,
+    offsets: torch.Tensor,
+    chunk_size: int = 512,
+    key_chunk_size: int = 512,
+    eps: float = 1e-9,
+):
+    """
+    Gradients of the warmup KL(p || q) between the head-summed attention distribution p and the indexer
+    distribution q, like `chunked_full_indexer_bwd_interface`, tiled over queries and keys. The temporaries are
+    [chunk_size, heads, key_chunk_size] whatever the sequence length, and run on any device, CPU included.
+
+    With dU = g - qhat * sum_j(g), g = -p (clipped like the reference) on the causal keys, three sweeps over the keys:
+    1. online log-sum-exp of the attention logits of every head and of the indexer logits;
+    2. p and g from the attention logits, the g part of the gradients and sum_j(g);
+    3. the qhat * sum_j(g) part of the gradients, from the indexer logits only.
+    The dense attention logits are thus computed twice, the (much cheaper) indexer logits three times.
+    """
+    device = q.device
+    softmax_scale = q.shape[-1] ** -0.5
+    H = q.shape[1]
+
+    dindexq = torch.zeros_like(indexq)
+    dweights = torch.zeros_like(weights)
+    dindexk = torch.zeros_like(indexk)
+
+    B = offsets.numel() - 1
+    for bi in range(B):
+        start = int(offsets[bi].item())
+        end = int(offsets[bi + 1].item())
+        seq_len = end - start
+        if seq_len <= 0:
+            continue
+
+        q_batch = q[start:end]
+        k_batch = k[start:end]
+        indexq_batch = indexq[start:end]
+        weights_batch = weights[start:end]
+        indexk_batch = indexk[start:end]
+        dIK = torch.zeros(seq_len, indexk.shape[-1], device=device, dtype=torch.float32)
+
+        for chunk_start in range(0, seq_len, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, seq_len)
+
+            q_chunk = q_batch[chunk_start:chunk_end]
+            IQ = indexq_batch[chunk_start:chunk_end]
+            W = weights_batch[chunk_start:chunk_end].to(torch.float32)
+            IQ_f = IQ.to(torch.float32)
+            qp = torch.arange(chunk_start, chunk_end, device=device)[:, None]
+            key_tiles = [(ks, min(ks + key_chunk_size, chunk_end)) for ks in range(0, chunk_end, key_chunk_size)]
+
+            def attention_logits(ks, ke, causal_2d):
+                logits = einsum(q_chunk, k_batch[ks:ke], 'q h d, k d -> q h k').to(torch.float32) * softmax_scale
+                return logits.masked_fill(~causal_2d.unsqueeze(1), float('-inf'))
+
+            def index_logits(ks, ke, causal_2d):
+                T = einsum(IQ, indexk_batch[ks:ke], 'i h k, j k -> i h j').to(torch.float32) * softmax_scale
+                R = torch.relu(T)
+                Sij = (R * W.unsqueeze(-1)).sum(dim=1)
+                return T, R, Sij.masked_fill(~causal_2d, float('-inf'))
+
+            def accumulate(dU, ks, ke, T, R):
+                # dW, dIQ and dIK of a [chunk, keys] gradient dU of the indexer logits
+                dW_chunk.add_((dU.unsqueeze(1) * R).sum(dim=-1))
+                dT = dU.unsqueeze(1) * W.unsqueeze(-1) * (T > 0)
+                dIQ_chunk.add_(softmax_scale * einsum(dT, indexk_batch[ks:ke].to(torch.float32), 'i h j, j k -> i h k'))
+                dIK[ks:ke] += softmax_scale * einsum(dT, IQ_f, 'i h j, i h k -> j k')
+
+            # 1. running max / sum of exp, key tile 0 makes every row finite
+            m_attn = torch.full(q_chunk.shape[:2], float('-inf'), device=device)
+            l_attn = torch.zeros(q_chunk.shape[:2], device=device)
+            m_index = torch.full(q_chunk.shape[:1], float('-inf'), device=device)
+            l_index = torch.zeros(q_chunk.shape[:1], device=device)
+            for ks, ke in key_tiles:
+                causal_2d = qp >= torch.arange(ks, ke, device=device)[None, :]
+                logits = attention_logits(ks, ke, causal_2d)
+                m_new = torch.maximum(m_attn, logits.amax(dim=-1))
+                l_attn = l_attn * torch.exp(m_attn - m_new) + torch.exp(logits - m_new.unsqueeze(-1)).sum(dim=-1)
+                m_attn = m_new
+                _, _, Sij = index_logits(ks, ke, causal_2d)
+                m_new = torch.maximum(m_index, Sij.amax(dim=-1))
+                l_index = l_index * torch.exp(m_index - m_new) + torch.exp(Sij - m_new.unsqueeze(-1)).sum(dim=-1)
+                m_index = m_new
+            lse_attn = m_attn + l_attn.log()
+            lse_index = m_index + l_index.log()
+
+            # 2. p, g and the g part of the gradients; sum_j p over the heads is H
+            dW_chunk = torch.zeros(W.shape, device=device)
+            dIQ_chunk = torch.zeros(IQ.shape, device=device)
+            g_sum = torch.zeros(q_chunk.shape[:1], device=device)
+            for ks, ke in key_tiles:
+                causal_2d = qp >= torch.arange(ks, ke, device=device)[None, :]
+                p = torch.exp(attention_logits(ks, ke, causal_2d) - lse_attn.unsqueeze(-1)).sum(dim=1) / (H + eps)
+                p_used = p.clamp_min(eps).log().clamp(-100.0, 0.0).exp()
+                T, R, Sij = index_logits(ks, ke, causal_2d)
+                in_range = (Sij - lse_index.unsqueeze(-1)) > -100.0
+                g = (-p_used * in_range).masked_fill(~causal_2d, 0.0)
+                g_sum += g.sum(dim=-1)
+                accumulate(g, ks, ke, T, R)
+
+            # 3. the -qhat * sum_j(g) part
+            for ks, ke in key_tiles:
+                causal_2d = qp >= torch.arange(ks, ke, device=device)[None, :]
+                T, R, Sij = index_logits(ks, ke, causal_2d)
+                qhat = torch.exp(Sij - lse_index.unsqueeze(-1))
+                accumulate(-qhat * g_sum.unsqueeze(-1), ks, ke, T, R)
+
+            dindexq[start + chunk_start:start + chunk_end] = dIQ_chunk.to(dindexq.dtype)
+            dweights[start + chunk_start:start + chunk_end] = dW_chunk.to(dweights.dtype)
+
+        dindexk[start:end] = dIK.to(dindexk.dtype)
+
+    return dindexq, dweights, dindexk
+
+
+def peak_memory_mb(fn, device) -> float:
+    """Peak memory of fn(): allocated CUDA memory, or the peak RSS growth of this (fresh) process on CPU."""
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    # ru_maxrss is in KB on Linux and only grows, measure in a process that ran nothing else
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn()
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 2 ** 10
+
+
+def make_inputs(S, H, D, d, device, dtype, seed=999):
+    torch.manual_seed(seed)
+    q = torch.randn((S, H, D), device=device, dtype=dtype)
+    kv = torch.randn((S, D), device=device, dtype=dtype)
+    indexq = torch.randn((S, H, d), device=device, dtype=dtype)
+    indexk = torch.randn((S, d), device=device, dtype=dtype)
+    weights = torch.randn((S, H), device=device, dtype=dtype)
+    offsets = torch.tensor([0, S // 3, S], dtype=torch.int32, device=device)
+    return q, kv, indexq, weights, indexk, offsets
+
+
+def run(name, S, H, D, d, device, dtype, chunk_size, key_chunk_size, queue=None):
+    inputs = make_inputs(S, H, D, d, device, dtype)
+    if name == "chunked":
+        # the current version at its default chunk_size
+        fn = lambda: chunked_full_indexer_bwd_interface(*inputs)
+    else:
+        fn = lambda: streaming_full_indexer_bwd_interface(*inputs, chunk_size=chunk_size, key_chunk_size=key_chunk_size)
+    start = time.perf_counter()
+    peak = peak_memory_mb(fn, device)
+    result = (peak, time.perf_counter() - start)
+    if queue is not None:
+        queue.put(result)
+    return result
+
+
+def measure(name, *args):
+    if args[4] == "cuda":
+        return run(name, *args)
+    # one spawned process per measurement, so that ru_maxrss starts from the inputs only
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run, args=(name, *args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        # killed by the OOM killer, most likely
+        return float("nan"), float("nan")
+    return queue.get()
+
+
+def test_kernel(S=1024, H=8, D=64, d=32, device="cpu"):
+    q, kv, indexq, weights, indexk, offsets = make_inputs(S, H, D, d, device, torch.float32)
+    ref_dq, ref_dw, ref_dk = chunked_full_indexer_bwd_interface(q, kv, indexq, weights, indexk, offsets, chunk_size=256)
+    dq, dw, dk = streaming_full_indexer_bwd_interface(q, kv, indexq, weights, indexk, offsets, chunk_size=200, key_chunk_size=96)
+    print(f"dq err: {get_abs_err(dq, ref_dq):.6f} ratio: {get_err_ratio(dq, ref_dq):.6f}")
+    print(f"dw err: {get_abs_err(dw, ref_dw):.6f} ratio: {get_err_ratio(dw, ref_dw):.6f}")
+    print(f"dk err: {get_abs_err(dk, ref_dk):.6f} ratio: {get_err_ratio(dk, ref_dk):.6f}")
+
+
+def benchmark(seq_lens, H, D, d, device, chunk_size, key_chunk_size):
+    dtype = torch.bfloat16 if device == "cuda" else torch.float32
+    print(f"{'seq_len':>8} {'chunked MB':>11} {'streaming MB':>13} {'chunked s':>10} {'streaming s':>12}")
+    for S in seq_lens:
+        args = (S, H, D, d, device, dtype, chunk_size, key_chunk_size)
+        chunked_mb, chunked_s = measure("chunked", *args)
+        streaming_mb, streaming_s = measure("streaming", *args)
+        print(f"{S:>8} {chunked_mb:>11.1f} {streaming_mb:>13.1f} {chunked_s:>10.2f} {streaming_s:>12.2f}", flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seq_lens", type=int, nargs="+", default=[2048, 4096, 8192])
+    parser.add_argument("--heads", type=int, default=16)
+    parser.add_argument("--head_dim", type=int, default=576)
+    parser.add_argument("--index_dim", type=int, default=128)
+    parser.add_argument("--chunk_size", type=int, default=512)
+    parser.add_argument("--key_chunk_size", type=int, default=512)
+    args = parser.parse_args()
+    test_kernel(device=args.device)
+    benchmark(args.seq_lens, args.heads, args.head_dim, args.index_dim, args.device, args.chunk_size, args.key_chunk_size)
@@ -0,0 +1,77 @@
+# the telemetry lives in dsa_kernel/telemetry.py, this file only holds its tests
+import torch
+
+from dsa_kernel.telemetry import IndexerTelemetry, distance_bins, indexer_telemetry, topk_recall
+
+
+def ref_indexer_telemetry(q, kv, topk_indices, offsets, sm_scale, topk, local_window, num_distance_bins):
+    # token by token with python sets
+    edges = distance_bins(num_distance_bins)
+    heads = q.shape[1]
+    hits, total, mass = [0] * heads, 0, [0.0] * heads
+    selected = local = 0
+    hist = [0] * num_distance_bins
+    for bos, eos in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        for t in range(bos, eos):
+            pos = t - bos
+            chosen = {i for i in topk_indices[t].tolist() if 0 <= i <= pos}
+            probs = ((q[t].float() @ kv[bos:t + 1].float().T) * sm_scale).softmax(dim=-1)
+            total += min(topk, pos + 1)
+            for h in range(heads):
+                dense = set(probs[h].topk(min(topk, pos + 1)).indices.tolist())
+                hits[h] += len(dense & chosen)
+                mass[h] += probs[h, sorted(chosen)].sum().item()
+            for i in chosen:
+                d = pos - i
+                selected += 1
+                local += d < local_window
+                hist[max(b for b, edge in enumerate(edges) if d >= edge)] += 1
+    return hits, total, mass, selected, local, hist
+
+
+def test_telemetry(S=300, H=4, D=32, topk=48, local_window=16, num_distance_bins=8):
+    torch.manual_seed(0)
+    q = torch.randn(S, H, D)
+    kv = torch.randn(S, D)
+    offsets = torch.tensor([0, 20, 130, S])
+    # distinct selections with -1 padding and some non-causal indices, like the indexer's padded rows
+    topk_indices = torch.rand(S, S // 2).argsort(dim=-1)[:, :topk]
+    topk_indices[torch.rand(S, topk) < 0.2] = -1
+
+    stats = indexer_telemetry(q, kv, topk_indices, offsets, D ** -0.5, topk, local_window, num_distance_bins,
+                              chunk_size=32)
+    hits, total, mass, selected, local, hist = ref_indexer_telemetry(
+        q, kv, topk_indices, offsets, D ** -0.5, topk, local_window, num_distance_bins)
+    assert stats["recall_hits"].tolist() == hits and int(stats["recall_total"]) == total
+    assert torch.allclose(stats["mass"].double(), torch.tensor(mass, dtype=torch.float64), rtol=1e-4)
+    assert int(stats["selected"]) == selected and int(stats["local"]) == local
+    assert stats["distance_hist"].tolist() == hist and int(stats["tokens"]) == S
+
+    # the dense top-k of the first head selected: full recall for that head
+    dense = torch.full((S, topk), -1)
+    for t in range(S):
+        probs = ((q[t, 0] @ kv[:t + 1].T) * D ** -0.5).softmax(dim=-1)
+        dense[t, :min(topk, t + 1)] = probs.topk(min(topk, t + 1)).indices
+    stats = indexer_telemetry(q[:, :1], kv, dense, torch.tensor([0, S]), D ** -0.5, topk)
+    assert stats["recall_hits"].item() == stats["recall_total"].item()
+
+    # row-wise recall against the set intersections of compare_indexers
+    ref = torch.randint(0, 64, (S, topk))
+    mask = torch.rand(S, topk) > 0.3
+    found, count = topk_recall(topk_indices, ref, mask)
+    for j in range(S):
+        chosen = set(topk_indices[j].tolist())
+        assert count[j].item() == mask[j].sum().item()
+        assert found[j].item() == sum(i in chosen for i in ref[j][mask[j]].tolist())
+
+    telemetry = IndexerTelemetry(topk=topk, local_window=local_window, num_distance_bins=num_distance_bins, every=2)
+    for _ in range(3):
+        telemetry.record(0, q, kv, topk_indices, offsets, D ** -0.5)
+    assert telemetry.stats()[0]["tokens"] == 2 * S
+    summary = telemetry.summary()
+    assert 0 <= summary["recall"] <= 1 and 0 <= summary["mass"] <= 1 and 0 <= summary["local"] <= 1
+    print("telemetry tests passed")
+
+
+if __name__ == "__main__":
+    test_telemetry()
@@ -1,4 +1,4 @@
-from typing import Literal
+from typing import Literal, Optional
 import warnings
 from transformers.models.deepseek_v3.configuration_deepseek_v3 import DeepseekV3Config as HFDeepseekV3Config
 
@@ -13,6 +13,9 @@ class DeepseekV3Config(HFDeepseekV3Config):
         indexer_norm: Literal["rmsnorm", "layernorm"] = "rmsnorm",
         index_weights: Literal["value", "one"] = "value",
         index_absorb: bool = True,
+        index_reuse_layers: Optional[list[int]] = None,
+        index_num_sinks: int = 0,
+        index_window: int = 0,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -23,5 +26,11 @@ class DeepseekV3Config(HFDeepseekV3Config):
         self.indexer_norm = indexer_norm
         self.index_weights = index_weights
         self.index_absorb = index_absorb
+        # layer l attends over the top-k indices of layer index_reuse_layers[l], None runs every layer's indexer
+        self.index_reuse_layers = index_reuse_layers
+        # every query always selects the first index_num_sinks tokens and its index_window most recent tokens, the
+        # indexer only scores the tokens between them for the other index_topk - index_num_sinks - index_window slots
+        self.index_num_sinks = index_num_sinks
+        self.index_window = index_window
 
 
@@ -1,3 +1,4 @@
+import time
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -16,7 +17,16 @@ from transformers.models.deepseek_v3.modeling_deepseek_v3 import (
     DeepseekV3ForCausalLM as HFDeepseekV3ForCausalLM
 )
 from .configuration_deepseek_v3 import DeepseekV3Config
-from dsa_kernel import prepare_cu_seqlens_from_position_ids, deepseek_sparse_attention
+from dsa_kernel import (
+    prepare_cu_seqlens_from_position_ids,
+    deepseek_sparse_attention,
+    deepseek_sparse_attention_with_indices,
+    deepseek_sparse_attention_prefill_chunk,
+    prewarm_dsa_kernels,
+    topk_overlap,
+    IndexerTelemetry,
+)
+from dsa_kernel.indexer_topk_reducesum import indexer_topk_reducesum_interface
 from liger_kernel.transformers.fused_linear_cross_entropy import LigerFusedLinearCrossEntropyLoss
 
 def dense_mha(
@@ -50,11 +60,44 @@ def dense_mha(
     attn_output = attn_output[:, :, :, : module.v_head_dim]
     return attn_output, attn_weights
 
+class DSAPrefillCache:
+    """
+    Latent KV and indexer keys of every layer for the chunked prefill of one sequence, preallocated for max_length
+    tokens. Each layer writes its chunk at [length, length + chunk) and reads back the whole prefix, then `advance`
+    moves past the chunk once all layers have run.
+    """
+
+    def __init__(self, num_layers: int, max_length: int, kv_dim: int, index_dim: int, dtype: torch.dtype, device):
+        self.max_length = max_length
+        self.kv = [torch.empty(max_length, kv_dim, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.index_k = [torch.empty(max_length, index_dim, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.length = 0
+
+    def update(self, layer_idx: int, kv: torch.Tensor, index_k: Optional[torch.Tensor] = None):
+        end = self.length + kv.shape[0]
+        assert end <= self.max_length, f"prefill cache holds {self.max_length} tokens"
+        self.kv[layer_idx][self.length:end] = kv
+        if index_k is not None:
+            self.index_k[layer_idx][self.length:end] = index_k
+        return self.kv[layer_idx][:end], self.index_k[layer_idx][:end]
+
+    def advance(self, num_tokens: int) -> None:
+        self.length += num_tokens
+
 class TransDSAIndexer(nn.Module):
-    def __init__(self, config: DeepseekV3Config):
+    def __init__(self, config: DeepseekV3Config, layer_idx: int = 0):
         super().__init__()
         self.config = config
+        self.layer_idx = layer_idx
         self.scaling = config.index_head_dim ** (-0.5) 
+        # set by DeepseekV3Model.set_index_reuse: the layer whose top-k indices this layer attends over, the top-k
+        # indices of the reused source layers in the current forward (None unless this layer reads or writes them),
+        # and the overlap stats of reused indices if measured
+        self.index_source = layer_idx
+        self.shared_topk_indices = None
+        self.reuse_stats = None
+        # set by DeepseekV3Model.set_indexer_telemetry
+        self.telemetry = None
         if self.config.index_absorb:
             self.wq_b = nn.Linear(config.q_lora_rank, config.index_n_heads * config.index_head_dim, bias=False)
             self.wk = nn.Linear(config.hidden_size, config.index_head_dim, bias=False)
@@ -69,25 +112,18 @@ class TransDSAIndexer(nn.Module):
             self.Rk = nn.Linear(config.kv_lora_rank, config.index_head_dim-config.qk_rope_head_dim, bias=False)
             self.Rv = nn.Linear(config.kv_lora_rank, config.index_n_heads, bias=False)
 
-    def forward(
+    def index_inputs(
         self,
-        kv_b_proj: nn.Module,
         q_latent: torch.Tensor,
         hidden_states: torch.Tensor,
         position_embeddings: tuple[torch.Tensor, torch.Tensor],
-
         q_pass: torch.Tensor,
         q_rot: torch.Tensor,
         k_pass: torch.Tensor,
         k_rot: torch.Tensor,
-        position_ids: torch.Tensor,
     ):
+        # index_q, index_k and weights of the indexer, flattened over the batch like q and kv
         batch_size, seq_length = hidden_states.shape[:-1]
-        kv_b_weight = rearrange(kv_b_proj.weight, '(h d) r -> h d r', h=self.config.num_attention_heads)
-        k_b_weight, v_b_weight = torch.split(kv_b_weight, [self.config.qk_nope_head_dim, self.config.v_head_dim], dim=1)
-        q_pass = torch.einsum("bhsd,hdr->bhsr", q_pass, k_b_weight)
-        q = torch.cat([q_pass, q_rot], dim=-1).transpose(1, 2).contiguous()
-        kv = torch.cat([k_pass, k_rot.squeeze(1)], dim=-1)
         if self.config.index_absorb:
             key_nope_shape = (batch_size, seq_length, -1, self.config.index_head_dim-self.config.qk_rope_head_dim)
             q_latent = self.wq_b(q_latent) #(bsz, seq, dim)
@@ -116,15 +152,80 @@ class TransDSAIndexer(nn.Module):
 
         if self.config.index_weights=="value":
             weights = weights.abs()
+        index_q = rearrange(index_q, 'b s h d -> (b s) h d', b=batch_size).contiguous()
+        index_k = rearrange(index_k, 'b s d -> (b s) d', b=batch_size).contiguous()
+        weights = rearrange(weights, 'b s h -> (b s) h', b=batch_size).contiguous()
+        return index_q, index_k, weights
+
+    def prefill_chunk(self, q: torch.Tensor, kv: torch.Tensor, index_args: tuple, prefill_cache: DSAPrefillCache):
+        # one chunk of a chunked prefill: cache the chunk's latent KV and indexer keys, attend over the whole prefix
+        if self.index_source != self.layer_idx:
+            kv, _ = prefill_cache.update(self.layer_idx, kv)
+            attn_output, _ = deepseek_sparse_attention_prefill_chunk(
+                q, kv, None, None, None, self.config.index_topk, self.config.kv_lora_rank, self.scaling,
+                topk_indices=self.shared_topk_indices[self.index_source])
+            return attn_output
+        index_q, index_k, weights = self.index_inputs(*index_args)
+        kv, index_k = prefill_cache.update(self.layer_idx, kv, index_k)
+        attn_output, topk_indices = deepseek_sparse_attention_prefill_chunk(
+            q, kv, index_q, index_k, weights, self.config.index_topk, self.config.kv_lora_rank, self.scaling,
+            num_sinks=self.config.index_num_sinks, window=self.config.index_window)
+        if self.shared_topk_indices is not None:
+            self.shared_topk_indices[self.layer_idx] = topk_indices
+        return attn_output
+
+    def forward(
+        self,
+        kv_b_proj: nn.Module,
+        q_latent: torch.Tensor,
+        hidden_states: torch.Tensor,
+        position_embeddings: tuple[torch.Tensor, torch.Tensor],
+
+        q_pass: torch.Tensor,
+        q_rot: torch.Tensor,
+        k_pass: torch.Tensor,
+        k_rot: torch.Tensor,
+        position_ids: torch.Tensor,
+        prefill_cache: Optional[DSAPrefillCache] = None,
+    ):
+        batch_size, seq_length = hidden_states.shape[:-1]
+        kv_b_weight = rearrange(kv_b_proj.weight, '(h d) r -> h d r', h=self.config.num_attention_heads)
+        k_b_weight, v_b_weight = torch.split(kv_b_weight, [self.config.qk_nope_head_dim, self.config.v_head_dim], dim=1)
+        q_pass = torch.einsum("bhsd,hdr->bhsr", q_pass, k_b_weight)
+        q = torch.cat([q_pass, q_rot], dim=-1).transpose(1, 2).contiguous()
+        kv = torch.cat([k_pass, k_rot.squeeze(1)], dim=-1)
+        if prefill_cache is not None:
+            assert batch_size == 1, "chunked prefill takes one sequence"
+            index_args = (q_latent, hidden_states, position_embeddings, q_pass, q_rot, k_pass, k_rot)
+            attn_output = self.prefill_chunk(q[0], kv[0], index_args, prefill_cache)
+            attn_output = torch.einsum("shr,hdr->shd", attn_output, v_b_weight)
+            return attn_output.unsqueeze(0), None
         position_ids = position_ids.view(-1)
         offsets = prepare_cu_seqlens_from_position_ids(position_ids)
         
         q = rearrange(q, 'b s h d -> (b s) h d', b=batch_size).contiguous()
         kv = rearrange(kv, 'b s d -> (b s) d', b=batch_size).contiguous()
-        index_q = rearrange(index_q, 'b s h d -> (b s) h d', b=batch_size).contiguous()
-        index_k = rearrange(index_k, 'b s d -> (b s) d', b=batch_size).contiguous()
-        weights = rearrange(weights, 'b s h -> (b s) h', b=batch_size).contiguous()
-        attn_output, _ = deepseek_sparse_attention(q, kv, index_q, index_k, weights, offsets, self.config.index_topk, self.config.kv_lora_rank, self.scaling)
+        index_args = (q_latent, hidden_states, position_embeddings, q_pass, q_rot, k_pass, k_rot)
+        if self.index_source != self.layer_idx:
+            # attend over the top-k of the source layer, this layer's indexer only runs to measure the overlap
+            topk_indices = self.shared_topk_indices[self.index_source]
+            if self.reuse_stats is not None:
+                index_q, index_k, weights = self.index_inputs(*index_args)
+                fresh_indices, _ = indexer_topk_reducesum_interface(
+                    index_q, weights, index_k, self.config.index_topk, offsets,
+                    num_sinks=self.config.index_num_sinks, window=self.config.index_window)
+                hits, total = topk_overlap(topk_indices, fresh_indices)
+                self.reuse_stats["hits"] += hits
+                self.reuse_stats["total"] += total
+            attn_output = deepseek_sparse_attention_with_indices(q, kv, topk_indices, offsets, self.config.kv_lora_rank, self.scaling)
+        else:
+            index_q, index_k, weights = self.index_inputs(*index_args)
+            attn_output, topk_indices = deepseek_sparse_attention(q, kv, index_q, index_k, weights, offsets, self.config.index_topk, self.config.kv_lora_rank, self.scaling,
+                                                                  num_sinks=self.config.index_num_sinks, window=self.config.index_window)
+            if self.shared_topk_indices is not None:
+                self.shared_topk_indices[self.layer_idx] = topk_indices
+        if self.telemetry is not None:
+            self.telemetry.record(self.layer_idx, q, kv, topk_indices, offsets, self.scaling)
         attn_output = torch.einsum("shr,hdr->shd", attn_output, v_b_weight)
         attn_output = rearrange(attn_output, '(b s) h d -> b s h d', b=batch_size).contiguous()
         return attn_output, None
@@ -136,7 +237,7 @@ class DeepseekV3Attention(HFDeepseekV3Attention):
         if not config.qk_latent_norm:
             delattr(self, "q_a_layernorm")
             delattr(self, "kv_a_layernorm")
-        self.indexer = TransDSAIndexer(config)
+        self.indexer = TransDSAIndexer(config, layer_idx)
 
     def forward(
         self,
@@ -163,7 +264,7 @@ class DeepseekV3Attention(HFDeepseekV3Attention):
         k_rot = k_rot.view(batch_size, 1, seq_length, self.qk_rope_head_dim)
         cos, sin = position_embeddings
         q_rot, k_rot = apply_rotary_pos_emb_interleave(q_rot, k_rot, cos, sin)
-        attn_output, attn_weights = self.indexer(self.kv_b_proj, q_latent, hidden_states, position_embeddings, q_pass, q_rot, k_pass, k_rot, kwargs["position_ids"])
+        attn_output, attn_weights = self.indexer(self.kv_b_proj, q_latent, hidden_states, position_embeddings, q_pass, q_rot, k_pass, k_rot, kwargs["position_ids"], kwargs.get("prefill_cache"))
 
         attn_output = attn_output.reshape(batch_size, seq_length, -1).contiguous()
         attn_output = self.o_proj(attn_output)
@@ -184,6 +285,115 @@ class DeepseekV3Model(DeepseekV3PreTrainedModel, HFDeepseekV3Model):
     def __init__(self, config: DeepseekV3Config):
         super().__init__(config)
         self.layers = nn.ModuleList([DeepseekV3DecoderLayer(config, layer_idx) for layer_idx in range(config.num_hidden_layers)])
+        self.set_index_reuse(getattr(config, "index_reuse_layers", None))
+
+    def set_index_reuse(self, index_reuse_layers: Optional[list[int]] = None, measure: bool = False) -> None:
+        """
+        Layer l attends over the top-k indices computed by layer index_reuse_layers[l] (itself by default) earlier
+        in the same forward, skipping its own indexer, e.g. [0, 0, 2, 2] shares the indices within pairs of layers.
+        With `measure`, reusing layers still run their indexer top-k and self.index_reuse_stats counts, per layer,
+        how many of the fresh indices the reused ones contain.
+        """
+        sources = list(range(len(self.layers))) if index_reuse_layers is None else list(index_reuse_layers)
+        assert len(sources) == len(self.layers)
+        for layer_idx, source in enumerate(sources):
+            assert source <= layer_idx and sources[source] == source, f"layer {layer_idx} cannot reuse layer {source}"
+        self.config.index_reuse_layers = index_reuse_layers
+        # only the layers reused by another one keep their indices, cleared at the start of every forward
+        reused = {source for layer_idx, source in enumerate(sources) if source != layer_idx}
+        self.shared_topk_indices = {} if reused else None
+        self.index_reuse_stats = {}
+        for layer_idx, (layer, source) in enumerate(zip(self.layers, sources)):
+            indexer = layer.self_attn.indexer
+            indexer.index_source = source
+            indexer.shared_topk_indices = self.shared_topk_indices if source != layer_idx or layer_idx in reused else None
+            indexer.reuse_stats = None
+            if measure and source != layer_idx:
+                indexer.reuse_stats = self.index_reuse_stats.setdefault(layer_idx, {"hits": 0, "total": 0})
+
+    def forward(self, *args, **kwargs):
+        # not at the end: a checkpointed layer recomputed in backward reads the indices of this forward
+        if self.shared_topk_indices is not None:
+            self.shared_topk_indices.clear()
+        return super().forward(*args, **kwargs)
+
+    def set_indexer_telemetry(self, telemetry: Optional[IndexerTelemetry] = None) -> Optional[IndexerTelemetry]:
+        """
+        Record the recall, attention mass and distances of every layer's top-k indices into `telemetry` during the
+        forwards (not the chunked prefill), None to stop. Dense attention scores are computed for the measured calls,
+        use IndexerTelemetry(every=N) to measure one forward in N, e.g. during training.
+        """
+        for layer in self.layers:
+            layer.self_attn.indexer.telemetry = telemetry
+        return telemetry
+
+    @torch.no_grad()
+    def chunked_prefill(
+        self,
+        input_ids: torch.LongTensor,
+        chunk_size: int = 1024,
+        prefill_cache: Optional[DSAPrefillCache] = None,
+    ):
+        """
+        Prefill of one long prompt input_ids [1, S] in chunks of chunk_size tokens. Every chunk goes through all
+        layers, attends over the latent KV and indexer keys cached for the tokens before it and appends its own, so
+        the indexer logits and the gathered keys are at most chunk_size x S instead of S x S. A given prefill_cache
+        is continued from its length. Returns the final hidden states [1, S, hidden_size], the cache, and per chunk
+        its token range, time in seconds and peak CUDA memory in bytes.
+        """
+        assert input_ids.shape[0] == 1, "chunked prefill takes one sequence"
+        seq_len = input_ids.shape[1]
+        device = input_ids.device
+        on_cuda = device.type == "cuda"
+        if prefill_cache is None:
+            prefill_cache = DSAPrefillCache(
+                len(self.layers), seq_len, self.config.kv_lora_rank + self.config.qk_rope_head_dim,
+                self.config.index_head_dim, self.dtype, device)
+        outputs, chunk_stats = [], []
+        for start in range(0, seq_len, chunk_size):
+            end = min(start + chunk_size, seq_len)
+            if on_cuda:
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+            tic = time.perf_counter()
+            if self.shared_topk_indices is not None:
+                self.shared_topk_indices.clear()
+            position_ids = torch.arange(prefill_cache.length, prefill_cache.length + end - start, device=device)
+            position_ids = position_ids.unsqueeze(0)
+            hidden_states = self.embed_tokens(input_ids[:, start:end])
+            position_embeddings = self.rotary_emb(hidden_states, position_ids)
+            for decoder_layer in self.layers[: self.config.num_hidden_layers]:
+                hidden_states = decoder_layer(
+                    hidden_states,
+                    position_embeddings=position_embeddings,
+                    position_ids=position_ids,
+                    prefill_cache=prefill_cache,
+                )
+            outputs.append(self.norm(hidden_states))
+            prefill_cache.advance(end - start)
+            if on_cuda:
+                torch.cuda.synchronize(device)
+            chunk_stats.append({
+                "start": start,
+                "end": end,
+                "seconds": time.perf_counter() - tic,
+                "peak_memory": torch.cuda.max_memory_allocated(device) if on_cuda else 0,
+            })
+        return torch.cat(outputs, dim=1), prefill_cache, chunk_stats
+
+    def prewarm_kernels(self, backward: bool = True) -> dict:
+        # compile the DSA kernels of the config's shapes once for all layers, returns the kernel registry stats
+        return prewarm_dsa_kernels(
+            heads=self.config.num_attention_heads,
+            dim_v=self.config.kv_lora_rank,
+            tail_dim=self.config.qk_rope_head_dim,
+            topk=self.config.index_topk,
+            index_heads=self.config.index_n_heads,
+            index_dim=self.config.index_head_dim,
+            sm_scale=self.config.index_head_dim ** (-0.5),
+            dtype=self.dtype,
+            backward=backward,
+        )
 
 def fixed_cross_entropy(shift_hidden_states, shift_labels, lm_head_weights, num_items_in_batch=None, ignore_index=-100, **kwargs):
     reduction = "sum" if num_items_in_batch is not None else "mean"
@@ -260,6 +470,7 @@ class DeepseekV3ForCausalLM(DeepseekV3PreTrainedModel, HFDeepseekV3ForCausalLM):
         )
 
 __all__ = [
+    "DSAPrefillCache",
     "DeepseekV3ForCausalLM",
     "DeepseekV3Model",
 ]
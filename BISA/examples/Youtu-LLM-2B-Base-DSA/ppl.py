@@ -1,13 +1,14 @@
 """
 Perplexity (PPL) evaluation script for the local model.
 Usage:
-    python ppl.py [--dataset DATASET] [--split SPLIT] [--max_length MAX_LENGTH] [--stride STRIDE] [--batch_size BATCH_SIZE]
+    python ppl.py [--dataset DATASET] [--split SPLIT] [--max_length MAX_LENGTH] [--stride STRIDE] [--batch_size BATCH_SIZE] [--index_reuse_group N] [--prefill_chunk_size N] [--telemetry_log PATH]
 """
 
 import argparse
 import os
 import torch
 import numpy as np
+import torch.nn.functional as F
 from tqdm import tqdm
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
@@ -30,6 +31,17 @@ def parse_args():
                         help="Batch size (default: 1)")
     parser.add_argument("--device", type=str, default="cuda",
                         help="Device to use (default: cuda)")
+    parser.add_argument("--index_reuse_group", type=int, default=1,
+                        help="Share the indexer top-k within groups of N consecutive layers, and compare the PPL "
+                             "and top-k overlap with every layer running its indexer (default: 1, no sharing)")
+    parser.add_argument("--prefill_chunk_size", type=int, default=0,
+                        help="Also prefill the first max_length tokens in chunks of N tokens, report the time and "
+                             "peak memory per chunk and the NLL against a single forward (default: 0, off)")
+    parser.add_argument("--telemetry_log", type=str, default=None,
+                        help="Append the per layer and head indexer recall, attention mass covered and selected "
+                             "distances of the evaluation to this JSON lines file")
+    parser.add_argument("--telemetry_local_window", type=int, default=128,
+                        help="Distance below which a selected token counts as local in the telemetry (default: 128)")
     return parser.parse_args()
 
 
@@ -110,6 +122,25 @@ def evaluate_ppl(model, tokenizer, text, max_length, stride, device, batch_size=
     return ppl.item(), avg_nll.item(), total_tokens
 
 
+def evaluate_chunked_prefill(model, tokenizer, text, max_length, chunk_size, device):
+    """
+    Prefill the first max_length tokens with model.model.chunked_prefill, print the time and peak memory of every
+    chunk, and return the NLL of the window from the chunked prefill and from a single forward.
+    """
+    input_ids = tokenizer(text, return_tensors="pt").input_ids[:, :max_length].to(device)
+    with torch.no_grad():
+        hidden_states, _, chunk_stats = model.model.chunked_prefill(input_ids, chunk_size=chunk_size)
+        logits = model.lm_head(hidden_states[:, :-1]).float()
+        chunked_nll = F.cross_entropy(logits.flatten(0, 1), input_ids[:, 1:].flatten()).item()
+        position_ids = torch.arange(input_ids.size(1), device=device).unsqueeze(0)
+        full_nll = model(input_ids=input_ids, labels=input_ids, position_ids=position_ids).loss.item()
+
+    print(f"{'chunk':>15}  {'ms':>9}  {'peak MB':>9}")
+    for stats in chunk_stats:
+        print(f"{stats['start']:>7}-{stats['end']:<7}  {stats['seconds'] * 1e3:9.1f}  {stats['peak_memory'] / 2**20:9.1f}")
+    return chunked_nll, full_nll
+
+
 def main():
     args = parse_args()
 
@@ -135,6 +166,9 @@ def main():
         attn_implementation="flash_attention_2",
     )
     model.eval()
+    if hasattr(model.model, "prewarm_kernels"):
+        stats = model.model.prewarm_kernels(backward=False)
+        print(f"Prewarmed {stats['compiles']} kernels in {stats['compile_time']:.1f}s")
 
     # Load dataset
     print("Loading dataset...")
@@ -142,13 +176,42 @@ def main():
 
     # Evaluate
     print("Starting PPL evaluation...")
-    ppl, avg_nll, total_tokens = evaluate_ppl(
-        model, tokenizer, text,
+    eval_kwargs = dict(
         max_length=args.max_length,
         stride=args.stride,
         device=args.device,
         batch_size=args.batch_size,
     )
+    telemetry = None
+    if args.telemetry_log is not None:
+        from dsa_kernel import IndexerTelemetry
+        telemetry = model.model.set_indexer_telemetry(
+            IndexerTelemetry(topk=model.config.index_topk, local_window=args.telemetry_local_window))
+    ppl, avg_nll, total_tokens = evaluate_ppl(model, tokenizer, text, **eval_kwargs)
+    if telemetry is not None:
+        model.model.set_indexer_telemetry(None)
+        telemetry_summary = telemetry.log(
+            args.telemetry_log,
+            model_path=args.model_path,
+            dataset=f"{args.dataset}/{args.dataset_config}/{args.split}",
+            max_length=args.max_length,
+            stride=args.stride,
+            ppl=ppl,
+        )["summary"]
+
+    reuse_ppl = None
+    if args.index_reuse_group > 1:
+        num_layers = len(model.model.layers)
+        index_reuse_layers = [l - l % args.index_reuse_group for l in range(num_layers)]
+        print(f"Starting PPL evaluation with index reuse {index_reuse_layers}...")
+        model.model.set_index_reuse(index_reuse_layers, measure=True)
+        reuse_ppl, reuse_avg_nll, _ = evaluate_ppl(model, tokenizer, text, **eval_kwargs)
+
+    prefill_nll = None
+    if args.prefill_chunk_size > 0:
+        print(f"Starting chunked prefill of {args.max_length} tokens in chunks of {args.prefill_chunk_size}...")
+        prefill_nll = evaluate_chunked_prefill(
+            model, tokenizer, text, args.max_length, args.prefill_chunk_size, args.device)
 
     print("=" * 60)
     print(f"Dataset:       {args.dataset}/{args.dataset_config} ({args.split})")
@@ -157,6 +220,28 @@ def main():
     print(f"Total Tokens:  {total_tokens}")
     print(f"Avg NLL:       {avg_nll:.4f}")
     print(f"Perplexity:    {ppl:.4f}")
+    if telemetry is not None:
+        print(f"Indexer:       recall {telemetry_summary['recall']:.4f}, mass {telemetry_summary['mass']:.4f}, "
+              f"local {telemetry_summary['local']:.4f} (logged to {args.telemetry_log})")
+    if reuse_ppl is not None:
+        reuse_stats = model.model.index_reuse_stats
+        hits = sum(s["hits"] for s in reuse_stats.values())
+        total = sum(s["total"] for s in reuse_stats.values())
+        print(f"Index Reuse:   groups of {args.index_reuse_group} layers")
+        print(f"Reuse Avg NLL: {reuse_avg_nll:.4f}")
+        print(f"Reuse PPL:     {reuse_ppl:.4f} ({reuse_ppl - ppl:+.4f})")
+        print(f"Top-k Overlap: {hits / max(total, 1):.4f}")
+        for layer_idx, s in sorted(reuse_stats.items()):
+            print(f"  layer {layer_idx:3d} <- {index_reuse_layers[layer_idx]:3d}: {s['hits'] / max(s['total'], 1):.4f}")
+    if prefill_nll is not None:
+        print(f"Prefill NLL:   {prefill_nll[0]:.4f} chunked, {prefill_nll[1]:.4f} single forward "
+              f"(first {args.max_length} tokens)")
+    if hasattr(model.model, "prewarm_kernels"):
+        from dsa_kernel import kernel_registry, routing_stats
+        stats = kernel_registry.stats()
+        print(f"Kernels:       {stats['compiles']} compiled ({stats['compile_time']:.1f}s), "
+              f"{stats['hits']} hits, {stats['misses']} misses")
+        print(f"Routing:       {routing_stats['dense_tokens']} dense / {routing_stats['sparse_tokens']} sparse tokens")
     print("=" * 60)
 
 
@@ -155,6 +155,7 @@ class DeepseekV2Config(PretrainedConfig):
         attention_bias=False,
         attention_dropout=0.0,
         use_shortcut_Q = False,
+        folded_shortcuts = None,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -198,6 +199,8 @@ class DeepseekV2Config(PretrainedConfig):
         self.attention_bias = attention_bias
         self.attention_dropout = attention_dropout
         self.use_shortcut_Q = use_shortcut_Q
+        # per layer, the shortcuts removed by fold_shortcut.model_fold_shortcuts
+        self.folded_shortcuts = folded_shortcuts
 
         super().__init__(
             pad_token_id=pad_token_id,
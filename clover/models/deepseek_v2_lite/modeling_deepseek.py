@@ -851,7 +851,11 @@ class DeepseekV2Attention(nn.Module):
                     "with a layer index."
                 )
             kv_seq_len += past_key_value.get_usable_length(kv_seq_len, self.layer_idx)
-        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+        rope_seq_len = kv_seq_len
+        if past_key_value is not None and position_ids is not None:
+            # a trimmed (sliding-window) cache keeps absolute positions beyond its length
+            rope_seq_len = max(kv_seq_len, int(position_ids.max()) + 1)
+        cos, sin = self.rotary_emb(value_states, seq_len=rope_seq_len)
 
         q_pe, k_pe = apply_rotary_pos_emb(q_pe, k_pe, cos, sin, position_ids)
 
@@ -981,8 +985,12 @@ class DeepseekV2FlashAttention2(DeepseekV2Attention):
         kv_seq_len = value_states.shape[-2]
         if past_key_value is not None:
             kv_seq_len += past_key_value.get_usable_length(kv_seq_len, self.layer_idx)
+        rope_seq_len = kv_seq_len
+        if past_key_value is not None and position_ids is not None:
+            # a trimmed (sliding-window) cache keeps absolute positions beyond its length
+            rope_seq_len = max(kv_seq_len, int(position_ids.max()) + 1)
 
-        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+        cos, sin = self.rotary_emb(value_states, seq_len=rope_seq_len)
         q_pe, k_pe = apply_rotary_pos_emb(q_pe, k_pe, cos, sin, position_ids)
 
         query_states = k_pe.new_empty(bsz, self.num_heads, q_len, self.q_head_dim)
@@ -1213,8 +1221,9 @@ class DeepseekV2DecoderLayer(nn.Module):
             else DeepseekV2MLP(config)
         )
         if config.use_shortcut_Q:
-            self.attn_shortcut_Q = nn.Parameter(torch.eye(config.hidden_size))
-            self.mlp_shortcut_Q = nn.Parameter(torch.eye(config.hidden_size))
+            folded = config.folded_shortcuts[layer_idx] if getattr(config, "folded_shortcuts", None) else []
+            self.attn_shortcut_Q = None if "attn_shortcut_Q" in folded else nn.Parameter(torch.eye(config.hidden_size))
+            self.mlp_shortcut_Q = None if "mlp_shortcut_Q" in folded else nn.Parameter(torch.eye(config.hidden_size))
         else:
             self.attn_shortcut_Q = None
             self.mlp_shortcut_Q = None
@@ -1272,6 +1281,9 @@ class DeepseekV2DecoderLayer(nn.Module):
         if self.attn_shortcut_Q is not None:
             rotated_shortcut = torch.matmul(residual, self.attn_shortcut_Q)
             hidden_states = rotated_shortcut + hidden_states
+        elif residual.shape[-1] < hidden_states.shape[-1]:
+            # folded [I 0] shortcut of a sliced residual stream
+            hidden_states = F.pad(residual, (0, hidden_states.shape[-1] - residual.shape[-1])) + hidden_states
         else:
             hidden_states = residual + hidden_states
 
@@ -1282,6 +1294,8 @@ class DeepseekV2DecoderLayer(nn.Module):
         if self.mlp_shortcut_Q is not None:
             rotated_shortcut = torch.matmul(residual, self.mlp_shortcut_Q)
             hidden_states = rotated_shortcut + hidden_states
+        elif residual.shape[-1] < hidden_states.shape[-1]:
+            hidden_states = F.pad(residual, (0, hidden_states.shape[-1] - residual.shape[-1])) + hidden_states
         else:
             hidden_states = (residual + hidden_states)
 
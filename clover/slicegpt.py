@@ -1,12 +1,15 @@
 import argparse
+import json
 import os
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
 from src.data import get_dataset, prepare_test_dataloader, prepare_dataloader
 from src.fuse_rmsnorm import insert_shortcut_and_fuse_rmsnorm
-from src.pca_calc import get_calibrate_outputs, evaluate_ppl, model_pca_calc
+from src.pca_calc import get_calibrate_outputs, evaluate_ppl, measure_latency, model_pca_calc
+from src.store import ActivationStore
 from src.rotate import model_rotate
-from src.slice import model_slice
+from src.fold_shortcut import model_fold_shortcuts
+from src.slice import model_slice, plan_slice_dims, slice_cost, stream_costs, stream_dims
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--model-path", type=str, default="deepseek-ai/DeepSeek-V2-Lite", help="Model to load")
@@ -18,9 +21,17 @@ parser.add_argument("--cal-nsamples", type=int, help="Number of samples of the c
 parser.add_argument("--cal-batch-size", type=int, default=8, help="Batch size for loading the calibration data.")
 parser.add_argument("--cal-max-seqlen", type=int, default=256, help="Maximum sequence length for the calibration data.")
 parser.add_argument("--varied-seqlen", action="store_true", help="Varied sequence lengths in the calibration data.")
+parser.add_argument("--cal-ram-budget-gb", type=float, default=None, help="Host memory for calibration activations before spilling to disk (no limit by default). Unused on CPU, where the activations are folded into Gram matrices on capture.")
+parser.add_argument("--cal-spill-dir", type=str, default=None, help="Directory for spilled activation shards, a temporary directory by default.")
 parser.add_argument("--seed", type=int, default=42, help="Seed for sampling the calibration data.")
 parser.add_argument("--pruned-dim", type=int, help="Data type to use.", default=2048)
 parser.add_argument("--ppl-eval-batch-size", type=int, default=8, help="Batch size for evaluating the perplexity.")
+parser.add_argument("--rotate-workers", type=int, default=1, help="Number of layers rotated in parallel.")
+parser.add_argument("--slice-plan", type=str, choices=["uniform", "flops", "params"], default="uniform", help="Slice every stream to --pruned-dim, or plan a width per stream from the PCA eigenvalues under a FLOP or parameter budget.")
+parser.add_argument("--slice-budget", type=float, default=None, help="Budget of the slicing plan as a fraction of the unsliced cost, the cost of slicing uniformly to --pruned-dim by default.")
+parser.add_argument("--slice-block-size", type=int, default=64, help="Planned stream widths are multiples of this.")
+parser.add_argument("--fold-shortcuts", action="store_true", help="Replace the shortcut rotations within --shortcut-atol of a (signed) permutation by that permutation, folded into the adjacent weights after slicing (approximate); reports how many shortcuts folded.")
+parser.add_argument("--shortcut-atol", type=float, default=1e-2, help="Largest entry-wise distance to a permutation for a shortcut to be folded.")
 args = parser.parse_args()
 
 def main(args: argparse.Namespace) -> None:
@@ -59,10 +70,14 @@ def main(args: argparse.Namespace) -> None:
         print(f'insert_shortcut_and_fuse_rmsnorm ppl: {dataset_ppl:.4f}')
     
     print(f"generate calculate feature")
-    ori_outputs = get_calibrate_outputs(model, train_loader)
+    ram_budget = None if args.cal_ram_budget_gb is None else int(args.cal_ram_budget_gb * 1024 ** 3)
+    store = ActivationStore(ram_budget=ram_budget, root=args.cal_spill_dir)
+    ori_outputs = get_calibrate_outputs(model, train_loader, store)
 
-    emb_Q, attn_Q, mlp_Q = model_pca_calc(model, ori_outputs, model.model.embed_tokens.weight.device)
-    model_rotate(model, torch.float64, emb_Q, attn_Q, mlp_Q)
+    emb_Q, attn_Q, mlp_Q, eigenvalues = model_pca_calc(model, ori_outputs, model.model.embed_tokens.weight.device, return_eigenvalues=True)
+    del ori_outputs
+    store.close()
+    model_rotate(model, torch.float64, emb_Q, attn_Q, mlp_Q, num_workers=args.rotate_workers)
     
     print("+"*10+"model_rotate Model:"+"+"*10)
     print(model)
@@ -72,10 +87,33 @@ def main(args: argparse.Namespace) -> None:
     
     model.save_pretrained(args.save_path)
     tokenizer.save_pretrained(args.save_path)
-    model_slice(model, args.pruned_dim)
+    full_dims = stream_dims(model, model.config.hidden_size)
+    dims = stream_dims(model, args.pruned_dim)
+    if args.slice_plan != "uniform":
+        cost_model = stream_costs(model, args.slice_plan)
+        budget = slice_cost(dims, *cost_model) if args.slice_budget is None else args.slice_budget * slice_cost(full_dims, *cost_model)
+        dims = plan_slice_dims(model, eigenvalues, budget, args.slice_plan, args.slice_block_size)
+        print(f"slice plan ({args.slice_plan}, {slice_cost(dims, *cost_model) / slice_cost(full_dims, *cost_model):.1%} of the unsliced cost): {dims}")
+    # the rotated checkpoint is saved unsliced, test.py --slice-dims slices it to the same widths
+    with open(os.path.join(args.save_path, "slice_dims.json"), "w") as f:
+        json.dump(dims, f)
+    flops_model = stream_costs(model, "flops")
+    predicted_speedup = slice_cost(full_dims, *flops_model) / slice_cost(dims, *flops_model)
+    latency = measure_latency(model)
+    model_slice(model, dims)
+    print(f"model_slice speedup: predicted {predicted_speedup:.2f}x (linear-layer FLOPs), measured {latency / measure_latency(model):.2f}x")
     if args.ppl_eval_batch_size > 0:
         dataset_ppl = evaluate_ppl(model, tokenizer.pad_token_id, test_loader)
-        print(f'model_slice dim={args.pruned_dim} ppl: {dataset_ppl:.4f}')
+        print(f'model_slice dim={args.pruned_dim if args.slice_plan == "uniform" else args.slice_plan} ppl: {dataset_ppl:.4f}')
+
+    if args.fold_shortcuts:
+        latency = measure_latency(model)
+        report = model_fold_shortcuts(model, args.shortcut_atol)
+        print(f"fold_shortcuts: folded {report['folded']}/{report['total']} shortcuts {report['counts']}, max folded error {report['max_err']:.2e}, shortcut FLOPs/token {report['flops_before'] / 1e6:.1f}M -> {report['flops_after'] / 1e6:.1f}M")
+        print(f"fold_shortcuts latency: {latency * 1000:.1f} ms -> {measure_latency(model) * 1000:.1f} ms")
+        if args.ppl_eval_batch_size > 0:
+            dataset_ppl = evaluate_ppl(model, tokenizer.pad_token_id, test_loader)
+            print(f'fold_shortcuts ppl: {dataset_ppl:.4f}')
 
 if __name__ == "__main__":
     main(args)
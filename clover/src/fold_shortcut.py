@@ -0,0 +1,138 @@
+import torch
+import torch.nn as nn
+import logging
+from .rotate import attention_input_weights, attention_output_weights, mlp_input_weights, mlp_output_weights
+
+
+def nearest_signed_permutation(S: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, float] | None:
+    """
+    Match the rows of a [m, n] shortcut (m <= n) to the signed columns of the identity.
+
+    Returns (cols, signs, err): a permutation of the n output dims whose first m entries are the column picked by each
+    row and the remaining ones the unpicked columns in order, the sign of every picked entry (+1 for the others), and
+    max |S[:, cols] * signs - [I 0]|. None if two rows pick the same column, i.e. S is not close to any permutation.
+    """
+    m, n = S.shape
+    S = S.to(torch.float64)
+    picked = S.abs().argmax(dim=1)
+    if picked.unique().numel() < m:
+        return None
+    unpicked = torch.ones(n, dtype=torch.bool, device=S.device)
+    unpicked[picked] = False
+    cols = torch.cat([picked, unpicked.nonzero().squeeze(-1)])
+    signs = torch.ones(n, dtype=torch.float64, device=S.device)
+    signs[:m] = torch.sign(S[torch.arange(m, device=S.device), picked])
+    err = (S[:, cols] * signs - torch.eye(m, n, dtype=torch.float64, device=S.device)).abs().max().item()
+    return cols, signs, err
+
+
+@torch.no_grad()
+def permute_columns(tensors: list[torch.Tensor], cols: torch.Tensor, signs: torch.Tensor | None = None) -> None:
+    # In place, X[:, i] <- signs[i] * X[:, cols[i]] for [*, n] tensors or views.
+    for X in tensors:
+        permuted = X.index_select(-1, cols.to(X.device))
+        if signs is not None:
+            permuted = permuted * signs.to(device=X.device, dtype=X.dtype)
+        X.copy_(permuted)
+
+
+def get_shortcut(layer: nn.Module, name: str, m: int, n: int, like: torch.Tensor) -> torch.Tensor:
+    # The [m, n] shortcut of the layer, materializing the [I 0] of a folded (None) one.
+    if getattr(layer, name) is None:
+        setattr(layer, name, nn.Parameter(torch.eye(m, n, dtype=like.dtype, device=like.device)))
+    return getattr(layer, name).data
+
+
+def stream_width(weights: list[torch.Tensor]) -> int:
+    return weights[0].shape[-1]
+
+
+@torch.no_grad()
+def model_fold_shortcuts(model: nn.Module, atol: float = 1e-2) -> dict:
+    """
+    Remove the shortcut matmuls of a rotated (and possibly sliced) model where the two rotations cancel.
+
+    A shortcut within `atol` of a signed permutation P (or [P 0] for the rectangular shortcut of a sliced stream) is
+    replaced by P: the residual stream it produces is re-indexed by P, i.e. the writers of that stream (o_proj or
+    down_proj) and its readers (the next input weights and norm, the next shortcut or lm_head) get their columns
+    permuted and sign-flipped, and the shortcut becomes a no-op (None), or a zero-pad in forward when it widens the
+    stream. The fold is approximate: the distance to P, at most `atol` per entry, is dropped. Shortcuts of rotations
+    computed per layer are rarely that close to a permutation, these stay dense matmuls; check `folded` / `total`.
+    The folded shortcuts are recorded in `model.config.folded_shortcuts` (per layer, the names of the shortcuts that
+    are None), so that a saved model reloads without them instead of with identity shortcuts.
+    Returns the per-layer kinds, the counts per kind, the number of folded shortcuts out of the total and the
+    shortcut FLOPs per token before and after.
+    """
+    layers = model.model.layers
+    flops_before = shortcut_flops(model)
+    kinds, max_err = [], 0.0
+    for layer_idx, layer in enumerate(layers):
+        next_layer = layers[layer_idx + 1] if layer_idx + 1 < len(layers) else None
+        attn_out = attention_output_weights(layer.self_attn)
+        mlp_out = mlp_output_weights(layer.mlp)
+        streams = {
+            "attn_shortcut_Q": (
+                layer.input_layernorm.weight.shape[0], attn_out,
+                [layer.post_attention_layernorm.weight], mlp_input_weights(layer.mlp), (layer, "mlp_shortcut_Q", mlp_out),
+            ),
+            "mlp_shortcut_Q": (
+                stream_width(attn_out), mlp_out,
+                [next_layer.input_layernorm.weight] if next_layer is not None else [model.model.norm.weight],
+                attention_input_weights(next_layer.self_attn) if next_layer is not None else [model.lm_head.weight.data],
+                (next_layer, "attn_shortcut_Q", attention_output_weights(next_layer.self_attn)) if next_layer is not None else None,
+            ),
+        }
+        layer_kinds = {}
+        for name, (m, writers, norms, readers, next_shortcut) in streams.items():
+            S = getattr(layer, name)
+            if S is None:
+                layer_kinds[name] = "none"
+                continue
+            match = nearest_signed_permutation(S.data)
+            if match is None or match[2] > atol:
+                layer_kinds[name] = "dense"
+                continue
+            cols, signs, err = match
+            max_err = max(max_err, err)
+            n = stream_width(writers)
+            permuted = not torch.equal(cols, torch.arange(n, device=cols.device)) or bool((signs < 0).any())
+            if permuted:
+                permute_columns(writers + readers, cols, signs)
+                permute_columns([w.data for w in norms], cols)
+                if next_shortcut is not None:
+                    next_layer_, next_name, next_writers = next_shortcut
+                    S_next = get_shortcut(next_layer_, next_name, n, stream_width(next_writers), S.data)
+                    permute_columns([S_next.T], cols, signs)
+            setattr(layer, name, None)
+            layer_kinds[name] = "permutation" if permuted else "identity" if m == n else "pad"
+        kinds.append(layer_kinds)
+
+    model.config.folded_shortcuts = [
+        [name for name in ["attn_shortcut_Q", "mlp_shortcut_Q"] if getattr(layer, name) is None] for layer in layers
+    ]
+    flops_after = shortcut_flops(model)
+    counts = {}
+    for layer_kinds in kinds:
+        for kind in layer_kinds.values():
+            counts[kind] = counts.get(kind, 0) + 1
+    total = sum(count for kind, count in counts.items() if kind != "none")
+    folded = total - counts.get("dense", 0)
+    logging.info(
+        f"fold_shortcuts: folded {folded}/{total} shortcuts {counts}, max folded error {max_err:.2e}, "
+        f"shortcut FLOPs/token {flops_before / 1e6:.1f}M -> {flops_after / 1e6:.1f}M"
+    )
+    return {
+        "kinds": kinds, "counts": counts, "folded": folded, "total": total, "max_err": max_err,
+        "flops_before": flops_before, "flops_after": flops_after,
+    }
+
+
+def shortcut_flops(model: nn.Module) -> int:
+    """Multiply-add FLOPs per token of the remaining shortcut matmuls."""
+    flops = 0
+    for layer in model.model.layers:
+        for name in ["attn_shortcut_Q", "mlp_shortcut_Q"]:
+            S = getattr(layer, name)
+            if S is not None:
+                flops += 2 * S.shape[0] * S.shape[1]
+    return flops
@@ -2,9 +2,12 @@ import torch
 import gc
 import inspect
 import logging
+import queue
+import threading
 import time
 from tqdm import tqdm
 from torch.utils.data import DataLoader, Dataset, SubsetRandomSampler
+from .store import ActivationStore
 
 def cleanup_memory() -> None:
     """Run GC and clear GPU memory."""
@@ -35,21 +38,147 @@ def sync_gpus() -> None:
     for i in range(torch.cuda.device_count()):
         torch.cuda.synchronize(device=i)
         
-def map_tensors(obj, device: torch.device | str | None = None, dtype: torch.dtype | None = None):
+def map_tensors(obj, device: torch.device | str | None = None, dtype: torch.dtype | None = None, non_blocking: bool = False):
     """Recursively map tensors to device and dtype."""
     if isinstance(obj, torch.Tensor):
         if device is not None:
-            obj = obj.to(device=device)
+            obj = obj.to(device=device, non_blocking=non_blocking)
         if dtype is not None:
             obj = obj.to(dtype=dtype)
         return obj
     elif isinstance(obj, (list, tuple)):
-        return type(obj)(map_tensors(x, device, dtype) for x in obj)
+        return type(obj)(map_tensors(x, device, dtype, non_blocking) for x in obj)
     elif isinstance(obj, dict):
-        return {k: map_tensors(v, device, dtype) for k, v in obj.items()}  # type: ignore
+        return {k: map_tensors(v, device, dtype, non_blocking) for k, v in obj.items()}  # type: ignore
     else:
         return obj
-    
+
+def prefetch_batches(loader, device: torch.device | str):
+    """
+    Yield the batches of `loader` on `device`. On CUDA the next batch is pinned and copied on a side stream
+    while the current one is being computed, instead of a blocking copy at the start of every step.
+    A copy of this function (and of `map_tensors`) lives in transmla/transmla/utils.py, make fixes in both.
+    """
+    device = torch.device(device)
+    if device.type != "cuda":
+        for batch in loader:
+            yield map_tensors(batch, device)
+        return
+
+    stream = torch.cuda.Stream(device)
+    pending = None
+    for batch in loader:
+        batch = {k: v.pin_memory() if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+        with torch.cuda.stream(stream):
+            batch = map_tensors(batch, device, non_blocking=True)
+        if pending is not None:
+            yield pending
+        torch.cuda.current_stream(device).wait_stream(stream)
+        for v in batch.values():
+            if isinstance(v, torch.Tensor):
+                v.record_stream(torch.cuda.current_stream(device))
+        pending = batch
+    if pending is not None:
+        yield pending
+
+class ActivationOffloader:
+    """
+    Hands activations captured by forward hooks to a consumer without stalling the forward pass.
+
+    On CUDA every activation is copied into a pinned host staging buffer on a side stream with `non_blocking=True`,
+    and a background thread waits for the copy before calling `consume(host_tensor)`, so the consumer folds
+    statistics or writes to disk while the next layers / batch compute. At most `max_inflight` copies are
+    pending, and the staging buffers are handed back to a pool once consumed, so at most `max_inflight + 1`
+    pinned buffers are ever allocated.
+    On CPU there is nothing to transfer: `consume` is called inline on the activation itself.
+
+    The staging buffer is reused as soon as `consume` returns; consumers that keep it must use `keep`.
+    Consumers run in submission order, on a single thread.
+
+    A copy of this class lives in transmla/transmla/utils.py, make fixes in both.
+    """
+    def __init__(self, device: torch.device | str, max_inflight: int = 64):
+        self.async_copy = torch.device(device).type == "cuda"
+        self.streams = {}
+        self.staging = queue.SimpleQueue()
+        self.error = None
+        if self.async_copy:
+            self.queue = queue.Queue(maxsize=max_inflight)
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    @staticmethod
+    def keep(x: torch.Tensor) -> torch.Tensor:
+        """Copy `x` out of the staging buffer, if it is one; the only copy made for a kept activation."""
+        return x.clone() if x.is_pinned() else x
+
+    def _staging_buffer(self, tensor: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """A recycled pinned buffer of at least the size of `tensor`, and a view of it with its shape and dtype."""
+        nbytes = tensor.numel() * tensor.element_size()
+        try:
+            buffer = self.staging.get_nowait()
+        except queue.Empty:
+            buffer = None
+        if buffer is None or buffer.numel() < nbytes:
+            # the packed activations vary in length, a too small buffer is replaced by a larger one
+            buffer = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+        return buffer, buffer[:nbytes].view(tensor.dtype).view(tensor.shape)
+
+    def submit(self, tensor: torch.Tensor, consume) -> None:
+        tensor = tensor.detach()
+        if not self.async_copy or tensor.device.type != "cuda":
+            consume(tensor)
+            return
+        if self.error is not None:
+            raise self.error
+
+        if tensor.device not in self.streams:
+            self.streams[tensor.device] = torch.cuda.Stream(tensor.device)
+        stream = self.streams[tensor.device]
+        stream.wait_stream(torch.cuda.current_stream(tensor.device))
+        with torch.cuda.stream(stream):
+            buffer, host = self._staging_buffer(tensor)
+            host.copy_(tensor, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(stream)
+        tensor.record_stream(stream)
+        self.queue.put((buffer, host, event, consume))
+
+    def _worker(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            buffer, host, event, consume = item
+            # the copy must be done before the buffer is recycled, even once a consumer has failed
+            event.synchronize()
+            try:
+                if self.error is None:
+                    consume(host)
+            except BaseException as e:
+                self.error = e
+            self.staging.put(buffer)
+
+    def close(self) -> None:
+        """Wait until every submitted activation has been consumed."""
+        if self.async_copy:
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+def valid_token_index(attention_mask: torch.Tensor | None) -> torch.Tensor | None:
+    """Flat positions of the real tokens of a batch, computed once per batch and shared by all hooks."""
+    if attention_mask is None:
+        return None
+    return attention_mask.flatten().nonzero().squeeze(-1)
+
+def pack_tokens(x: torch.Tensor, index: torch.Tensor | None) -> torch.Tensor:
+    """Drop the padded positions of a [batch, seq, dim] activation, returning a [1, tokens, dim] tensor."""
+    if index is None:
+        return x
+    return x.reshape(-1, x.shape[-1]).index_select(0, index.to(x.device)).unsqueeze(0)
+
 @torch.no_grad()
 def evaluate_ppl(
     model: torch.nn.Module, pad_token_id: int | None, testloader: DataLoader[dict[str, torch.Tensor]]
@@ -101,25 +230,149 @@ def evaluate_ppl(
 
     return ppl.item()
 
-def insert_hooks(model):
+@torch.no_grad()
+def measure_latency(model: torch.nn.Module, batch_size: int = 1, seq_len: int = 128, repeats: int = 5) -> float:
+    """Median wall time in seconds of a forward pass over random tokens, after one warm-up pass."""
+    model.eval()
+    device = model.model.embed_tokens.weight.device
+    input_ids = torch.randint(0, model.config.vocab_size, (batch_size, seq_len), device=device)
+    times = []
+    for idx in range(repeats + 1):
+        sync_gpus()
+        start_time = time.perf_counter()
+        model(input_ids=input_ids, use_cache=False)
+        sync_gpus()
+        if idx > 0:
+            times.append(time.perf_counter() - start_time)
+    return sorted(times)[len(times) // 2]
+
+def trim_cache(past_key_values, keep: int):
+    """Keep only the most recent `keep` positions of every layer in a HF cache (DynamicCache or legacy tuple)."""
+    if isinstance(past_key_values, (list, tuple)):
+        return type(past_key_values)(tuple(t[..., -keep:, :] for t in layer) for layer in past_key_values)
+    if hasattr(past_key_values, "layers"):
+        for layer in past_key_values.layers:
+            layer.keys = layer.keys[..., -keep:, :]
+            layer.values = layer.values[..., -keep:, :]
+    else:
+        for idx in range(len(past_key_values.key_cache)):
+            past_key_values.key_cache[idx] = past_key_values.key_cache[idx][..., -keep:, :]
+            past_key_values.value_cache[idx] = past_key_values.value_cache[idx][..., -keep:, :]
+    return past_key_values
+
+@torch.no_grad()
+def evaluate_sliding_ppl(
+    model: torch.nn.Module,
+    input_ids: torch.Tensor,
+    max_length: int = 2048,
+    stride: int = 512,
+    kv_reuse: bool = True,
+    message: str = "Evaluating sliding-window perplexity"
+) -> tuple[float, float, int]:
+    """
+    Strided sliding-window perplexity over one long token stream of shape (1, seq_len).
+    Every token except the first is scored exactly once, with at most `max_length` tokens of context.
+
+    With `kv_reuse` the result is an approximation of the strided perplexity: the overlap between
+    consecutive windows is kept in the KV cache and only the `stride` new tokens are forwarded (at their
+    absolute positions), which cuts the cost by about `max_length / stride`. Cached overlap tokens keep the
+    hidden states they got in the window they were first computed in, rather than being recomputed with the
+    context of the current window, so only the first window's NLL is exact. Without `kv_reuse` every window
+    is recomputed and the result is the exact strided perplexity.
+    The same evaluator (with `trim_cache`) lives in transmla/transmla/utils.py, make fixes in both.
+    """
+    assert 0 < stride <= max_length, f"stride ({stride}) must be in (0, max_length={max_length}]"
+    sync_gpus()
+
+    start_time = time.time()
+
+    model.eval()
+    device = model.model.embed_tokens.weight.device
+    input_ids = input_ids.to(device)
+    seq_len = input_ids.size(1)
+
+    total_nll = torch.zeros((), dtype=torch.float64, device=device)
+    past_key_values = None
+    last_logits = None
+    prev_end = 0
+
+    logging.info(message)
+    for begin in tqdm(range(0, seq_len, stride), desc=message):
+        end = min(begin + max_length, seq_len)
+
+        if kv_reuse and past_key_values is not None and stride < max_length:
+            # forward only the new tokens on top of the trimmed overlap
+            new_ids = input_ids[:, prev_end:end]
+            past_key_values = trim_cache(past_key_values, prev_end - begin)
+            outputs = model(
+                input_ids=new_ids,
+                position_ids=torch.arange(prev_end, end, device=device).unsqueeze(0),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            logits = torch.cat([last_logits, outputs.logits[:, :-1]], dim=1)
+            targets = new_ids
+        else:
+            chunk_ids = input_ids[:, begin:end]
+            outputs = model(
+                input_ids=chunk_ids,
+                position_ids=torch.arange(end - begin, device=device).unsqueeze(0),
+                use_cache=kv_reuse,
+            )
+            first_target = max(prev_end, begin + 1)
+            logits = outputs.logits[:, first_target - 1 - begin : end - 1 - begin]
+            targets = input_ids[:, first_target:end]
+
+        total_nll += torch.nn.functional.cross_entropy(
+            logits.reshape(-1, logits.size(-1)).float(), targets.reshape(-1), reduction="sum"
+        ).double()
+
+        if kv_reuse:
+            past_key_values = outputs.past_key_values
+            last_logits = outputs.logits[:, -1:]
+        prev_end = end
+        if end >= seq_len:
+            break
+
+    total_tokens = seq_len - 1
+    avg_nll = total_nll / total_tokens
+    ppl = torch.exp(avg_nll)
+
+    sync_gpus()
+
+    elapsed = time.time() - start_time
+    logging.info(
+        "Time spent on evaluation: %s",
+        time.strftime("%H:%M:%S.{}".format(str(elapsed % 1)[2:])[:13], time.gmtime(elapsed)),
+    )
+
+    return ppl.item(), avg_nll.item(), total_tokens
+
+class RunningGram:
+    """Running float64 sum of X^T X over the activations folded into it, an input of `layer_pca_calc`."""
+    def __init__(self):
+        self.H = None
+        self.tokens = 0
+
+    def add(self, x: torch.Tensor) -> None:
+        x = x.reshape(-1, x.shape[-1]).double()
+        H = x.mT @ x
+        self.H = H if self.H is None else self.H.add_(H)
+        self.tokens += x.shape[0]
+
+def insert_hooks(model, offloader: ActivationOffloader, capture, batch_state: dict):
+    """`capture(key)` returns the consumer of the activations captured under `key`."""
     input_layernorm_hooks = []
     post_attention_layernorm_hooks = []
-    input_layernorm_outputs = {}
-    post_attention_layernorm_outputs = {}
-    embed_tokens_outputs = []
 
     def embed_tokens_hook_fn(module, input, output):
-        embed_tokens_outputs.append(output.to('cpu'))
+        offloader.submit(pack_tokens(output, batch_state.get("index")), capture("embed_tokens"))
 
     def input_layernorm_hook_fn(module, input, output, index):
-        if index not in input_layernorm_outputs:
-            input_layernorm_outputs[index] = []
-        input_layernorm_outputs[index].append(output.to('cpu'))
+        offloader.submit(pack_tokens(output, batch_state.get("index")), capture(f"input_layernorm.{index}"))
 
     def post_attention_layernorm_hook_fn(module, input, output, index):
-        if index not in post_attention_layernorm_outputs:
-            post_attention_layernorm_outputs[index] = []
-        post_attention_layernorm_outputs[index].append(output.to('cpu'))
+        offloader.submit(pack_tokens(output, batch_state.get("index")), capture(f"post_attention_layernorm.{index}"))
         
     embed_tokens_hook = model.model.embed_tokens.register_forward_hook(lambda module, input, output: embed_tokens_hook_fn(module, input, output))
     for idx, layer in enumerate(model.model.layers):
@@ -128,32 +381,47 @@ def insert_hooks(model):
         post_attention_layernorm_hook = layer.post_attention_layernorm.register_forward_hook(lambda module, input, output, idx=idx: post_attention_layernorm_hook_fn(module, input, output, idx))
         post_attention_layernorm_hooks.append(post_attention_layernorm_hook)
     
-    return embed_tokens_hook, input_layernorm_hooks, post_attention_layernorm_hooks, embed_tokens_outputs, input_layernorm_outputs, post_attention_layernorm_outputs
+    return embed_tokens_hook, input_layernorm_hooks, post_attention_layernorm_hooks
 
 @torch.no_grad()
 def get_calibrate_outputs(
-    model: torch.nn.Module, trainloader: DataLoader[dict[str, torch.Tensor]]
-) -> tuple[list[torch.Tensor], list[torch.Tensor]]:
+    model: torch.nn.Module, trainloader: DataLoader[dict[str, torch.Tensor]], store: ActivationStore | None = None
+) -> dict:
     """
     Take the input signals ("activations") for a layer, run the layer forward.
+    The activations are appended to `store` (RAM only if None), padded positions are packed out on capture.
+    On CPU the PCA runs on the CPU anyway, so every capture is folded into a `RunningGram` instead and `store`
+    is left unused.
     """
 
     start_time = time.time()
 
     model.eval()
-    embed_tokens_hook, input_layernorm_hooks, post_attention_layernorm_hooks, embed_tokens_outputs, input_layernorm_outputs, post_attention_layernorm_outputs = insert_hooks(model)
-    ignore_masks = []
+    device = model.model.embed_tokens.weight.device
+    store = store if store is not None else ActivationStore()
+    offloader = ActivationOffloader(device)
+    if offloader.async_copy:
+        capture = lambda key: lambda x: store.append(key, x)
+    else:
+        grams = {}
+        capture = lambda key: grams.setdefault(key, RunningGram()).add
+    batch_state = {}
+    embed_tokens_hook, input_layernorm_hooks, post_attention_layernorm_hooks = insert_hooks(model, offloader, capture, batch_state)
     logging.info("Training perplexity...")
-    for batch in tqdm(trainloader):
-        batch = map_tensors(batch, model.model.embed_tokens.weight.device)
-        ignore_masks.append(batch["attention_mask"].to('cpu'))
+    for batch in tqdm(prefetch_batches(trainloader, device), total=len(trainloader)):
+        # padded positions are packed out by the hooks, so only real tokens are stored
+        batch_state["index"] = valid_token_index(batch.get("attention_mask"))
         model(**batch)
+    offloader.close()
+    store.flush()
 
     elapsed = time.time() - start_time
     logging.info(
         "Time spent on evaluation: %s",
         time.strftime("%H:%M:%S.{}".format(str(elapsed % 1)[2:])[:13], time.gmtime(elapsed)),
     )
+    if store.disk_bytes > 0:
+        logging.info(f"Activation store: {store.ram_bytes / 1024 ** 3:.2f} GB in RAM, {store.disk_bytes / 1024 ** 3:.2f} GB on disk")
 
     embed_tokens_hook.remove()
     for hook in input_layernorm_hooks:
@@ -161,43 +429,42 @@ def get_calibrate_outputs(
     for hook in post_attention_layernorm_hooks:
         hook.remove()
 
-    for idx, X_batch in enumerate(embed_tokens_outputs):
-        if ignore_masks:
-            X_batch[ignore_masks[idx] == 0] = 0
-
-    for value in input_layernorm_outputs.values():
-        for idx, X_batch in enumerate(value):
-            if ignore_masks:
-                X_batch[ignore_masks[idx] == 0] = 0
-
-    for value in post_attention_layernorm_outputs.values():
-        for idx, X_batch in enumerate(value):
-            if ignore_masks:
-                X_batch[ignore_masks[idx] == 0] = 0
-
-
+    num_layers = len(model.model.layers)
+    if offloader.async_copy:
+        captured = store
+        valid_tokens = {idx: sum(x.shape[0] * x.shape[1] for x in store[f"input_layernorm.{idx}"]) for idx in range(num_layers)}
+    else:
+        captured = grams
+        valid_tokens = {idx: grams[f"input_layernorm.{idx}"].tokens for idx in range(num_layers)}
+    logging.info(f"Valid calibration tokens per layer: {min(valid_tokens.values())} - {max(valid_tokens.values())}")
     outputs = {
-        "embed_tokens": embed_tokens_outputs,
-        "input_layernorm": input_layernorm_outputs,
-        "post_attention_layernorm": post_attention_layernorm_outputs,
+        "embed_tokens": captured["embed_tokens"],
+        "input_layernorm": {idx: captured[f"input_layernorm.{idx}"] for idx in range(num_layers)},
+        "post_attention_layernorm": {idx: captured[f"post_attention_layernorm.{idx}"] for idx in range(num_layers)},
+        "valid_tokens": valid_tokens,
     }
     return outputs
 
 @torch.no_grad()
 def layer_pca_calc(
-    X: list[torch.Tensor], device: str | torch.device | None = None
+    X: list[torch.Tensor] | RunningGram, device: str | torch.device | None = None, return_eigenvalues: bool = False
 ) -> tuple[torch.Tensor, torch.Tensor]:
     """
-    Run PCA on a list of batched data. Returns the eigenvalues and eigenvectors.
+    Run PCA on a list (or a `StoredActivations` view) of batched data, streaming one batch at a time, or on the
+    Gram matrix of a `RunningGram`. Returns the eigenvectors, and the eigenvalues in the same (descending) order
+    with `return_eigenvalues`.
     """
     # Run GC and cleanup GPU memory
     cleanup_memory()
 
-    H = None
-    for idx, X_batch in enumerate(X):
-        X_batch = X_batch.double().to(device=device)
-        H_batch = torch.sum(X_batch.mT @ X_batch, dim=0)  # sum over the batch dimension.
-        H = H_batch if H is None else H + H_batch
+    if isinstance(X, RunningGram):
+        H = X.H.to(device=device, copy=True)
+    else:
+        H = None
+        for idx, X_batch in enumerate(X):
+            X_batch = X_batch.double().to(device=device)
+            H_batch = torch.sum(X_batch.mT @ X_batch, dim=0)  # sum over the batch dimension.
+            H = H_batch if H is None else H + H_batch
 
     damp = 0.01 * torch.mean(torch.diag(H))
     diag = torch.arange(H.shape[-1]).to(device=device)
@@ -206,13 +473,26 @@ def layer_pca_calc(
     del H
     index = torch.argsort(X_eig[0], descending=True)
     eigen_vec = X_eig[1][:, index]
+    if return_eigenvalues:
+        return eigen_vec, X_eig[0][index]
     return eigen_vec
 
-def model_pca_calc(model, outputs, device):
-    emb_Q = layer_pca_calc(outputs['embed_tokens'], device)
+def model_pca_calc(model, outputs, device, return_eigenvalues: bool = False):
+    """
+    Rotations of the residual stream: emb_Q, and per layer attn_Q / mlp_Q. With `return_eigenvalues` also returns the
+    eigenvalues of every stream, [emb, attn 0, mlp 0, attn 1, ...], the order used by `plan_slice_dims`.
+    """
+    emb_Q, emb_E = layer_pca_calc(outputs['embed_tokens'], device, return_eigenvalues=True)
     attn_Q = []
     mlp_Q = []
+    eigenvalues = [emb_E]
     for idx in range(len(outputs['input_layernorm'].keys())):
-        attn_Q.append(layer_pca_calc(outputs['input_layernorm'][idx], device))
-        mlp_Q.append(layer_pca_calc(outputs['post_attention_layernorm'][idx], device))
+        Q, E = layer_pca_calc(outputs['input_layernorm'][idx], device, return_eigenvalues=True)
+        attn_Q.append(Q)
+        eigenvalues.append(E)
+        Q, E = layer_pca_calc(outputs['post_attention_layernorm'][idx], device, return_eigenvalues=True)
+        mlp_Q.append(Q)
+        eigenvalues.append(E)
+    if return_eigenvalues:
+        return emb_Q, attn_Q, mlp_Q, eigenvalues
     return emb_Q, attn_Q, mlp_Q
\ No newline at end of file
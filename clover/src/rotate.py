@@ -2,80 +2,127 @@ import torch
 import torch.nn as nn
 import re
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# float64 bytes of one block of rows rotated at a time (per worker thread)
+CHUNK_BYTES = 256 * 1024 ** 2
+
+MLP_INPUT = re.compile(r"(up_proj|gate_proj|gate)$")
+MLP_OUTPUT = re.compile(r"(down_proj)$")
+
+
+@torch.no_grad()
+def rotate_rows(rows: list[torch.Tensor], Q: torch.Tensor, chunk_bytes: int = CHUNK_BYTES) -> None:
+    """
+    In place, X <- X @ Q for every X in `rows` ([n, d] tensors or views with d == Q.shape[0]).
+
+    Rows of all tensors with the same width are rotated together: they are gathered into float64 blocks of at most
+    `chunk_bytes`, multiplied by Q once per block and copied back into the original storage. All experts of an MoE
+    layer thus share a few large matmuls, and the float64 working set stays bounded whatever the model size.
+    """
+    Q = Q.to(dtype=torch.float64)
+    max_rows = max(1, chunk_bytes // (8 * Q.shape[0]))
+    block, block_rows = [], 0
+
+    def flush():
+        Q_ = Q.to(device=block[0].device)
+        rotated = torch.cat([x.to(dtype=torch.float64) for x in block]) @ Q_
+        for x, r in zip(block, rotated.split([x.shape[0] for x in block])):
+            x.copy_(r)
+        block.clear()
+
+    for X in rows:
+        for start in range(0, X.shape[0], max_rows):
+            x = X[start:start + max_rows]
+            if block and (block_rows + x.shape[0] > max_rows or x.device != block[0].device):
+                flush()
+                block_rows = 0
+            block.append(x)
+            block_rows += x.shape[0]
+    if block:
+        flush()
+
+
+def attention_input_weights(self_attn: nn.Module) -> list[torch.Tensor]:
+    # WQ, WK and WV matrices of the self-attention layer, rotated on the right.
+    return [getattr(self_attn, name).weight.data for name in ["q_proj", "q_a_proj", "kv_a_proj_with_mqa"] if hasattr(self_attn, name)]
+
+
+def attention_output_weights(self_attn: nn.Module) -> list[torch.Tensor]:
+    # Output matrix (and bias) of the self-attention layer, rotated on the left: Q.T @ W == (W.T @ Q).T.
+    W = self_attn.o_proj
+    rows = [W.weight.data.T]
+    if W.bias is not None:
+        rows.append(W.bias.data[None])
+    return rows
+
+
+def mlp_input_weights(mlp: nn.Module) -> list[torch.Tensor]:
+    # MLP & MoE input weights: gate_proj / up_proj of every expert and the router.
+    return [module.weight.data for name, module in mlp.named_modules() if MLP_INPUT.search(name)]
+
+
+def mlp_output_weights(mlp: nn.Module) -> list[torch.Tensor]:
+    # MLP & MoE output weights and biases, rotated on the left.
+    rows = []
+    for name, module in mlp.named_modules():
+        if MLP_OUTPUT.search(name):
+            rows.append(module.weight.data.T)
+            if module.bias is not None:
+                rows.append(module.bias.data[None])
+    return rows
+
 
 def rotate_attention_inputs(self_attn: nn.Module, Q: torch.Tensor) -> None:
-    # Rotate the WQ, WK and WV matrices of the self-attention layer.
-    for name in ["q_proj", "q_a_proj", "kv_a_proj_with_mqa"]:
-        if hasattr(self_attn, name):
-            W = getattr(self_attn, name)
-            dtype = W.weight.dtype
-            W_ = W.weight.to(dtype=torch.float64)
-            W.weight.data = torch.matmul(W_, Q).to(dtype=dtype)
-            print(f"rotate {name} done.")
-            
+    rotate_rows(attention_input_weights(self_attn), Q)
+
 def rotate_attention_output(self_attn: nn.Module, Q: torch.Tensor) -> None:
-    # Rotate output matrix of the self-attention layer.
-    for name in ["o_proj", ]:
-        if hasattr(self_attn, name):
-            W = getattr(self_attn, name)
-            dtype = W.weight.data.dtype
-            W_ = W.weight.data.to(dtype=torch.float64)
-            W.weight.data = torch.matmul(Q.T, W_).to(dtype=dtype)
-            if W.bias is not None:
-                b = W.bias.data.to(dtype=torch.float64)
-                W.bias.data = torch.matmul(Q.T, b).to(dtype=dtype)
-            print(f"rotate {name} done.")
+    rotate_rows(attention_output_weights(self_attn), Q)
 
 def rotate_mlp_input(mlp: nn.Module, Q: torch.Tensor) -> None:
-    # Rotate the MLP & MoE input weights.
-    for name, module in mlp.named_modules():
-        if re.search(r"(up_proj|gate_proj|gate)$", name):
-            dtype = module.weight.dtype
-            W_ = module.weight.data.to(dtype=torch.float64)
-            module.weight.data = torch.matmul(W_, Q).to(dtype=dtype)
-            print(f"rotate {name} done.")
+    rotate_rows(mlp_input_weights(mlp), Q)
 
 def rotate_mlp_output(mlp: nn.Module, Q: torch.Tensor) -> None:
-    # Rotate the MLP output weights and bias.
-    for name, module in mlp.named_modules():
-        if re.search(r"(down_proj)$", name):
-            dtype = module.weight.data.dtype
-            W_ = module.weight.data.to(dtype=torch.float64)
-            module.weight.data = torch.matmul(Q.T, W_).to(dtype=dtype)
-            if module.bias is not None:
-                b = module.bias.data.to(dtype=torch.float64)
-                module.bias.data = torch.matmul(Q.T, b).to(dtype=dtype)
-            print(f"rotate {name} done.")
+    rotate_rows(mlp_output_weights(mlp), Q)
 
 def rotate_embeddings(embed_tokens: nn.Module, Q: torch.Tensor) -> None:
-    # Rotate the embeddings.
-    dtype = embed_tokens.weight.data.dtype
-    W_ = embed_tokens.weight.data.to(dtype=torch.float64)
-    embed_tokens.weight.data = torch.matmul(W_, Q).to(dtype=dtype)
-    print(f"rotate embed_tokens done.")
+    rotate_rows([embed_tokens.weight.data], Q)
 
 def rotate_lm_head(lm_head: nn.Module, Q: torch.Tensor) -> None:
-    # Rotate the head.
-    dtype = lm_head.weight.data.dtype
-    W_ = lm_head.weight.data.to(dtype=torch.float64)
-    lm_head.weight.data = torch.matmul(W_, Q).to(dtype=dtype)
-    print(f"rotate lm_head done.")
+    rotate_rows([lm_head.weight.data], Q)
 
-def model_rotate(model: nn.Module, dtype, emb_Q: torch.Tensor, attn_Q: list[torch.Tensor], mlp_Q: list[torch.Tensor]):
-    rotate_embeddings(model.model.embed_tokens, emb_Q)
 
-    for layer_idx, layer in enumerate(model.model.layers):
-        in_attn_Q = out_mlp_Q if layer_idx > 0 else emb_Q
-        in_mlp_Q = out_attn_Q = attn_Q[layer_idx]
-        out_mlp_Q = mlp_Q[layer_idx]
+def rotate_layer(layer: nn.Module, in_attn_Q: torch.Tensor, out_attn_Q: torch.Tensor, out_mlp_Q: torch.Tensor, dtype) -> None:
+    in_mlp_Q = out_attn_Q
+    layer.attn_shortcut_Q.data = torch.matmul(in_attn_Q.T.clone(), out_attn_Q.to(dtype=dtype),).to(torch.bfloat16)
+    layer.mlp_shortcut_Q.data = torch.matmul(in_mlp_Q.T.clone().to(dtype=dtype), out_mlp_Q.to(dtype=dtype),).to(torch.bfloat16)
+
+    # the attention inputs and the attention outputs are rotated by different matrices
+    rotate_rows(attention_input_weights(layer.self_attn), in_attn_Q)
+    rotate_rows(attention_output_weights(layer.self_attn), out_attn_Q)
+    rotate_rows(mlp_input_weights(layer.mlp), in_mlp_Q)
+    rotate_rows(mlp_output_weights(layer.mlp), out_mlp_Q)
 
-        layer.attn_shortcut_Q.data = torch.matmul(in_attn_Q.T.clone(), out_attn_Q.to(dtype=dtype),).to(torch.bfloat16)
-        layer.mlp_shortcut_Q.data = torch.matmul(in_mlp_Q.T.clone().to(dtype=dtype), out_mlp_Q.to(dtype=dtype),).to(torch.bfloat16)
 
-        rotate_attention_inputs(layer.self_attn, in_attn_Q)
-        rotate_attention_output(layer.self_attn, out_attn_Q)
+def model_rotate(model: nn.Module, dtype, emb_Q: torch.Tensor, attn_Q: list[torch.Tensor], mlp_Q: list[torch.Tensor], num_workers: int = 1):
+    """
+    Rotate the residual stream of the model: embeddings by emb_Q, every layer's attention output by attn_Q[i] and
+    MLP output by mlp_Q[i]. Layers are independent once their Qs are known and run on `num_workers` threads.
+    """
+    start = time.perf_counter()
+    rotate_embeddings(model.model.embed_tokens, emb_Q)
 
-        rotate_mlp_input(layer.mlp, in_mlp_Q)
-        rotate_mlp_output(layer.mlp, out_mlp_Q)
+    layers = model.model.layers
+    in_attn_Qs = [emb_Q] + mlp_Q[:-1]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(rotate_layer, layer, in_attn_Qs[layer_idx], attn_Q[layer_idx], mlp_Q[layer_idx], dtype)
+            for layer_idx, layer in enumerate(layers)
+        ]
+        for layer_idx, future in enumerate(futures):
+            future.result()
+            logging.info(f"rotate layer {layer_idx} done.")
 
-    rotate_lm_head(model.lm_head, out_mlp_Q)
\ No newline at end of file
+    rotate_lm_head(model.lm_head, mlp_Q[-1])
+    logging.info(f"model_rotate: {len(layers)} layers in {time.perf_counter() - start:.1f}s")
@@ -51,24 +51,128 @@ def slice_lm_head(lm_head: nn.Module, dim: int) -> None:
     lm_head.weight.data = lm_head.weight.data[:, :dim]
     lm_head.in_features = dim
 
-def model_slice(model: nn.Module, dim: int, prune_lm_head=False):
-    slice_embeddings(model.model.embed_tokens, dim)
+def stream_dims(model: nn.Module, dim: int | list[int], prune_lm_head=False) -> list[int]:
+    # Widths of the streams [emb, attn 0, mlp 0, attn 1, ...] for one width `dim` or a list of widths.
+    num_streams = 2 * len(model.model.layers) + 1
+    if isinstance(dim, int):
+        dims = [dim] * num_streams
+        if not prune_lm_head:
+            dims[-1] = model.lm_head.weight.shape[1]
+        return dims
+    assert len(dim) == num_streams, f"expected {num_streams} stream widths, got {len(dim)}"
+    return list(dim)
 
-    for layer_idx, layer in enumerate(model.model.layers):
-        slice_attention_inputs(layer.self_attn, dim)
-        slice_attention_output(layer.self_attn, dim)
-        slice_mlp_input(layer.mlp, dim)
-        layer.attn_shortcut_Q.data = layer.attn_shortcut_Q.data[:dim,:dim]
-        if layer_idx < len(model.model.layers)-1 or prune_lm_head:
-            slice_mlp_output(layer.mlp, dim)
-            layer.mlp_shortcut_Q.data = layer.mlp_shortcut_Q.data[:dim,:dim]
-        else:
-            layer.mlp_shortcut_Q.data = layer.mlp_shortcut_Q.data[:dim]
+def model_slice(model: nn.Module, dim: int | list[int], prune_lm_head=False):
+    """
+    Slice the rotated residual streams. `dim` is one width for every stream, or the widths of the 2 * num_layers + 1
+    streams [emb, attn 0, mlp 0, attn 1, ...] (e.g. from `plan_slice_dims`), with rectangular shortcuts between
+    streams of different widths. The last stream is only sliced with `prune_lm_head`.
+    """
+    dims = stream_dims(model, dim, prune_lm_head)
+    slice_embeddings(model.model.embed_tokens, dims[0])
 
+    for layer_idx, layer in enumerate(model.model.layers):
+        in_dim, attn_dim, mlp_dim = dims[2 * layer_idx: 2 * layer_idx + 3]
+        slice_attention_inputs(layer.self_attn, in_dim)
+        slice_attention_output(layer.self_attn, attn_dim)
+        slice_mlp_input(layer.mlp, attn_dim)
+        slice_mlp_output(layer.mlp, mlp_dim)
+        layer.attn_shortcut_Q.data = layer.attn_shortcut_Q.data[:in_dim, :attn_dim]
+        layer.mlp_shortcut_Q.data = layer.mlp_shortcut_Q.data[:attn_dim, :mlp_dim]
 
-        layer.input_layernorm.weight.data = layer.input_layernorm.weight.data[:dim] * math.sqrt(layer.input_layernorm.weight.data.shape[0]/dim)
-        layer.post_attention_layernorm.weight.data = layer.post_attention_layernorm.weight.data[:dim] * math.sqrt(layer.post_attention_layernorm.weight.data.shape[0]/dim)
+        layer.input_layernorm.weight.data = layer.input_layernorm.weight.data[:in_dim] * math.sqrt(layer.input_layernorm.weight.data.shape[0]/in_dim)
+        layer.post_attention_layernorm.weight.data = layer.post_attention_layernorm.weight.data[:attn_dim] * math.sqrt(layer.post_attention_layernorm.weight.data.shape[0]/attn_dim)
 
     if prune_lm_head:
-        slice_lm_head(model.lm_head, dim)
-        model.model.norm.weight.data = model.model.norm.weight.data[:dim]
\ No newline at end of file
+        slice_lm_head(model.lm_head, dims[-1])
+        model.model.norm.weight.data = model.model.norm.weight.data[:dims[-1]]
+
+
+def stream_costs(model: nn.Module, metric: str = "flops") -> tuple[list[float], float, float]:
+    """
+    Linear cost model of the residual stream widths, per token for "flops" (a multiply-add counts 2, a routed expert
+    is weighted by the fraction of tokens it sees, embedding lookups are free) or in "params".
+
+    Returns (unit, shortcut, fixed): the cost of the weights reading or writing every stream per unit of its width,
+    the cost per entry of a shortcut (stream i to stream i + 1 costs shortcut * w_i * w_i+1), and the cost of the
+    weights independent of the widths, so that the total is fixed + sum(unit * w) + shortcut * sum(w_i * w_i+1).
+    """
+    assert metric in ("flops", "params")
+    scale = 2.0 if metric == "flops" else 1.0
+    routed_fraction = (getattr(model.config, "num_experts_per_tok", None) or 0) / (getattr(model.config, "n_routed_experts", None) or 1)
+
+    def weight_cost(name: str) -> float:
+        # cost of one weight of the module called `name`
+        if name == "embed_tokens":
+            return 0.0 if metric == "flops" else 1.0
+        if metric == "flops" and re.search(r"(^|\.)experts\.", name):
+            return scale * routed_fraction
+        return scale
+
+    layers = model.model.layers
+    full = model.model.embed_tokens.weight.shape[1]
+    total = weight_cost("embed_tokens") * model.model.embed_tokens.weight.numel() + scale * model.lm_head.weight.numel()
+    for name, module in layers.named_modules():
+        if isinstance(module, nn.Linear) or re.search(r"mlp\.gate$", name):
+            total += weight_cost(name) * module.weight.numel()
+
+    unit = [0.0] * (2 * len(layers) + 1)
+    unit[0] += weight_cost("embed_tokens") * model.model.embed_tokens.weight.shape[0]
+    unit[-1] += scale * model.lm_head.weight.shape[0]
+    for layer_idx, layer in enumerate(layers):
+        for name in ["q_proj", "q_a_proj", "kv_a_proj_with_mqa"]:
+            if hasattr(layer.self_attn, name):
+                unit[2 * layer_idx] += scale * getattr(layer.self_attn, name).weight.shape[0]
+        unit[2 * layer_idx + 1] += scale * layer.self_attn.o_proj.weight.shape[1]
+        for name, module in layer.mlp.named_modules():
+            if re.search(r"(up_proj|gate_proj|gate)$", name):
+                unit[2 * layer_idx + 1] += weight_cost(name) * module.weight.shape[0]
+            elif re.search(r"(down_proj)$", name):
+                unit[2 * layer_idx + 2] += weight_cost(name) * module.weight.shape[1]
+    return unit, scale, total - sum(unit) * full
+
+
+def slice_cost(dims: list[int], unit: list[float], shortcut: float, fixed: float) -> float:
+    return fixed + sum(u * w for u, w in zip(unit, dims)) + shortcut * sum(a * b for a, b in zip(dims[:-1], dims[1:]))
+
+
+def plan_slice_dims(
+    model: nn.Module, eigenvalues: list[torch.Tensor], budget: float, metric: str = "flops",
+    block_size: int = 64, min_dim: int | None = None, prune_lm_head=False,
+) -> list[int]:
+    """
+    Widths of the residual streams [emb, attn 0, mlp 0, ...] within `budget`, in the cost of `stream_costs`.
+
+    Every stream starts at `min_dim` (one block by default) and grows by blocks of `block_size`. Each step adds the
+    block with the largest kept variance (its eigenvalues over the total of the stream) per unit of extra cost, the
+    shortcuts to both neighbouring streams included, until no block fits in the budget. Without `prune_lm_head` the
+    last stream stays at full width and its cost is part of the budget.
+    """
+    unit, shortcut, fixed = stream_costs(model, metric)
+    full = model.model.embed_tokens.weight.shape[1]
+    min_dim = min_dim or block_size
+    assert full % block_size == 0 and min_dim % block_size == 0
+    dims = [min_dim] * len(unit)
+    if not prune_lm_head:
+        dims[-1] = full
+    cost = slice_cost(dims, unit, shortcut, fixed)
+    assert cost <= budget, f"the budget ({budget:.3e}) does not cover streams of width {min_dim} ({cost:.3e})"
+
+    gains = [(E / E.sum()).view(-1, block_size).sum(-1).tolist() for E in eigenvalues]
+    while True:
+        best, best_ratio, best_extra = None, 0.0, 0.0
+        for idx, dim in enumerate(dims):
+            if dim >= full or (idx == len(dims) - 1 and not prune_lm_head):
+                continue
+            neighbours = (dims[idx - 1] if idx > 0 else 0) + (dims[idx + 1] if idx + 1 < len(dims) else 0)
+            extra = block_size * (unit[idx] + shortcut * neighbours)
+            if cost + extra > budget:
+                continue
+            ratio = gains[idx][dim // block_size] / extra
+            if best is None or ratio > best_ratio:
+                best, best_ratio, best_extra = idx, ratio, extra
+        if best is None:
+            break
+        dims[best] += block_size
+        cost += best_extra
+    return dims
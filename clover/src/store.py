@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+# numpy has no bfloat16, so shards hold the raw bits through a same-width integer view.
+_INT_VIEW = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+_NP_INT = {torch.uint8: np.uint8, torch.int16: np.int16, torch.int32: np.int32, torch.int64: np.int64}
+
+
+class StoredActivations:
+    """Read-only, ordered view of the activations appended under one key of an `ActivationStore`."""
+
+    def __init__(self, store: "ActivationStore", key: str):
+        self.store = store
+        self.key = key
+
+    def __len__(self) -> int:
+        return len(self.store.index.get(self.key, []))
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        return self.store.load(self.store.index[self.key][idx])
+
+    def __iter__(self):
+        for entry in self.store.index.get(self.key, []):
+            yield self.store.load(entry)
+
+
+class ActivationStore:
+    """
+    Append-only store of calibration activations with a RAM budget.
+
+    Activations stay in memory until `ram_budget` bytes are held; every later append goes to the shard
+    file `<root>/<key>.bin` and its (offset, shape, dtype) is recorded in `<root>/index.json`. Reading a
+    spilled entry memory-maps its slice of the shard, so `layer_pca_calc` streams over the data one batch
+    at a time and the host only needs to hold the current batch.
+
+    Args:
+        ram_budget: Bytes kept in memory before spilling to disk, None for no limit.
+        root: Directory for the shards, a temporary directory (removed by `close`) if None.
+    """
+
+    def __init__(self, ram_budget: int | None = None, root: str | None = None):
+        self.ram_budget = ram_budget
+        self.owns_root = root is None
+        self.root = root
+        self.ram_bytes = 0
+        self.disk_bytes = 0
+        self.index: dict[str, list] = {}
+        self.ram: list[torch.Tensor] = []
+        self.files = {}
+
+    def append(self, key: str, x: torch.Tensor) -> None:
+        x = x.detach()
+        nbytes = x.numel() * x.element_size()
+        if self.ram_budget is None or self.ram_bytes + nbytes <= self.ram_budget:
+            # a pinned `x` is a recycled staging buffer of the offloader, spilled entries are written straight from it
+            self.ram.append(x.clone() if x.is_pinned() else x)
+            self.ram_bytes += nbytes
+            self.index.setdefault(key, []).append(("ram", len(self.ram) - 1))
+            return
+
+        if self.root is None:
+            self.root = tempfile.mkdtemp(prefix="clover_activations_")
+            logging.info(f"Activation store exceeded {self.ram_budget / 1024 ** 3:.2f} GB, spilling to {self.root}")
+        if key not in self.files:
+            os.makedirs(self.root, exist_ok=True)
+            self.files[key] = open(os.path.join(self.root, f"{key}.bin"), "wb")
+        f = self.files[key]
+        offset = f.tell()
+        x = x.to("cpu").contiguous()
+        x.view(_INT_VIEW[x.element_size()]).numpy().tofile(f)
+        self.disk_bytes += nbytes
+        self.index.setdefault(key, []).append(("disk", f"{key}.bin", offset, list(x.shape), str(x.dtype).split(".")[-1]))
+
+    def flush(self) -> None:
+        """Finish the shard files and write the index, after which spilled entries can be read."""
+        for f in self.files.values():
+            f.flush()
+        if self.root is not None and self.files:
+            with open(os.path.join(self.root, "index.json"), "w") as f:
+                json.dump({key: [e for e in entries if e[0] == "disk"] for key, entries in self.index.items()}, f)
+
+    def load(self, entry) -> torch.Tensor:
+        if entry[0] == "ram":
+            return self.ram[entry[1]]
+        _, shard, offset, shape, dtype = entry
+        dtype = getattr(torch, dtype)
+        int_dtype = _INT_VIEW[torch.empty((), dtype=dtype).element_size()]
+        # copy-on-write mapping: pages are read lazily and the shard is never modified
+        mm = np.memmap(os.path.join(self.root, shard), dtype=_NP_INT[int_dtype], mode="c", offset=offset, shape=tuple(shape))
+        return torch.from_numpy(mm).view(dtype)
+
+    def keys(self) -> list[str]:
+        return list(self.index.keys())
+
+    def __getitem__(self, key: str) -> StoredActivations:
+        return StoredActivations(self, key)
+
+    def close(self) -> None:
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.ram = []
+        self.index = {}
+        if self.owns_root and self.root is not None:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.root = None
@@ -1,9 +1,10 @@
 import argparse
+import json
 import os
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
 from src.data import get_dataset, prepare_test_dataloader
-from src.pca_calc import evaluate_ppl
+from src.pca_calc import evaluate_ppl, evaluate_sliding_ppl
 from src.slice import model_slice
 
 parser = argparse.ArgumentParser()
@@ -12,7 +13,9 @@ parser.add_argument("--dtype", type=str, help="Data type to use.", choices=["fp3
 parser.add_argument("--device", type=str, help="Device to use.", choices=["cpu", "cuda", "auto"], default="auto")
 parser.add_argument("--cal-dataset", type=str, help="Dataset to calibrate and calculate perplexity on.", choices=["wikitext2", "ptb", "c4", "alpaca"], default="wikitext2")
 parser.add_argument("--pruned-dim", type=int, help="Data type to use.")
+parser.add_argument("--slice-dims", type=str, default=None, help="JSON list of the 2 * num_layers + 1 stream widths to slice to, e.g. the slice_dims.json slicegpt.py writes next to the rotated model. Overrides --pruned-dim.")
 parser.add_argument("--ppl-eval-batch-size", type=int, default=1, help="Batch size for evaluating the perplexity.")
+parser.add_argument("--ppl-stride", type=int, default=0, help="Stride for an approximate sliding-window perplexity that reuses the overlap's KV cache (only the first window is exact), 0 to disable.")
 args = parser.parse_args()
 
 def main(args: argparse.Namespace) -> None:
@@ -34,13 +37,23 @@ def main(args: argparse.Namespace) -> None:
     test_loader = prepare_test_dataloader(
         dataset=dataset["test"], tokenizer=tokenizer, batch_size=args.ppl_eval_batch_size
     )
-    if args.pruned_dim is not None:
+    if args.slice_dims is not None:
+        with open(args.slice_dims) as f:
+            dims = json.load(f)
+        model_slice(model, dims)
+        model.save_pretrained("outputs/slice_planned")
+        tokenizer.save_pretrained("outputs/slice_planned")
+    elif args.pruned_dim is not None:
         model_slice(model, args.pruned_dim)
         model.save_pretrained(f"outputs/slice_{args.pruned_dim}")
         tokenizer.save_pretrained(f"outputs/slice_{args.pruned_dim}")
     print(model)
     dataset_ppl = evaluate_ppl(model, tokenizer.pad_token_id, test_loader)
     print(f'Original ppl: {dataset_ppl:.4f}')
+    if args.ppl_stride > 0:
+        input_ids = test_loader.dataset.input_ids.reshape(1, -1)
+        dataset_ppl, _, _ = evaluate_sliding_ppl(model, input_ids, test_loader.dataset.input_ids.shape[-1], args.ppl_stride)
+        print(f'Sliding-window ppl, stride={args.ppl_stride}: {dataset_ppl:.4f}')
 
 if __name__ == "__main__":
     main(args)
\ No newline at end of file
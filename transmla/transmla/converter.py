@@ -4,9 +4,11 @@ from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
 
 from modify_config import modify_config
-from utils import get_dataset, prepare_dataloader, prepare_test_dataloader, evaluate_ppl
+from utils import get_dataset, prepare_dataloader, prepare_test_dataloader, evaluate_ppl, evaluate_sliding_ppl
 from partial_rope import partial_rope
 from lora_qkv import low_rank_qkv
+from safetensors_writer import StreamingSafetensorsWriter, save_remaining, write_index
+from distributed import init_distributed, is_distributed, get_rank, shard_batches, owns_layer, all_gather_object
 
 
 def load_model_and_tokenizer(args):
@@ -25,6 +27,14 @@ def load_model_and_tokenizer(args):
         tokenizer.pad_token = tokenizer.eos_token
 
     assert model.config.model_type in ["llama", "qwen2", "mistral", "mimo"] or not args.deepseek_style
+    # the deepseek-style modeling files have no quantized linear layers
+    assert args.weight_bits is None or not args.deepseek_style
+    # the deepseek-style modeling files have one kv_lora_rank for all layers
+    assert args.kv_cache_budget is None or not args.deepseek_style
+    # the deepseek-style modeling files (and the vLLM loader) have no absorbed projections
+    assert not (args.export_absorbed and args.deepseek_style)
+    # only the absorbed forward of mla.py caches the latent
+    assert args.kv_cache_quant is None or (args.export_absorbed and not args.deepseek_style)
 
     return model, tokenizer
 
@@ -51,6 +61,11 @@ def get_dataset_loader(tokenizer: AutoTokenizer, **kwargs):
     
 def main(args):
 
+    if args.distributed:
+        init_distributed()
+        # the candidates of the freqfold search would have to be compared on every worker
+        assert args.freqfold != "auto", "--distributed needs an explicit --freqfold"
+
     ##############################
     #       original model       #
     ##############################
@@ -62,6 +77,12 @@ def main(args):
     model, tokenizer = load_model_and_tokenizer(args)
     # get dataset
     train_loader, test_loader = get_dataset_loader(tokenizer, **vars(args))
+    if is_distributed():
+        # every worker calibrates on its share of the batches, the statistics of a layer are summed on its owner;
+        # the perplexity is only evaluated by rank 0
+        train_loader = shard_batches(train_loader)
+        if get_rank() != 0:
+            test_loader = None
 
     if test_loader:
         message = "Evaluating original model's ppl"
@@ -83,7 +104,9 @@ def main(args):
     else:
         args.collapse = int(args.collapse)
 
-    model = partial_rope(model, tokenizer, train_loader, test_loader, **vars(args))
+    # with --shared-calibration, partial_rope leaves layer 0's rope-removed qkv outputs here for low_rank_qkv
+    calibration = {}
+    model = partial_rope(model, tokenizer, train_loader, test_loader, calibration=calibration, **vars(args))
     if args.freqfold == "auto":
         args.freqfold = model[1]
         model = model[0]
@@ -95,11 +118,41 @@ def main(args):
     print("LoraQKV Model".center(60))
     print("="*60 + "\n")
 
-    model = low_rank_qkv(model, tokenizer, train_loader, test_loader, **vars(args))
+    writer = None
+    on_layer_done = None
+    if args.stream_save or is_distributed():
+        # each layer is written as soon as low_rank_qkv finalizes it, overlapping with the remaining layers;
+        # with several workers, each one writes the layers it owns to its own shards
+        shard_prefix = f"model-rank{get_rank():05d}" if is_distributed() else "model"
+        writer = StreamingSafetensorsWriter(args.save_path, args.max_shard_size, args.save_workers, shard_prefix)
+        def on_layer_done(layer_idx, layer):
+            if owns_layer(layer_idx):
+                writer.add({f"model.layers.{layer_idx}.{name}": tensor for name, tensor in layer.state_dict().items()})
+
+    model = low_rank_qkv(model, tokenizer, train_loader, test_loader, calibration=calibration, on_layer_done=on_layer_done, **vars(args))
+
+    if test_loader and args.ppl_eval_stride > 0:
+        input_ids = test_loader.dataset.input_ids.reshape(1, -1)
+        message = f"Evaluating lora-qkv model's sliding-window ppl, stride={args.ppl_eval_stride}"
+        dataset_ppl, _, _ = evaluate_sliding_ppl(model, input_ids, test_loader.dataset.input_ids.shape[-1], args.ppl_eval_stride, message=message)
+        print(f'Low rank approximate QKV sliding-window ppl, stride={args.ppl_eval_stride}: {dataset_ppl:.4f}')
 
     # save model
     print(f"\nSaving model and tokenizer to {args.save_path}...")
-    model.save_pretrained(os.path.join(args.save_path))
+    if writer is not None:
+        if get_rank() == 0:
+            save_remaining(model, writer, exclude=("model.layers.",) if is_distributed() else ())
+        weight_map = writer.close()
+        if is_distributed():
+            shards = all_gather_object((weight_map, writer.total_size))
+            if get_rank() != 0:
+                return
+            write_index(args.save_path, {k: v for worker_map, _ in shards for k, v in worker_map.items()}, sum(size for _, size in shards))
+        model.config.save_pretrained(args.save_path)
+        if model.can_generate():
+            model.generation_config.save_pretrained(args.save_path)
+    else:
+        model.save_pretrained(os.path.join(args.save_path), max_shard_size=args.max_shard_size)
     tokenizer.save_pretrained(os.path.join(args.save_path))
 
     # modify config
@@ -119,13 +172,26 @@ if __name__ == "__main__":
     parser.add_argument("--cal-max-seqlen", type=int, default=256, help="Maximum sequence length for the calibration data.")
     parser.add_argument("--seed", type=int, default=42, help="Seed for sampling the calibration data.")
     parser.add_argument("--ppl-eval-batch-size", type=int, default=2, help="Batch size for evaluating the perplexity.")
+    parser.add_argument("--ppl-eval-stride", type=int, default=0, help="Stride for an extra, approximate sliding-window ppl of the final model that reuses the overlap's KV cache (only the first window is exact), 0 to disable.")
     parser.add_argument("--freqfold", type=str, default="auto", help="Freqfold for removing RoPE, int or auto")
     parser.add_argument("--collapse", type=str, default="auto", help="Collapse for removing RoPE, int or auto")
     parser.add_argument("--qk-mqa-dim", type=int, default=64, help="")
     parser.add_argument("--q-lora-rank", type=int, help="")
     parser.add_argument("--kv-lora-rank", type=int, default=512, help="")
+    parser.add_argument("--kv-cache-budget", type=int, default=None, help="KV cache bytes per token over all layers; assigns a kv_lora_rank to every layer from the calibration spectra instead of --kv-lora-rank.")
+    parser.add_argument("--kv-rank-multiple", type=int, default=64, help="Granularity of the per-layer kv_lora_rank with --kv-cache-budget.")
     parser.add_argument("--balance-kv-ratio", type=float, default=1, help="")
     parser.add_argument("--use-qkv-norm", action='store_true', default=False, help="")
+    parser.add_argument("--shared-calibration", action='store_true', default=False, help="Derive layer 0's rope-removed qkv outputs and rmsnorm statistics from the first calibration pass, where they are exact; the later layers, whose inputs change with the conversion, are recalibrated.")
+    parser.add_argument("--stream-save", action='store_true', default=False, help="Write every layer to safetensors shards as soon as it is converted.")
+    parser.add_argument("--max-shard-size", type=str, default="5GB", help="Maximum size of a safetensors shard.")
+    parser.add_argument("--save-workers", type=int, default=1, help="Number of threads writing shards with --stream-save.")
+    parser.add_argument("--distributed", action='store_true', default=False, help="Convert with the workers started by torchrun (gloo): calibration batches are split between them, every worker builds and writes the layers it owns.")
+    parser.add_argument("--export-absorbed", action='store_true', default=False, help="Also save the absorbed per-head projections (W_UK^T·W_q, W_o·W_UV) for serving from the latent cache.")
+    parser.add_argument("--weight-bits", type=int, choices=[4, 8], default=None, help="Quantize q_a/q_b/kv_a/kv_b projections to int8 or int4 weights.")
+    parser.add_argument("--weight-group-size", type=int, default=128, help="Number of input columns sharing one scale with --weight-bits.")
+    parser.add_argument("--kv-cache-quant", type=str, choices=["int8", "fp8"], default=None, help="Store the kv latent of the absorbed cache in int8 / emulated fp8, requires --export-absorbed.")
+    parser.add_argument("--kv-cache-group-size", type=int, default=64, help="Number of latent channels sharing one scale per token with --kv-cache-quant, lowered per layer to the largest size dividing its kv_lora_rank.")
     parser.add_argument("--deepseek-style", action='store_true', default=False, help="Use deepseek style modeling / configuration files from transformers.")
     args = parser.parse_args()
 
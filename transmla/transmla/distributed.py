@@ -0,0 +1,103 @@
+import os
+from datetime import timedelta
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed() -> None:
+    """
+    Join the process group set up by `torchrun` (RANK / WORLD_SIZE / MASTER_ADDR in the environment).
+    The gloo backend runs on plain CPU processes, on one host or on several hosts of a local network.
+    """
+    if not dist.is_initialized():
+        # generous timeout: the other workers wait at the next collective while rank 0 evaluates perplexity
+        dist.init_process_group("gloo", timeout=timedelta(hours=6))
+    # the workers of one host share its cores
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", "1"))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def all_reduce_sum(tensor: torch.Tensor) -> torch.Tensor:
+    """Sum `tensor` over all workers, a no-op in a single process. gloo reduces on the CPU."""
+    if not is_distributed():
+        return tensor
+    reduced = tensor.cpu()
+    dist.all_reduce(reduced)
+    return reduced.to(tensor.device)
+
+
+def reduce_sum(tensor: torch.Tensor, dst: int) -> torch.Tensor:
+    """Sum `tensor` over all workers into worker `dst`, the others get back a partial sum. A no-op in a single process."""
+    if not is_distributed():
+        return tensor
+    reduced = tensor.cpu()
+    dist.reduce(reduced, dst)
+    return reduced.to(tensor.device)
+
+
+def shard_batches(loader) -> list:
+    """The calibration batches of this worker: every world_size-th batch, starting at its rank."""
+    rank, world_size = get_rank(), get_world_size()
+    batches = [batch for idx, batch in enumerate(loader) if idx % world_size == rank]
+    assert batches, f"worker {rank} got no calibration batch, use at least {world_size} batches"
+    return batches
+
+
+def layer_owner(layer_idx: int) -> int:
+    """Layers are dealt round-robin, the owner of a layer builds it and writes its weights."""
+    return layer_idx % get_world_size()
+
+
+def owns_layer(layer_idx: int) -> bool:
+    return layer_owner(layer_idx) == get_rank()
+
+
+def share_layers(objects: list, dst: int | None = None) -> list:
+    """
+    Send `objects[i]` from the owner of layer i to every worker, or only to worker `dst`, e.g. the converted
+    attention modules when the next calibration pass runs the whole model. The list is updated in place.
+    """
+    if not is_distributed():
+        return objects
+    for layer_idx in range(len(objects)):
+        src = layer_owner(layer_idx)
+        if dst is None:
+            box = [objects[layer_idx]]
+            dist.broadcast_object_list(box, src)
+            objects[layer_idx] = box[0]
+        elif src != dst and get_rank() == src:
+            dist.send_object_list([objects[layer_idx]], dst)
+        elif src != dst and get_rank() == dst:
+            box = [None]
+            dist.recv_object_list(box, src)
+            objects[layer_idx] = box[0]
+    return objects
+
+
+def share_self_attns(model, dst: int | None = None) -> None:
+    """`share_layers` for the attention modules of `model`, which are replaced by the received ones."""
+    layers = model.model.layers
+    self_attns = share_layers([layer.self_attn for layer in layers], dst)
+    for layer, self_attn in zip(layers, self_attns):
+        layer.self_attn = self_attn
+
+
+def all_gather_object(obj) -> list:
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
@@ -1,11 +1,15 @@
+import math
 import torch
 import torch.nn as nn
+from tqdm import tqdm
 from typing import Optional, Tuple
 
 from transformers.modeling_utils import ALL_ATTENTION_FUNCTIONS
 from transformers.models.deepseek_v3.modeling_deepseek_v3 import apply_rotary_pos_emb_interleave
 
-from utils import pca_calc, get_qkv_calibrate_outputs, evaluate_ppl, statistics_qkv_rmsnorm
+from utils import pca_calc, gram, eigen_basis, get_qkv_calibrate_outputs, evaluate_ppl, statistics_qkv_rmsnorm
+from quantize import quantize_lora_qkv, fake_quantize_latent
+from distributed import all_reduce_sum, reduce_sum, all_gather_object, is_distributed, get_rank, layer_owner, owns_layer, share_self_attns
 
  
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
@@ -17,6 +21,131 @@ def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
     )
     return hidden_states.reshape(batch, num_key_value_heads * n_rep, slen, head_dim)
 
+def balance_kv_outputs(key_outputs, value_outputs, latent_dim, qk_mqa_dim, balance_kv_ratio=None, ratio=None):
+    """
+    The inputs of the joint kv PCA: the nope part of the key outputs next to the value outputs. With
+    `balance_kv_ratio`, the keys are divided by the ratio of the mean key and value norms (times balance_kv_ratio),
+    or by `ratio` when it is already known.
+    Returns (kv_outputs, ratio).
+    """
+    if ratio is not None:
+        pass
+    elif balance_kv_ratio is not None and is_distributed():
+        # column norms over the calibration tokens of all workers
+        k_outputs_norm = all_reduce_sum(torch.cat([key.reshape(-1, latent_dim)[:,qk_mqa_dim:] for key in key_outputs]).float().pow(2).sum(dim=0)).sqrt().mean()
+        v_outputs_norm = all_reduce_sum(torch.cat([value.reshape(-1, latent_dim)[:,qk_mqa_dim:] for value in value_outputs]).float().pow(2).sum(dim=0)).sqrt().mean()
+        ratio = k_outputs_norm / (v_outputs_norm * balance_kv_ratio)
+    elif balance_kv_ratio is not None:
+        k_outputs_norm = torch.cat([key.reshape(-1, latent_dim)[:,qk_mqa_dim:] for key in key_outputs]).norm(p=2,dim=0).mean()
+        v_outputs_norm = torch.cat([value.reshape(-1, latent_dim)[:,qk_mqa_dim:] for value in value_outputs]).norm(p=2,dim=0).mean()
+        ratio = k_outputs_norm / (v_outputs_norm * balance_kv_ratio)
+    else:
+        ratio = 1
+    kv_outputs = [torch.cat([key_outputs[i][:,:,qk_mqa_dim:] / ratio, value_outputs[i]], dim=-1) for i in range(len(key_outputs))]
+    return kv_outputs, ratio
+
+
+def allocate_kv_lora_ranks(spectra, num_blocks, block_size, min_rank, max_rank):
+    """
+    Split `num_blocks` blocks of `block_size` ranks between the layers, at least `min_rank` and at most `max_rank`
+    per layer, maximizing the sum over layers of the fraction of the kv variance kept by the leading ranks.
+    The eigenvalues are sorted, so every further block of a layer gains less than the one before, and picking the
+    largest gains over all layers is optimal.
+    """
+    assert min_rank % block_size == 0 and max_rank % block_size == 0
+    num_extra = num_blocks - len(spectra) * min_rank // block_size
+    assert num_extra >= 0, f"the budget does not cover kv_lora_rank={min_rank} in every layer"
+    gains = torch.stack([
+        (eigenvalues[min_rank:max_rank] / eigenvalues.sum()).view(-1, block_size).sum(-1)
+        for eigenvalues in spectra
+    ])
+    num_extra = min(num_extra, gains.numel())
+    chosen = torch.zeros(gains.numel(), dtype=torch.long)
+    chosen[gains.flatten().topk(num_extra).indices] = 1
+    return [min_rank + block_size * int(n) for n in chosen.view_as(gains).sum(-1)]
+
+
+def plan_kv_lora_ranks(model, qkv_outputs, pcas, **kwargs):
+    """
+    Per-layer kv_lora_rank for a kv cache budget of `kv_cache_budget` bytes per token (all layers together).
+    A layer caches kv_lora_rank + qk_mqa_dim values per token; with `kv_cache_quant` the latent takes one byte per
+    value plus one scale per `kv_cache_group_size` values.
+    `pcas` holds the `LoraQKV(pca=...)` of every layer, None if not computed yet. The kv PCA of those layers is
+    computed here and kept in `pcas` (leading kv_lora_rank eigenvectors on the CPU, eigenvalues) for LoraQKV not to
+    compute it again. With several workers, the spectra of the other workers' layers are gathered from their owners.
+    """
+    layers = model.model.layers
+    self_attn = layers[0].self_attn
+    qk_mqa_dim, block_size = kwargs["qk_mqa_dim"], kwargs["kv_rank_multiple"]
+    element_size = self_attn.q_proj.weight.element_size()
+    rank_bytes = element_size
+    if kwargs.get("kv_cache_quant"):
+        assert block_size % kwargs["kv_cache_group_size"] == 0
+        rank_bytes = 1 + element_size / kwargs["kv_cache_group_size"]
+    budget_ranks = (kwargs["kv_cache_budget"] - len(layers) * qk_mqa_dim * element_size) / rank_bytes
+    max_rank = (2 * self_attn.latent_dim - qk_mqa_dim) // block_size * block_size
+
+    for layer_idx, layer in enumerate(tqdm(layers, desc="Computing kv spectra")):
+        if pcas[layer_idx] is not None or is_distributed():
+            continue
+        kv_outputs, _ = balance_kv_outputs(
+            qkv_outputs["key"][layer_idx], qkv_outputs["value"][layer_idx],
+            layer.self_attn.latent_dim, qk_mqa_dim, kwargs["balance_kv_ratio"],
+        )
+        R_kv, eigenvalues = pca_calc(kv_outputs, layer.self_attn.k_proj.weight.device, return_eigenvalues=True)
+        pcas[layer_idx] = {"R_kv": R_kv[:, :max_rank].cpu(), "kv_eigenvalues": eigenvalues.cpu()}
+    spectra = [None] * len(layers)
+    owned = {layer_idx: pca["kv_eigenvalues"].cpu() for layer_idx, pca in enumerate(pcas) if pca is not None}
+    for worker_spectra in all_gather_object(owned):
+        for layer_idx, eigenvalues in worker_spectra.items():
+            spectra[layer_idx] = eigenvalues
+    kv_lora_ranks = allocate_kv_lora_ranks(spectra, int(budget_ranks // block_size), block_size, block_size, max_rank)
+    for rank, pca in zip(kv_lora_ranks, pcas):
+        if pca is not None:
+            pca["R_kv"] = pca["R_kv"][:, :rank]
+
+    for layer_idx, (rank, eigenvalues) in enumerate(zip(kv_lora_ranks, spectra)):
+        print(f"layer {layer_idx}: kv_lora_rank={rank}, kept variance {(eigenvalues[:rank].sum() / eigenvalues.sum()).item():.4f}")
+    used = sum(rank * rank_bytes + qk_mqa_dim * element_size for rank in kv_lora_ranks)
+    print(f"kv cache: {used:.0f} bytes per token (budget {kwargs['kv_cache_budget']}), mean kv_lora_rank {sum(kv_lora_ranks) / len(kv_lora_ranks):.1f}")
+    return kv_lora_ranks
+
+
+@torch.no_grad()
+def owned_lora_pca(model, qkv_outputs, **kwargs) -> list:
+    """
+    With several workers: the query and balanced kv Gram matrices of every layer are summed on the worker owning it,
+    which alone runs their eigendecompositions. Returns per layer the `pca` of `LoraQKV`, None for the layers of the
+    other workers.
+    """
+    layers = model.model.layers
+    grams = {}
+    for layer_idx, layer in enumerate(tqdm(layers, desc="Summing qkv Gram matrices")):
+        self_attn = layer.self_attn
+        owner = layer_owner(layer_idx)
+        kv_outputs, ratio = balance_kv_outputs(
+            qkv_outputs["key"][layer_idx], qkv_outputs["value"][layer_idx],
+            self_attn.latent_dim, kwargs["qk_mqa_dim"], kwargs["balance_kv_ratio"],
+        )
+        q_gram = None
+        if kwargs["q_lora_rank"] is not None:
+            q_gram = reduce_sum(gram(qkv_outputs["query"][layer_idx], self_attn.q_proj.weight.device), owner)
+        kv_gram = reduce_sum(gram(kv_outputs, self_attn.k_proj.weight.device), owner)
+        if owner == get_rank():
+            grams[layer_idx] = (ratio, q_gram, kv_gram)
+
+    # the eigendecompositions of the owned layers run without waiting for the other workers
+    pcas = [None] * len(layers)
+    for layer_idx, (ratio, q_gram, kv_gram) in grams.items():
+        self_attn = layers[layer_idx].self_attn
+        pca = {"ratio": ratio}
+        if q_gram is not None:
+            pca["R_q"], pca["q_eigenvalues"] = eigen_basis(q_gram, self_attn.q_proj.weight.device, return_eigenvalues=True)
+        pca["R_kv"], pca["kv_eigenvalues"] = eigen_basis(kv_gram, self_attn.k_proj.weight.device, return_eigenvalues=True)
+        pcas[layer_idx] = pca
+    return pcas
+
+
 class LoraQKV(nn.Module):
     def __init__(
         self, 
@@ -31,7 +160,14 @@ class LoraQKV(nn.Module):
         use_qkv_norm=False, 
         balance_kv_ratio=None, 
         rms_norm_eps=1e-6,
+        derive_norm_stats=False,
+        pca=None,
     ):
+        """
+        `pca` holds what is already known of the calibration: the balance `ratio`, `R_q` / `q_eigenvalues` and
+        `R_kv` / `kv_eigenvalues` (at least the leading ranks), see `plan_kv_lora_ranks` and `owned_lora_pca`.
+        The rest is computed from the q/k/v outputs.
+        """
         super().__init__()
         assert qk_mqa_dim * collapse == self_attn.head_dim
 
@@ -51,6 +187,8 @@ class LoraQKV(nn.Module):
 
         self.attention_function = ALL_ATTENTION_FUNCTIONS["sdpa"]
         self.scaling = (self.head_dim + self.qk_mqa_dim)**(-0.5)
+        # {"dtype": "int8" | "fp8", "group_size": int} once low_rank_qkv enables the quantized latent cache
+        self.kv_cache_quant = None
 
         # -----------------Attributes for the bias-----------------
         q_bias = self_attn.q_proj.bias is not None
@@ -107,27 +245,85 @@ class LoraQKV(nn.Module):
         self.o_proj = self_attn.o_proj
 
         # -----------------apply bkv on the key and value outputs-----------------
+        pca = pca or {}
+        kv_outputs, ratio = balance_kv_outputs(key_outputs, value_outputs, self.latent_dim, self.qk_mqa_dim, balance_kv_ratio, pca.get("ratio"))
         if balance_kv_ratio is not None:
-            k_outputs_norm = torch.cat([key.reshape(-1, self.latent_dim)[:,self.qk_mqa_dim:] for key in key_outputs]).norm(p=2,dim=0).mean()
-            v_outputs_norm = torch.cat([value.reshape(-1, self.latent_dim)[:,self.qk_mqa_dim:] for value in value_outputs]).norm(p=2,dim=0).mean()
-            ratio = k_outputs_norm / (v_outputs_norm * balance_kv_ratio)
             self_attn.k_proj.weight.data[self.qk_mqa_dim:] /= ratio
             if self.attention_bias:
                 self_attn.k_proj.bias.data[self.qk_mqa_dim:] /= ratio
             self_attn.k_up_proj.weight.data[:, self.qk_mqa_dim:] *= ratio
-        else:
-            ratio = 1
-        kv_outputs = [torch.cat([key_outputs[i][:,:,qk_mqa_dim:] / ratio, value_outputs[i]], dim=-1) for i in range(len(key_outputs))]
 
         # -----------------apply pca on the query and key/value outputs-----------------
-        if self.q_lora_rank is not None:
-            R_q = pca_calc(query_outputs, self_attn.q_proj.weight.device)
+        # the eigenvalues are the variances of the rank dimensions, kept for the quantization stage
+        if self.q_lora_rank is not None and "R_q" in pca:
+            R_q, q_eigenvalues = (pca[name].to(self_attn.q_proj.weight.device) for name in ("R_q", "q_eigenvalues"))
+            self.q_rank_energy = q_eigenvalues[:self.q_lora_rank]
+        elif self.q_lora_rank is not None:
+            R_q, q_eigenvalues = pca_calc(query_outputs, self_attn.q_proj.weight.device, return_eigenvalues=True)
+            self.q_rank_energy = q_eigenvalues[:self.q_lora_rank]
         else:
             R_q = None
-        R_kv = pca_calc(kv_outputs, self_attn.k_proj.weight.device)
+        if "R_kv" in pca:
+            R_kv, kv_eigenvalues = (pca[name].to(self_attn.k_proj.weight.device) for name in ("R_kv", "kv_eigenvalues"))
+        else:
+            R_kv, kv_eigenvalues = pca_calc(kv_outputs, self_attn.k_proj.weight.device, return_eigenvalues=True)
+        self.kv_rank_energy = kv_eigenvalues[:self.kv_lora_rank]
 
         # -----------------initialize the weights / bias-----------------
         self._init_weights(self_attn, R_q, R_kv)
+
+        # -----------------rmsnorm statistics without another calibration pass-----------------
+        if use_qkv_norm and derive_norm_stats:
+            q_bias = self_attn.q_proj.bias.data if self.attention_bias else None
+            q_a_outputs, kv_a_outputs = self.lora_outputs(query_outputs, key_outputs, kv_outputs, q_bias, R_q, R_kv)
+            statistics_qkv_rmsnorm(self, q_a_outputs, kv_a_outputs)
+
+    @torch.no_grad()
+    def export_absorbed(self):
+        """
+        Add the per-head absorbed projections used by the latent-cache path of MLAAttention:
+        q_absorbed_proj = W_UK^T·W_q (nope part of q_b_proj / q_proj, into the kv latent space) and
+        o_absorbed_proj = W_o·W_UV (from the kv latent space straight to hidden states).
+        Both are computed in float64 and then cast.
+        """
+        q_proj = self.q_proj if self.q_lora_rank is None else self.q_b_proj
+        kv_b_weight = self.kv_b_proj.weight.data.to(torch.float64).view(self.num_attention_heads, 2 * self.head_dim, self.kv_lora_rank)
+        k_b_weight, v_b_weight = kv_b_weight.split([self.head_dim, self.head_dim], dim=1)
+        q_weight = q_proj.weight.data.to(torch.float64).view(self.num_attention_heads, self.head_dim + self.qk_mqa_dim, -1)[:, :self.head_dim]
+
+        self.q_absorbed_proj = nn.Linear(q_weight.shape[-1], self.num_attention_heads * self.kv_lora_rank, bias=self.attention_bias, device=q_proj.weight.device, dtype=self.dtype)
+        self.q_absorbed_proj.weight.data = torch.einsum("hdr,hdD->hrD", k_b_weight, q_weight).reshape(-1, q_weight.shape[-1]).to(self.dtype).contiguous()
+        if self.attention_bias:
+            q_bias = q_proj.bias.data.to(torch.float64).view(self.num_attention_heads, self.head_dim + self.qk_mqa_dim)[:, :self.head_dim]
+            self.q_absorbed_proj.bias.data = torch.einsum("hdr,hd->hr", k_b_weight, q_bias).flatten().to(self.dtype).contiguous()
+
+        o_weight = self.o_proj.weight.data.to(torch.float64).view(-1, self.num_attention_heads, self.head_dim)
+        self.o_absorbed_proj = nn.Linear(self.num_attention_heads * self.kv_lora_rank, o_weight.shape[0], bias=False, device=self.o_proj.weight.device, dtype=self.dtype)
+        self.o_absorbed_proj.weight.data = torch.einsum("Dhd,hdr->Dhr", o_weight, v_b_weight).reshape(o_weight.shape[0], -1).to(self.dtype).contiguous()
+
+    @torch.no_grad()
+    def lora_outputs(self, query_outputs, key_outputs, kv_outputs, q_bias, R_q, R_kv):
+        """
+        The q_a_proj / kv_a_proj_with_mqa outputs on the calibration inputs, derived from the q/k/v outputs.
+        Both projections are the PCA bases applied to the original projections, so this is exact per token for the
+        same layer input, i.e. for layer 0 whose inputs are the embeddings in every model.
+        """
+        q_a_outputs = None
+        if self.q_lora_rank is not None:
+            R = R_q[:, :self.q_lora_rank]
+            q_a_outputs = []
+            for q in query_outputs:
+                q = q.double().to(R.device)
+                if q_bias is not None:
+                    q = q - q_bias.double().to(R.device)
+                q_a_outputs.append(q.matmul(R).to(self.dtype))
+        R = R_kv[:, :self.kv_lora_rank]
+        kv_a_outputs = []
+        for key, kv in zip(key_outputs, kv_outputs):
+            kv_a_nope = kv.double().to(R.device).matmul(R)
+            k_rope = key[:, :, :self.qk_mqa_dim].double().to(R.device)
+            kv_a_outputs.append(torch.cat([kv_a_nope, k_rope], dim=-1).to(self.dtype))
+        return q_a_outputs, kv_a_outputs
         
     def _init_weights(self, self_attn, R_q, R_kv):
         # 0. Split the weights of k_proj and v_proj into rope / nope parts.
@@ -254,10 +450,17 @@ class LoraQKV(nn.Module):
 
         if hasattr(self, "kv_a_layernorm"):
             kv_nope = self.kv_a_layernorm(kv_nope)
+        if self.kv_cache_quant is not None:
+            # what the absorbed MLAAttention reads back from its quantized latent cache
+            kv_nope = fake_quantize_latent(kv_nope, **self.kv_cache_quant)
         kv_nope = self.kv_b_proj(kv_nope).view(bsz, q_len, self.num_attention_heads, self.head_dim * 2).transpose(1, 2)
         k_nope, value_states = kv_nope.split([self.head_dim, self.head_dim],dim=-1)
         key_states = torch.cat([k_nope, repeat_kv(k_rope, self.num_attention_heads)], dim=-1)
 
+        if past_key_value is not None:
+            cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}  # Specific to RoPE models
+            key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
+
         attn_output, attn_weights = self.attention_function(
             self,
             query_states,
@@ -277,10 +480,42 @@ class LoraQKV(nn.Module):
 
 def low_rank_qkv(model, tokenizer, train_loader, test_loader, **kwargs):
 
-    message = "Calibrating rope-removed model's qkv outputs"
-    rm_rope_qkv_outputs = get_qkv_calibrate_outputs(model, train_loader, message)
+    num_layers = len(model.model.layers)
+    calibration = kwargs.get("calibration") or {}
+    # with shared calibration, partial_rope derived the qkv outputs of the layers whose inputs are unchanged
+    derived = calibration.pop("qkv_outputs", None) or {"query": {}, "key": {}, "value": {}}
+    exact_layers = set(derived["key"])
+    if len(exact_layers) < num_layers:
+        message = "Calibrating rope-removed model's qkv outputs"
+        layers = [idx for idx in range(num_layers) if idx not in exact_layers]
+        rm_rope_qkv_outputs = get_qkv_calibrate_outputs(model, train_loader, message, layers=layers)
+    else:
+        rm_rope_qkv_outputs = {"query": {}, "key": {}, "value": {}}
+    for name in ["query", "key", "value"]:
+        rm_rope_qkv_outputs[name].update(derived[name])
+    distributed = is_distributed()
+    # the rmsnorm statistics of these layers are derived too, still exact since their inputs are unchanged in the
+    # converted model; with several workers, a layer is only built on its owner and the statistics are collective
+    derived_norm_layers = set() if distributed else exact_layers
+    # called once a layer's weights are final, e.g. to stream it to disk
+    on_layer_done = kwargs.get("on_layer_done")
+    norm_pass_layers = [idx for idx in range(num_layers) if idx not in derived_norm_layers] if kwargs["use_qkv_norm"] else []
+
+    def finish_layer(layer_idx, layer):
+        # quantize last: the absorbed projections and the rmsnorm statistics use the full precision weights
+        if kwargs.get("weight_bits"):
+            quantize_lora_qkv(layer.self_attn, kwargs["weight_bits"], kwargs["weight_group_size"])
+        if on_layer_done is not None:
+            on_layer_done(layer_idx, layer)
+
+    kv_lora_ranks = [kwargs["kv_lora_rank"]] * num_layers
+    pcas = owned_lora_pca(model, rm_rope_qkv_outputs, **kwargs) if distributed else [None] * num_layers
+    if kwargs.get("kv_cache_budget"):
+        kv_lora_ranks = plan_kv_lora_ranks(model, rm_rope_qkv_outputs, pcas, **kwargs)
 
     for layer_idx, layer in enumerate(model.model.layers):
+        if distributed and not owns_layer(layer_idx):
+            continue
         setattr(layer, "self_attn", LoraQKV(
             layer.self_attn,
             rm_rope_qkv_outputs["query"][layer_idx], 
@@ -289,24 +524,61 @@ def low_rank_qkv(model, tokenizer, train_loader, test_loader, **kwargs):
             q_lora_rank=kwargs["q_lora_rank"], 
             qk_mqa_dim=kwargs["qk_mqa_dim"], 
             collapse=kwargs["collapse"],
-            kv_lora_rank=kwargs["kv_lora_rank"],
+            kv_lora_rank=kv_lora_ranks[layer_idx],
             use_qkv_norm=kwargs["use_qkv_norm"],
             balance_kv_ratio=kwargs["balance_kv_ratio"],
             rms_norm_eps=model.config.rms_norm_eps,
+            derive_norm_stats=layer_idx in derived_norm_layers,
+            pca=pcas[layer_idx],
         ))
+        if kwargs.get("export_absorbed"):
+            layer.self_attn.export_absorbed()
+        if not norm_pass_layers:
+            finish_layer(layer_idx, layer)
+    if distributed:
+        # the norm pass runs every layer on every worker, otherwise only rank 0 needs them
+        share_self_attns(model, dst=None if norm_pass_layers else 0)
     
-    if kwargs["use_qkv_norm"]:
-        lora_qkv_outputs = get_qkv_calibrate_outputs(model, train_loader)
+    if norm_pass_layers:
+        # the pass runs with the initial (unit) layernorm weights everywhere, as without shared calibration, so the
+        # statistics of the later layers do not depend on which ones were derived
+        derived_norms = [
+            norm for idx in derived_norm_layers
+            for norm in (getattr(model.model.layers[idx].self_attn, "q_a_layernorm", None), model.model.layers[idx].self_attn.kv_a_layernorm)
+            if norm is not None
+        ]
+        derived_weights = [norm.weight.data for norm in derived_norms]
+        for norm in derived_norms:
+            norm.weight.data = torch.ones_like(norm.weight.data)
+        lora_qkv_outputs = get_qkv_calibrate_outputs(model, train_loader, layers=norm_pass_layers)
+        for norm, weight in zip(derived_norms, derived_weights):
+            norm.weight.data = weight
         for layer_idx, layer in enumerate(model.model.layers):
-            statistics_qkv_rmsnorm(
-                layer.self_attn, 
-                lora_qkv_outputs["q_a_proj"][layer_idx] if len(lora_qkv_outputs["q_a_proj"]) > layer_idx else None, 
-                lora_qkv_outputs["kv_a_proj"][layer_idx]
-            )
+            if layer_idx in norm_pass_layers:
+                # summed over all workers: every worker takes part for every layer
+                statistics_qkv_rmsnorm(
+                    layer.self_attn, 
+                    lora_qkv_outputs["q_a_proj"].get(layer_idx), 
+                    lora_qkv_outputs["kv_a_proj"][layer_idx]
+                )
+            if not distributed or owns_layer(layer_idx):
+                finish_layer(layer_idx, layer)
+        if distributed:
+            share_self_attns(model, dst=0)
 
     if test_loader:
         message = "Evaluating lora-qkv model's ppl"
         dataset_ppl = evaluate_ppl(model, tokenizer.pad_token_id, test_loader, message)
         print(f'Low rank approximate QKV ppl: {dataset_ppl:.4f}')
+
+    if kwargs.get("kv_cache_quant"):
+        for layer in model.model.layers:
+            # the largest group size up to kv_cache_group_size that divides the layer's kv_lora_rank, as for the weights
+            group_size = math.gcd(kwargs["kv_cache_group_size"], layer.self_attn.kv_lora_rank)
+            layer.self_attn.kv_cache_quant = {"dtype": kwargs["kv_cache_quant"], "group_size": group_size}
+        if test_loader:
+            message = f"Evaluating lora-qkv model's ppl with a {kwargs['kv_cache_quant']} latent kv cache"
+            dataset_ppl = evaluate_ppl(model, tokenizer.pad_token_id, test_loader, message)
+            print(f'Low rank approximate QKV ppl, {kwargs["kv_cache_quant"]} latent kv cache: {dataset_ppl:.4f}')
     
     return model
\ No newline at end of file
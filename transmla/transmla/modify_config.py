@@ -51,6 +51,8 @@ transformers_dirs = {
 transformers_dirs["qwen2"] = transformers_dirs["llama"]
 transformers_dirs["mistral"] = transformers_dirs["llama"]
 mla_dir = "transmla/transformers/mla.py"
+# imported by mla.py
+quantize_dir = "transmla/quantize.py"
 
 
 
@@ -72,9 +74,25 @@ def modify_config(model, config_path: str, args):
     config["qk_rope_head_dim"] = config["head_dim"] = args.qk_mqa_dim
     config["qk_nope_head_dim"] = config["v_head_dim"] = model.model.layers[0].self_attn.head_dim
     config["q_lora_rank"] = args.q_lora_rank
-    config["kv_lora_rank"] = args.kv_lora_rank
+    kv_lora_ranks = [layer.self_attn.kv_lora_rank for layer in model.model.layers]
+    config["kv_lora_rank"] = max(kv_lora_ranks)
+    # per-layer ranks from --kv-cache-budget; the vLLM model pads every layer's latent to kv_lora_rank
+    config["kv_lora_ranks"] = kv_lora_ranks if len(set(kv_lora_ranks)) > 1 else None
 
     config["qk_latent_layernorm"] = hasattr(model.model.layers[0].self_attn, "kv_a_layernorm")
+    # only mla.py serves from the latent cache, the deepseek-style modeling files ignore these weights
+    config["absorbed_weights"] = hasattr(model.model.layers[0].self_attn, "q_absorbed_proj") and not args.deepseek_style
+    # the group sizes follow each layer's ranks, so they are recorded per layer
+    weight_quants = [getattr(layer.self_attn, "weight_quant", None) for layer in model.model.layers]
+    config["weight_quant"] = {
+        "bits": weight_quants[0]["bits"],
+        "group_sizes": [weight_quant["group_sizes"] for weight_quant in weight_quants],
+    } if weight_quants[0] else None
+    kv_cache_quants = [getattr(layer.self_attn, "kv_cache_quant", None) for layer in model.model.layers]
+    config["kv_cache_quant"] = {
+        "dtype": kv_cache_quants[0]["dtype"],
+        "group_sizes": [kv_cache_quant["group_size"] for kv_cache_quant in kv_cache_quants],
+    } if kv_cache_quants[0] else None
 
     with open(config_path, "w") as f:
         json.dump(config, f, indent=4)
@@ -84,4 +102,5 @@ def modify_config(model, config_path: str, args):
     for item in os.listdir(transformers_dir):
         source_path = os.path.join(transformers_dir, item)
         shutil.copy(source_path, args.save_path)
-    shutil.copy(mla_dir, args.save_path)
\ No newline at end of file
+    shutil.copy(mla_dir, args.save_path)
+    shutil.copy(quantize_dir, args.save_path)
\ No newline at end of file
@@ -5,6 +5,7 @@ from typing import Optional, Tuple
 from transformers.modeling_utils import ALL_ATTENTION_FUNCTIONS
 
 from utils import get_qkv_calibrate_outputs, evaluate_ppl
+from distributed import all_reduce_sum, reduce_sum, is_distributed, layer_owner, owns_layer, share_self_attns
 
 def rotate_half(x, group):
     rotate_x = []
@@ -44,8 +45,29 @@ def apply_rotary_pos_emb(q, k, cos, sin, rope_head=1):
     k_embed = torch.cat([k_rope_embed, k_nope], dim=-1)
     return q_embed, k_embed
 
+@torch.no_grad()
+def key_grams(Z: list[torch.Tensor], num_key_value_heads: int, head_dim: int, freqfold: int, collapse: int, device) -> list[torch.Tensor]:
+    """The Gram matrices of the joint complex PCA, one per frequency group, over the key outputs `Z` held by this worker."""
+    grams = []
+    for i in range(head_dim//2//freqfold):
+        H = None
+        for Z_batch in Z:
+            b,n,d = Z_batch.shape
+            head_batch = deepcopy(Z_batch).view(b,n, num_key_value_heads, 2, head_dim//2//freqfold, freqfold//collapse, collapse)
+            head_batch = head_batch.permute(0, 1, 3, 6, 2, 5, 4)
+            head_batch = head_batch.reshape(b,n*2, num_key_value_heads*freqfold, head_dim//2//freqfold)
+            head_batch_i = head_batch[:,:,:,i].double().to(device)
+            head_batch_i = torch.sum(head_batch_i.mT @ head_batch_i, dim=0)  # sum over the batch dimension.
+            H = head_batch_i if H is None else H + head_batch_i
+        grams.append(H)
+    return grams
+
 class PartialRope(nn.Module):
-    def __init__(self, self_attn, key_outputs=None, freqfold=1, rope_head=1, collapse=1):
+    """
+    With `key_outputs`, k_proj is rotated by the joint complex PCA of the key outputs. With `grams` (see `key_grams`),
+    already summed over the workers, it is rotated by their PCA instead.
+    """
+    def __init__(self, self_attn, key_outputs=None, freqfold=1, rope_head=1, collapse=1, grams=None):
         super().__init__()
         self.config = self_attn.config
         self.layer_idx = self_attn.layer_idx
@@ -67,9 +89,14 @@ class PartialRope(nn.Module):
         self.o_proj = self_attn.o_proj
         self._insert_kv_up_proj()
         if key_outputs is not None:
-            Rk = self.joint_complex_pca(key_outputs, freqfold)
+            grams = [all_reduce_sum(H) for H in key_grams(key_outputs, self.num_key_value_heads, self.head_dim, freqfold, self.collapse, self.k_proj.weight.device)]
+        if grams is not None:
+            Rk = self.joint_complex_pca(grams)
             self.rotate_k_proj(Rk, freqfold=freqfold)
             self.rotate_k_up_proj(Rk, freqfold=freqfold)
+            # kept so that the calibrated key outputs can be rotated the same way, see `rotate_k_outputs`
+            self.Rk = Rk
+            self.freqfold = freqfold
             
     def _insert_kv_up_proj(self):
         self.k_up_proj = nn.Linear(self.latent_dim, self.hidden_size, bias=False, dtype=self.k_proj.weight.dtype, device=self.k_proj.weight.device)
@@ -83,19 +110,10 @@ class PartialRope(nn.Module):
         self.v_up_proj.weight.data = torch.stack([v_up_eye]*kv_groups,dim=1).reshape(-1, self.latent_dim).contiguous()
 
     @torch.no_grad()
-    def joint_complex_pca(self, Z: list[torch.Tensor], freqfold: int = 1) -> torch.Tensor:
+    def joint_complex_pca(self, grams: list[torch.Tensor]) -> torch.Tensor:
         dtype = self.k_proj.weight.dtype
         eigen_vecs = []
-        for i in range(self.head_dim//2//freqfold):
-            H = None
-            for Z_batch in Z:
-                b,n,d = Z_batch.shape
-                head_batch = deepcopy(Z_batch).view(b,n, self.num_key_value_heads, 2, self.head_dim//2//freqfold, freqfold//self.collapse, self.collapse)
-                head_batch = head_batch.permute(0, 1, 3, 6, 2, 5, 4)
-                head_batch = head_batch.reshape(b,n*2, self.num_key_value_heads*freqfold, self.head_dim//2//freqfold)
-                head_batch_i = head_batch[:,:,:,i].double().to(self.k_proj.weight.device)
-                head_batch_i = torch.sum(head_batch_i.mT @ head_batch_i, dim=0)  # sum over the batch dimension.
-                H = head_batch_i if H is None else H + head_batch_i
+        for H in grams:
             damp = 0.01 * torch.mean(torch.diag(H))
             diag = torch.arange(H.shape[-1]).to(self.k_proj.weight.device)
             H[diag, diag] = H[diag, diag] + damp
@@ -105,19 +123,23 @@ class PartialRope(nn.Module):
             eigen_vecs.append(X_eig[1][:, index])
         return torch.stack(eigen_vecs+eigen_vecs).to(dtype)
 
-    def rotate_k_proj(self, U, freqfold=1):
-        k_weight = deepcopy(self.k_proj.weight.data)
-        U = U.to(k_weight.dtype).to(k_weight.device)
-        if self.k_proj.bias is not None:
-            k_bias = deepcopy(self.k_proj.bias.data)
-            k_weight = torch.cat([k_weight, k_bias.unsqueeze(1)], dim=1)
+    def _rotate_k_rows(self, k_weight, U, freqfold=1):
+        """Rotate the rows ([latent_dim, ...]) of k_proj, or of its outputs, returning [num_key_value_heads, head_dim, ...]."""
         k_weight = k_weight.reshape(self.num_key_value_heads, self.head_dim//freqfold, freqfold//self.collapse, self.collapse, -1)
         k_weight = k_weight.permute(3, 0, 2, 1, 4).reshape(self.num_key_value_heads*freqfold, self.head_dim//freqfold, -1)
         k_weight = torch.einsum("dhc,hdD->cdD", U, k_weight)
 
         # premute the dimensions to align with deepseek's implementation
         k_weight = k_weight.reshape(self.collapse, self.num_key_value_heads, freqfold//self.collapse, 2, self.head_dim//freqfold // 2, -1)
-        k_weight = k_weight.permute(0, 1, 4, 2, 3, 5).reshape(self.num_key_value_heads, self.head_dim, -1)
+        return k_weight.permute(0, 1, 4, 2, 3, 5).reshape(self.num_key_value_heads, self.head_dim, -1)
+
+    def rotate_k_proj(self, U, freqfold=1):
+        k_weight = deepcopy(self.k_proj.weight.data)
+        U = U.to(k_weight.dtype).to(k_weight.device)
+        if self.k_proj.bias is not None:
+            k_bias = deepcopy(self.k_proj.bias.data)
+            k_weight = torch.cat([k_weight, k_bias.unsqueeze(1)], dim=1)
+        k_weight = self._rotate_k_rows(k_weight, U, freqfold)
 
         if self.k_proj.bias is not None:
             k_bias = k_weight[:, :, -1]
@@ -138,6 +160,21 @@ class PartialRope(nn.Module):
         k_up_weight = k_up_weight.permute(0, 1, 2, 5, 3, 4).reshape(-1, self.latent_dim)
 
         self.k_up_proj.weight.data = k_up_weight.contiguous()
+
+    @torch.no_grad()
+    def rotate_k_outputs(self, Z: list[torch.Tensor]) -> list[torch.Tensor]:
+        """
+        The outputs the rotated k_proj gives on the inputs that produced `Z` (outputs of the original k_proj).
+        k_proj is rotated row-wise with its bias, so this is exact per token.
+        """
+        U = self.Rk.double()
+        rotated = []
+        for Z_batch in Z:
+            b, n, d = Z_batch.shape
+            k = Z_batch.reshape(-1, d).T.double().to(U.device)
+            k = self._rotate_k_rows(k, U, self.freqfold).reshape(d, b * n).T
+            rotated.append(k.reshape(b, n, d).to(device=Z_batch.device, dtype=Z_batch.dtype))
+        return rotated
   
     def forward(
         self,
@@ -193,6 +230,26 @@ class PartialRope(nn.Module):
 
 
 
+def distributed_partial_rope(model, ori_qkv_outputs, freqfold: int, collapse):
+    """
+    With several workers: the key Gram matrices of every layer are summed on the worker owning it, which alone builds
+    its PartialRope. The built layers are then sent to every worker, since the next calibration pass runs them all.
+    """
+    layers = model.model.layers
+    grams = {}
+    for layer_idx, layer in enumerate(layers):
+        self_attn = layer.self_attn
+        head_dim = self_attn.head_dim
+        local = key_grams(ori_qkv_outputs["key"][layer_idx], self_attn.config.num_key_value_heads, head_dim, freqfold, collapse, self_attn.k_proj.weight.device)
+        local = [reduce_sum(H, layer_owner(layer_idx)) for H in local]
+        if owns_layer(layer_idx):
+            grams[layer_idx] = local
+    # the eigendecompositions and rotations of the owned layers run without waiting for the other workers
+    for layer_idx, layer_grams in grams.items():
+        layers[layer_idx].self_attn = PartialRope(layers[layer_idx].self_attn, freqfold=freqfold, collapse=collapse, grams=layer_grams)
+    share_self_attns(model)
+    return model
+
 def partial_rope(model, tokenizer, train_loader, test_loader, **kwargs):
 
     freqfold = kwargs["freqfold"]
@@ -202,13 +259,16 @@ def partial_rope(model, tokenizer, train_loader, test_loader, **kwargs):
     ori_qkv_outputs = get_qkv_calibrate_outputs(model, train_loader, message)
 
     def partial_rope_freqfold(model, ori_qkv_outputs, test_loader, freqfold: int, collapse):
-        for layer_idx, layer in enumerate(model.model.layers):
-            setattr(layer, "self_attn", PartialRope(
-                layer.self_attn, 
-                ori_qkv_outputs["key"][layer_idx], 
-                freqfold=freqfold,
-                collapse=collapse,
-            ))
+        if is_distributed():
+            distributed_partial_rope(model, ori_qkv_outputs, freqfold, collapse)
+        else:
+            for layer_idx, layer in enumerate(model.model.layers):
+                setattr(layer, "self_attn", PartialRope(
+                    layer.self_attn, 
+                    ori_qkv_outputs["key"][layer_idx], 
+                    freqfold=freqfold,
+                    collapse=collapse,
+                ))
             
         if test_loader:
             message = f"Evaluating partial-rope model's ppl, freqfold={freqfold}"
@@ -220,7 +280,8 @@ def partial_rope(model, tokenizer, train_loader, test_loader, **kwargs):
 
     if freqfold != "auto":
         freqfold = int(freqfold)
-        return partial_rope_freqfold(model, ori_qkv_outputs, test_loader, freqfold, collapse)[0]
+        model = partial_rope_freqfold(model, ori_qkv_outputs, test_loader, freqfold, collapse)[0]
+        best_freqfold = None
     else:
         assert test_loader is not None, "test_loader is required for auto freqfold detection"
         device = model.device
@@ -247,4 +308,22 @@ def partial_rope(model, tokenizer, train_loader, test_loader, **kwargs):
 
         print(f"Best freqfold: {best_freqfold}")
 
-        return model, best_freqfold
+    if kwargs.get("shared_calibration") and kwargs.get("calibration") is not None:
+        if all(0 in ori_qkv_outputs[name] for name in ["query", "key", "value"]):
+            # q_proj and v_proj are untouched and k_proj is only rotated, and layer 0 gets the same inputs (the
+            # embeddings) in both models: its rope-removed qkv outputs are exact, low_rank_qkv recalibrates the others
+            print("Shared calibration: deriving layer 0's rope-removed qkv outputs from the original model.")
+            kwargs["calibration"]["qkv_outputs"] = {
+                "query": {0: ori_qkv_outputs["query"][0]},
+                "key": {0: model.model.layers[0].self_attn.rotate_k_outputs(ori_qkv_outputs["key"][0])},
+                "value": {0: ori_qkv_outputs["value"][0]},
+            }
+        else:
+            print("Shared calibration needs layer 0's q/k/v outputs, low_rank_qkv will recalibrate.")
+    for layer in model.model.layers:
+        if hasattr(layer.self_attn, "Rk"):
+            del layer.self_attn.Rk
+
+    if best_freqfold is None:
+        return model
+    return model, best_freqfold
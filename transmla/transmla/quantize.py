@@ -0,0 +1,174 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# clipping ratios tried for every (row, group) scale
+CLIP_GRID = (1.0, 0.95, 0.9, 0.85, 0.8, 0.75, 0.7)
+
+
+def pack_int4(q: torch.Tensor) -> torch.Tensor:
+    """Pack pairs of int4 values ([-8, 7]) along the last dim into uint8."""
+    q = q.to(torch.uint8) & 0xF
+    return q[..., 0::2] | (q[..., 1::2] << 4)
+
+
+def unpack_int4(packed: torch.Tensor) -> torch.Tensor:
+    low = (packed & 0xF).to(torch.int8)
+    high = (packed >> 4).to(torch.int8)
+    q = torch.stack([low, high], dim=-1).flatten(-2)
+    # sign-extend the 4-bit values
+    return (q ^ 8) - 8
+
+
+def quantize_weight(weight: torch.Tensor, bits: int = 8, group_size: int = 128, channel_energy: torch.Tensor | None = None):
+    """
+    Symmetric weight-only quantization with one scale per (output row, group of `group_size` input columns).
+
+    For every scale the clipping ratio in `CLIP_GRID` with the smallest error is kept. The error of input column j is
+    weighted by `channel_energy[j]`, the mean squared activation of that input, so that clipping is decided where the
+    calibration data puts its variance. Returns (qweight, scales), qweight is int8, packed two per uint8 for 4 bits.
+    """
+    out_features, in_features = weight.shape
+    assert in_features % group_size == 0, f"in_features ({in_features}) must be divisible by group_size ({group_size})"
+    qmax = 2 ** (bits - 1) - 1
+    w = weight.to(torch.float32).view(out_features, in_features // group_size, group_size)
+    if channel_energy is None:
+        energy = torch.ones(group_size * w.shape[1], device=w.device)
+    else:
+        energy = channel_energy.to(device=w.device, dtype=torch.float32)
+    energy = energy.view(1, -1, group_size)
+
+    absmax = w.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8)
+    best_scale, best_err = None, None
+    for clip in CLIP_GRID:
+        scale = absmax * clip / qmax
+        q = (w / scale).round().clamp(-qmax - 1, qmax)
+        err = ((q * scale - w).pow(2) * energy).sum(dim=-1, keepdim=True)
+        if best_err is None:
+            best_scale, best_err = scale, err
+        else:
+            better = err < best_err
+            best_scale = torch.where(better, scale, best_scale)
+            best_err = torch.where(better, err, best_err)
+
+    q = (w / best_scale).round().clamp(-qmax - 1, qmax).to(torch.int8).view(out_features, in_features)
+    if bits == 4:
+        q = pack_int4(q)
+    return q, best_scale.squeeze(-1)
+
+
+class QuantLinear(nn.Module):
+    """
+    Linear layer with int8 / int4 weights and per-group scales, dequantized block by block in forward.
+
+    Only `chunk_size` output rows are dequantized at a time, so the weights stream from memory at 1 (or 0.5) bytes
+    per value and the dequantized block stays in cache, which is what bounds CPU decoding.
+    """
+
+    def __init__(self, in_features, out_features, bias=False, bits=8, group_size=128, chunk_size=1024, device=None, dtype=None):
+        super().__init__()
+        assert bits in (4, 8), f"bits ({bits}) must be 4 or 8"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        self.chunk_size = chunk_size
+        packed_features = in_features // 2 if bits == 4 else in_features
+        self.register_buffer("qweight", torch.zeros(out_features, packed_features, dtype=torch.uint8 if bits == 4 else torch.int8, device=device))
+        self.register_buffer("scales", torch.ones(out_features, in_features // group_size, dtype=dtype, device=device))
+        if bias:
+            self.bias = nn.Parameter(torch.zeros(out_features, dtype=dtype, device=device))
+        else:
+            self.register_parameter("bias", None)
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear: nn.Linear, bits=8, group_size=128, channel_energy=None):
+        weight = linear.weight.data
+        module = cls(linear.in_features, linear.out_features, linear.bias is not None, bits, group_size, device=weight.device, dtype=weight.dtype)
+        qweight, scales = quantize_weight(weight, bits, group_size, channel_energy)
+        module.qweight.copy_(qweight)
+        module.scales.copy_(scales)
+        if linear.bias is not None:
+            module.bias.data.copy_(linear.bias.data)
+        return module
+
+    def dequantize(self, start: int = 0, end: int | None = None, dtype=None) -> torch.Tensor:
+        q = self.qweight[start:end]
+        if self.bits == 4:
+            q = unpack_int4(q)
+        scales = self.scales[start:end]
+        dtype = dtype or scales.dtype
+        w = q.to(dtype).view(q.shape[0], -1, self.group_size) * scales.to(dtype).unsqueeze(-1)
+        return w.view(q.shape[0], self.in_features)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.chunk_size >= self.out_features:
+            return F.linear(x, self.dequantize(dtype=x.dtype), self.bias)
+        out = x.new_empty(*x.shape[:-1], self.out_features)
+        for start in range(0, self.out_features, self.chunk_size):
+            end = min(start + self.chunk_size, self.out_features)
+            out[..., start:end] = F.linear(x, self.dequantize(start, end, dtype=x.dtype))
+        if self.bias is not None:
+            out += self.bias
+        return out
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, group_size={self.group_size}"
+
+
+@torch.no_grad()
+def quantize_lora_qkv(self_attn, bits: int = 8, group_size: int = 128) -> None:
+    """
+    Replace q_a_proj / q_b_proj / kv_a_proj_with_mqa / kv_b_proj of a LoraQKV layer by QuantLinear.
+
+    The inputs of q_b_proj and kv_b_proj are PCA coordinates, so their groups are ranges of consecutive ranks, and
+    the calibrated eigenvalues (`q_rank_energy`, `kv_rank_energy`) weight the clipping search. The rows of q_a_proj
+    and kv_a_proj_with_mqa are the ranks themselves and get one set of scales each.
+    Every projection uses the largest group size up to `group_size` that divides its inputs, so with per-layer
+    ranks (e.g. a kv_lora_rank of 192 or 320 and a group size of 128) the groups of kv_b_proj differ between layers.
+    """
+    names = ["kv_a_proj_with_mqa", "kv_b_proj"]
+    energies = {"kv_b_proj": getattr(self_attn, "kv_rank_energy", None)}
+    if self_attn.q_lora_rank is not None:
+        names += ["q_a_proj", "q_b_proj"]
+        energies["q_b_proj"] = getattr(self_attn, "q_rank_energy", None)
+    group_sizes = {name: math.gcd(group_size, getattr(self_attn, name).in_features) for name in names}
+    for name, module_group_size in group_sizes.items():
+        setattr(self_attn, name, QuantLinear.from_linear(getattr(self_attn, name), bits, module_group_size, energies.get(name)))
+    # recorded in the config by modify_config, so that MLAAttention builds the same modules
+    self_attn.weight_quant = {"bits": bits, "group_sizes": group_sizes}
+
+
+# code dtype and largest code of the latent kv cache formats; fp8 is emulated by rounding through float8_e4m3fn
+KV_CACHE_DTYPES = {"int8": (torch.int8, 127.0), "fp8": (torch.float8_e4m3fn, 448.0)}
+
+
+def quantize_latent(latent: torch.Tensor, dtype: str = "int8", group_size: int = 64):
+    """
+    Quantize the compressed kv `latent` [..., kv_lora_rank] with one scale per token and group of `group_size`
+    channels. R_kv orders the channels by variance, so the trailing groups get their own, much smaller scales.
+    Returns (codes, scales), the scales have the dtype of `latent`.
+    """
+    code_dtype, qmax = KV_CACHE_DTYPES[dtype]
+    x = latent.float().unflatten(-1, (-1, group_size))
+    scales = (x.abs().amax(dim=-1) / qmax).clamp(min=1e-8).to(latent.dtype)
+    x = (x / scales.float().unsqueeze(-1)).clamp(-qmax, qmax)
+    if code_dtype == torch.int8:
+        x = x.round()
+    return x.to(code_dtype).flatten(-2), scales
+
+
+def dequantize_latent(codes: torch.Tensor, scales: torch.Tensor, dtype=None) -> torch.Tensor:
+    dtype = dtype or scales.dtype
+    x = codes.to(dtype).unflatten(-1, (scales.shape[-1], -1)) * scales.to(dtype).unsqueeze(-1)
+    return x.flatten(-2)
+
+
+def fake_quantize_latent(latent: torch.Tensor, dtype: str = "int8", group_size: int = 64) -> torch.Tensor:
+    """The latent as attention sees it when read back from a quantized cache."""
+    codes, scales = quantize_latent(latent, dtype, group_size)
+    return dequantize_latent(codes, scales, latent.dtype)
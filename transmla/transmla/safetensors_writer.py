@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from safetensors.torch import save_file
+
+
+def parse_size(size) -> int:
+    """Parse a shard size such as 5GB / 500MB / an int number of bytes."""
+    if isinstance(size, int):
+        return size
+    size = size.strip().upper()
+    for unit, scale in [("GB", 1000 ** 3), ("MB", 1000 ** 2), ("KB", 1000)]:
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * scale)
+    return int(size)
+
+
+class StreamingSafetensorsWriter:
+    """
+    Writes a state dict to safetensors shards while it is still being produced.
+
+    Tensors handed to `add` are copied to the CPU and grouped into shards of at most `max_shard_size` bytes.
+    Every full shard is written by one of `num_writers` background threads, so saving overlaps with whatever
+    the caller does next, and at most `num_writers` shards wait in memory. `close` names the shards like
+    `save_pretrained` (model-00001-of-0000N.safetensors) and writes model.safetensors.index.json. With another
+    `shard_prefix` (one per worker of a distributed conversion) the shards are named <shard_prefix>-0000i.safetensors
+    and the caller writes the index of all workers with `write_index`.
+    """
+
+    def __init__(self, save_dir: str, max_shard_size="5GB", num_writers: int = 1, shard_prefix: str = "model"):
+        self.save_dir = save_dir
+        self.shard_prefix = shard_prefix
+        self.max_shard_size = parse_size(max_shard_size)
+        self.executor = ThreadPoolExecutor(max_workers=num_writers)
+        self.slots = threading.Semaphore(num_writers)
+        self.futures = []
+        self.shard = {}
+        self.shard_size = 0
+        self.shard_names = []
+        self.weight_map = {}
+        self.total_size = 0
+        os.makedirs(save_dir, exist_ok=True)
+
+    def add(self, state_dict: dict[str, torch.Tensor]) -> None:
+        for name, tensor in state_dict.items():
+            assert name not in self.weight_map, f"{name} was already written"
+            nbytes = tensor.numel() * tensor.element_size()
+            if self.shard and self.shard_size + nbytes > self.max_shard_size:
+                self._submit()
+            # own copy, so the tensor may change or be freed once this returns
+            self.shard[name] = tensor.detach().to("cpu", copy=True).contiguous()
+            self.shard_size += nbytes
+            self.total_size += nbytes
+            self.weight_map[name] = len(self.shard_names)
+
+    def _submit(self) -> None:
+        shard, path = self.shard, os.path.join(self.save_dir, f"{self.shard_prefix}-{len(self.shard_names) + 1:05d}.safetensors.tmp")
+        self.shard_names.append(path)
+        self.shard, self.shard_size = {}, 0
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._write, shard, path))
+
+    def _write(self, shard: dict, path: str) -> None:
+        try:
+            save_file(shard, path, metadata={"format": "pt"})
+        finally:
+            self.slots.release()
+
+    def close(self) -> dict[str, str]:
+        """Wait for the writers and rename the shards, returns the weight map (tensor name -> shard file)."""
+        if self.shard:
+            self._submit()
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+
+        num_shards = len(self.shard_names)
+        if self.shard_prefix != "model":
+            names = [os.path.basename(tmp)[:-len(".tmp")] for tmp in self.shard_names]
+        elif num_shards == 1:
+            names = ["model.safetensors"]
+        else:
+            names = [f"model-{i + 1:05d}-of-{num_shards:05d}.safetensors" for i in range(num_shards)]
+        for tmp, name in zip(self.shard_names, names):
+            os.replace(tmp, os.path.join(self.save_dir, name))
+        weight_map = {key: names[shard] for key, shard in self.weight_map.items()}
+        if self.shard_prefix == "model" and num_shards > 1:
+            write_index(self.save_dir, weight_map, self.total_size)
+        return weight_map
+
+
+def write_index(save_dir: str, weight_map: dict[str, str], total_size: int) -> None:
+    index = {
+        "metadata": {"total_size": total_size},
+        "weight_map": dict(sorted(weight_map.items())),
+    }
+    with open(os.path.join(save_dir, "model.safetensors.index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+
+
+def save_remaining(model, writer: StreamingSafetensorsWriter, exclude: tuple[str, ...] = ()) -> None:
+    """
+    Add the parameters of `model` not written yet (embeddings, final norm, lm_head), skipping tied weights and
+    names starting with one of `exclude` (the layers other workers write).
+    """
+    embed_ptr = model.get_input_embeddings().weight.data_ptr()
+    remaining = {}
+    for name, tensor in model.state_dict().items():
+        if name in writer.weight_map or name.startswith(exclude):
+            continue
+        if name == "lm_head.weight" and tensor.data_ptr() == embed_ptr:
+            continue
+        remaining[name] = tensor
+    writer.add(remaining)
@@ -12,6 +12,10 @@ class LlamaMLAConfig(LlamaConfig):
         qk_nope_head_dim=128,
         v_head_dim=128,
         qk_latent_layernorm=True,
+        absorbed_weights=False,
+        weight_quant=None,
+        kv_cache_quant=None,
+        kv_lora_ranks=None,
         **kwargs
     ):
         super().__init__(*args, **kwargs)
@@ -22,4 +26,8 @@ class LlamaMLAConfig(LlamaConfig):
         self.qk_nope_head_dim = qk_nope_head_dim
         self.qk_head_dim = qk_rope_head_dim + qk_nope_head_dim
         self.v_head_dim = v_head_dim
-        self.qk_latent_layernorm = qk_latent_layernorm
\ No newline at end of file
+        self.qk_latent_layernorm = qk_latent_layernorm
+        self.absorbed_weights = absorbed_weights
+        self.weight_quant = weight_quant
+        self.kv_cache_quant = kv_cache_quant
+        self.kv_lora_ranks = kv_lora_ranks
\ No newline at end of file
@@ -12,6 +12,10 @@ class MixtralMLAConfig(MixtralConfig):
         qk_nope_head_dim=128,
         v_head_dim=128,
         attention_bias=False,
+        absorbed_weights=False,
+        weight_quant=None,
+        kv_cache_quant=None,
+        kv_lora_ranks=None,
         **kwargs
     ):
         super().__init__(*args, **kwargs)
@@ -22,4 +26,8 @@ class MixtralMLAConfig(MixtralConfig):
         self.qk_nope_head_dim = qk_nope_head_dim
         self.qk_head_dim = qk_rope_head_dim + qk_nope_head_dim
         self.v_head_dim = v_head_dim
-        self.attention_bias = attention_bias
\ No newline at end of file
+        self.attention_bias = attention_bias
+        self.absorbed_weights = absorbed_weights
+        self.weight_quant = weight_quant
+        self.kv_cache_quant = kv_cache_quant
+        self.kv_lora_ranks = kv_lora_ranks
\ No newline at end of file
@@ -18,6 +18,9 @@ from transformers.models.deepseek_v3.modeling_deepseek_v3 import (
     DeepseekV3RMSNorm
 )
 
+# copied next to this file by modify_config: the int8 / int4 weights and the latent kv cache use the converter's code
+from .quantize import QuantLinear, quantize_latent, dequantize_latent
+
 
 class MLAAttention(nn.Module):
     """
@@ -35,7 +38,8 @@ class MLAAttention(nn.Module):
         self.num_heads = config.num_attention_heads
         self.rope_theta = config.rope_theta
         self.q_lora_rank = config.q_lora_rank
-        self.kv_lora_rank = config.kv_lora_rank
+        kv_lora_ranks = getattr(config, "kv_lora_ranks", None)
+        self.kv_lora_rank = kv_lora_ranks[layer_idx] if kv_lora_ranks else config.kv_lora_rank
         self.qk_rope_head_dim = config.qk_rope_head_dim
         self.qk_nope_head_dim = config.qk_nope_head_dim
         self.v_head_dim = config.v_head_dim
@@ -71,6 +75,31 @@ class MLAAttention(nn.Module):
             bias=False,
         )
 
+        # Checkpoints exported with --export-absorbed carry W_UK^T·W_q and W_o·W_UV per head, so attention runs
+        # against the cached latent (kv_lora_rank + qk_rope_head_dim per token) without decompressing it.
+        self.absorbed_weights = getattr(config, "absorbed_weights", False)
+        if self.absorbed_weights:
+            q_input_dim = config.hidden_size if self.q_lora_rank is None else self.q_lora_rank
+            self.q_absorbed_proj = nn.Linear(q_input_dim, self.num_heads * self.kv_lora_rank, bias=config.attention_bias)
+            self.o_absorbed_proj = nn.Linear(self.num_heads * self.kv_lora_rank, config.hidden_size, bias=False)
+
+        # The absorbed forward can keep the cached latent as int8 / fp8 codes, the rope part stays unquantized.
+        # The group sizes divide each layer's kv_lora_rank, so they are recorded per layer.
+        kv_cache_quant = getattr(config, "kv_cache_quant", None)
+        self.kv_cache_quant = {
+            "dtype": kv_cache_quant["dtype"], "group_size": kv_cache_quant["group_sizes"][layer_idx]
+        } if kv_cache_quant else None
+        assert not self.kv_cache_quant or self.absorbed_weights, "kv_cache_quant requires absorbed_weights"
+
+        # Checkpoints converted with --weight-bits store these projections as int8 / int4 weights, with per-layer group sizes.
+        weight_quant = getattr(config, "weight_quant", None)
+        if weight_quant:
+            for name, group_size in weight_quant["group_sizes"][layer_idx].items():
+                linear = getattr(self, name)
+                setattr(self, name, QuantLinear(
+                    linear.in_features, linear.out_features, linear.bias is not None, weight_quant["bits"], group_size
+                ))
+
         self.scaling = self.qk_head_dim**-0.5
 
     def forward(
@@ -82,6 +111,9 @@ class MLAAttention(nn.Module):
         cache_position: Optional[torch.LongTensor] = None,
         **kwargs: Unpack[FlashAttentionKwargs],
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        if self.absorbed_weights:
+            return self.absorbed_forward(hidden_states, position_embeddings, attention_mask, past_key_value, cache_position, **kwargs)
+
         batch_size, seq_length = hidden_states.shape[:-1]
         query_shape = (batch_size, seq_length, -1, self.qk_head_dim)
         key_shape = (batch_size, seq_length, -1, self.qk_nope_head_dim + self.v_head_dim)
@@ -147,3 +179,91 @@ class MLAAttention(nn.Module):
         attn_output = attn_output.reshape(batch_size, seq_length, -1).contiguous()
         attn_output = self.o_proj(attn_output)
         return attn_output, attn_weights
+
+    def absorbed_forward(
+        self,
+        hidden_states: torch.Tensor,
+        position_embeddings: Tuple[torch.Tensor, torch.Tensor],
+        attention_mask: Optional[torch.Tensor],
+        past_key_value: Optional[Cache] = None,
+        cache_position: Optional[torch.LongTensor] = None,
+        **kwargs: Unpack[FlashAttentionKwargs],
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Attention in the kv latent space: q_nope·W_UK·c becomes (W_UK^T·W_q·x)·c and the output W_o·W_UV·(attn·c),
+        so the cache holds the normalized latent c and k_rot of every token instead of per-head keys and values.
+        """
+        batch_size, seq_length = hidden_states.shape[:-1]
+
+        if self.q_lora_rank is None:
+            q_proj, q_input = self.q_proj, hidden_states
+        elif self.qk_latent_layernorm:
+            q_proj, q_input = self.q_b_proj, self.q_a_layernorm(self.q_a_proj(hidden_states))
+        else:
+            q_proj, q_input = self.q_b_proj, self.q_a_proj(hidden_states)
+        # only the rope rows of q_proj / q_b_proj are needed, the nope rows are absorbed into q_absorbed_proj
+        q_weight = q_proj.dequantize(dtype=q_input.dtype) if isinstance(q_proj, QuantLinear) else q_proj.weight
+        q_rot_weight = q_weight.view(self.num_heads, self.qk_head_dim, -1)[:, self.qk_nope_head_dim:]
+        q_rot_bias = None
+        if q_proj.bias is not None:
+            q_rot_bias = q_proj.bias.view(self.num_heads, self.qk_head_dim)[:, self.qk_nope_head_dim:].flatten()
+        q_rot = F.linear(q_input, q_rot_weight.flatten(0, 1), q_rot_bias)
+        q_rot = q_rot.view(batch_size, seq_length, self.num_heads, self.qk_rope_head_dim).transpose(1, 2)
+        q_latent = self.q_absorbed_proj(q_input).view(batch_size, seq_length, self.num_heads, self.kv_lora_rank).transpose(1, 2)
+
+        compressed_kv = self.kv_a_proj_with_mqa(hidden_states)
+        k_pass, k_rot = torch.split(compressed_kv, [self.kv_lora_rank, self.qk_rope_head_dim], dim=-1)
+        if self.qk_latent_layernorm:
+            k_pass = self.kv_a_layernorm(k_pass)
+        k_pass = k_pass.view(batch_size, 1, seq_length, self.kv_lora_rank)
+        k_rot = k_rot.view(batch_size, 1, seq_length, self.qk_rope_head_dim)
+
+        cos, sin = position_embeddings
+        q_rot, k_rot = apply_rotary_pos_emb_interleave(q_rot, k_rot, cos, sin)
+
+        query_states = torch.cat((q_latent, q_rot), dim=-1)
+        cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
+        if self.kv_cache_quant:
+            # the cache holds the latent codes as keys and [k_rot, scales] as values
+            codes, scales = quantize_latent(k_pass, **self.kv_cache_quant)
+            # fp8 codes go through the cache as raw bytes, caches only concatenate tensors of one dtype
+            code_dtype = codes.dtype
+            codes = codes.view(torch.int8)
+            rot_and_scales = torch.cat((k_rot, scales), dim=-1)
+            if past_key_value is not None:
+                codes, rot_and_scales = past_key_value.update(codes, rot_and_scales, self.layer_idx, cache_kwargs)
+            k_rot, scales = torch.split(rot_and_scales, [self.qk_rope_head_dim, scales.shape[-1]], dim=-1)
+            value_states = dequantize_latent(codes.view(code_dtype), scales, query_states.dtype)
+            key_states = torch.cat((value_states, k_rot), dim=-1)
+        else:
+            key_states = torch.cat((k_pass, k_rot), dim=-1)
+            value_states = k_pass
+            if past_key_value is not None:
+                key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
+
+        # one latent head shared by all query heads
+        key_states = key_states.expand(batch_size, self.num_heads, -1, -1)
+        value_states = value_states.expand(batch_size, self.num_heads, -1, -1)
+        if self.config._attn_implementation == "flash_attention_2":
+            value_states = F.pad(value_states, [0, self.qk_rope_head_dim])
+
+        attention_interface = eager_attention_forward
+        if self.config._attn_implementation != "eager" and not kwargs.get("output_attentions", False):
+            attention_interface = ALL_ATTENTION_FUNCTIONS[self.config._attn_implementation]
+
+        attn_output, attn_weights = attention_interface(
+            self,
+            query_states,
+            key_states,
+            value_states,
+            attention_mask,
+            dropout=0.0 if not self.training else self.attention_dropout,
+            scaling=self.scaling,
+            softcap=getattr(self.config, "attn_logit_softcapping", None),
+            **kwargs,
+        )
+        if self.config._attn_implementation == "flash_attention_2":
+            attn_output = attn_output[:, :, :, : self.kv_lora_rank]
+        attn_output = attn_output.reshape(batch_size, seq_length, -1).contiguous()
+        attn_output = self.o_absorbed_proj(attn_output)
+        return attn_output, attn_weights
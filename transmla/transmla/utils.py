@@ -1,4 +1,6 @@
 import logging
+import queue
+import threading
 import time
 import torch
 import datasets
@@ -7,6 +9,8 @@ from transformers import PreTrainedTokenizerBase
 from tqdm import tqdm
 import logging
 
+from distributed import all_reduce_sum, is_distributed
+
 def get_dataset(name: str) -> datasets.DatasetDict:
     """
     Get the dataset from the HuggingFace datasets library.
@@ -187,20 +191,180 @@ def sync_gpus() -> None:
     for i in range(torch.cuda.device_count()):
         torch.cuda.synchronize(device=i)
         
-def map_tensors(obj, device: torch.device | str | None = None, dtype: torch.dtype | None = None):
+def map_tensors(obj, device: torch.device | str | None = None, dtype: torch.dtype | None = None, non_blocking: bool = False):
     """Recursively map tensors to device and dtype."""
     if isinstance(obj, torch.Tensor):
         if device is not None:
-            obj = obj.to(device=device)
+            obj = obj.to(device=device, non_blocking=non_blocking)
         if dtype is not None:
             obj = obj.to(dtype=dtype)
         return obj
     elif isinstance(obj, (list, tuple)):
-        return type(obj)(map_tensors(x, device, dtype) for x in obj)
+        return type(obj)(map_tensors(x, device, dtype, non_blocking) for x in obj)
     elif isinstance(obj, dict):
-        return {k: map_tensors(v, device, dtype) for k, v in obj.items()}  # type: ignore
+        return {k: map_tensors(v, device, dtype, non_blocking) for k, v in obj.items()}  # type: ignore
     else:
         return obj
+
+def prefetch_batches(loader, device: torch.device | str):
+    """
+    Yield the batches of `loader` on `device`. On CUDA the next batch is pinned and copied on a side stream
+    while the current one is being computed, instead of a blocking copy at the start of every step.
+    A copy of this function (and of `map_tensors`) lives in clover/src/pca_calc.py, make fixes in both.
+    """
+    device = torch.device(device)
+    if device.type != "cuda":
+        for batch in loader:
+            yield map_tensors(batch, device)
+        return
+
+    stream = torch.cuda.Stream(device)
+    pending = None
+    for batch in loader:
+        batch = {k: v.pin_memory() if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+        with torch.cuda.stream(stream):
+            batch = map_tensors(batch, device, non_blocking=True)
+        if pending is not None:
+            yield pending
+        torch.cuda.current_stream(device).wait_stream(stream)
+        for v in batch.values():
+            if isinstance(v, torch.Tensor):
+                v.record_stream(torch.cuda.current_stream(device))
+        pending = batch
+    if pending is not None:
+        yield pending
+
+class ActivationOffloader:
+    """
+    Hands activations captured by forward hooks to a consumer without stalling the forward pass.
+
+    On CUDA every activation is copied into a pinned host staging buffer on a side stream with `non_blocking=True`,
+    and a background thread waits for the copy before calling `consume(host_tensor)`, so the consumer folds
+    statistics or writes to disk while the next layers / batch compute. At most `max_inflight` copies are
+    pending, and the staging buffers are handed back to a pool once consumed, so at most `max_inflight + 1`
+    pinned buffers are ever allocated.
+    On CPU there is nothing to transfer: `consume` is called inline on the activation itself.
+
+    The staging buffer is reused as soon as `consume` returns; consumers that keep it must use `keep`.
+    Consumers run in submission order, on a single thread.
+
+    A copy of this class lives in clover/src/pca_calc.py, make fixes in both.
+    """
+    def __init__(self, device: torch.device | str, max_inflight: int = 64):
+        self.async_copy = torch.device(device).type == "cuda"
+        self.streams = {}
+        self.staging = queue.SimpleQueue()
+        self.error = None
+        if self.async_copy:
+            self.queue = queue.Queue(maxsize=max_inflight)
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    @staticmethod
+    def keep(x: torch.Tensor) -> torch.Tensor:
+        """Copy `x` out of the staging buffer, if it is one; the only copy made for a kept activation."""
+        return x.clone() if x.is_pinned() else x
+
+    def _staging_buffer(self, tensor: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """A recycled pinned buffer of at least the size of `tensor`, and a view of it with its shape and dtype."""
+        nbytes = tensor.numel() * tensor.element_size()
+        try:
+            buffer = self.staging.get_nowait()
+        except queue.Empty:
+            buffer = None
+        if buffer is None or buffer.numel() < nbytes:
+            # the packed activations vary in length, a too small buffer is replaced by a larger one
+            buffer = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+        return buffer, buffer[:nbytes].view(tensor.dtype).view(tensor.shape)
+
+    def submit(self, tensor: torch.Tensor, consume) -> None:
+        tensor = tensor.detach()
+        if not self.async_copy or tensor.device.type != "cuda":
+            consume(tensor)
+            return
+        if self.error is not None:
+            raise self.error
+
+        if tensor.device not in self.streams:
+            self.streams[tensor.device] = torch.cuda.Stream(tensor.device)
+        stream = self.streams[tensor.device]
+        stream.wait_stream(torch.cuda.current_stream(tensor.device))
+        with torch.cuda.stream(stream):
+            buffer, host = self._staging_buffer(tensor)
+            host.copy_(tensor, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(stream)
+        tensor.record_stream(stream)
+        self.queue.put((buffer, host, event, consume))
+
+    def _worker(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            buffer, host, event, consume = item
+            # the copy must be done before the buffer is recycled, even once a consumer has failed
+            event.synchronize()
+            try:
+                if self.error is None:
+                    consume(host)
+            except BaseException as e:
+                self.error = e
+            self.staging.put(buffer)
+
+    def close(self) -> None:
+        """Wait until every submitted activation has been consumed."""
+        if self.async_copy:
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+def valid_token_index(attention_mask: torch.Tensor | None) -> torch.Tensor | None:
+    """Flat positions of the real tokens of a batch, computed once per batch and shared by all hooks."""
+    if attention_mask is None:
+        return None
+    return attention_mask.flatten().nonzero().squeeze(-1)
+
+def pack_tokens(x: torch.Tensor, index: torch.Tensor | None) -> torch.Tensor:
+    """Drop the padded positions of a [batch, seq, dim] activation, returning a [1, tokens, dim] tensor."""
+    if index is None:
+        return x
+    return x.reshape(-1, x.shape[-1]).index_select(0, index.to(x.device)).unsqueeze(0)
+
+def count_valid_tokens(outputs: dict) -> dict:
+    """Number of captured tokens per layer."""
+    return {
+        index: value.tokens if isinstance(value, RunningRMSNorm) else sum(x.shape[0] * x.shape[1] for x in value)
+        for index, value in outputs.items()
+    }
+
+class RunningRMSNorm:
+    """Running mean of the inverse rms of the activations folded into it, all `statistics_qkv_rmsnorm` needs of them."""
+    def __init__(self, eps: float):
+        self.eps = eps
+        self.total = torch.zeros(2, dtype=torch.float64)
+        self.tokens = 0
+        self.dtype = None
+
+    def add(self, x: torch.Tensor) -> None:
+        inv_rms = torch.rsqrt(x.reshape(-1, x.shape[-1]).pow(2).mean(-1) + self.eps)
+        self.total += torch.stack([inv_rms.double().sum().cpu(), torch.tensor(inv_rms.numel(), dtype=torch.float64)])
+        self.tokens += inv_rms.numel()
+        self.dtype = x.dtype
+
+    def mean(self) -> torch.Tensor:
+        """The mean over the calibration tokens of all workers."""
+        total = all_reduce_sum(self.total.clone())
+        return (total[0] / total[1]).to(self.dtype)
+
+def append_to(outputs: dict, index):
+    """Consumer that appends activations to `outputs[index]`."""
+    def consume(x):
+        if index not in outputs:
+            outputs[index] = []
+        outputs[index].append(ActivationOffloader.keep(x))
+    return consume
     
 @torch.no_grad()
 def evaluate_ppl(
@@ -256,7 +420,115 @@ def evaluate_ppl(
 
     return ppl.item()
 
-def insert_qkv_hooks(model):
+def trim_cache(past_key_values, keep: int):
+    """Keep only the most recent `keep` positions of every layer in a HF cache (DynamicCache or legacy tuple)."""
+    if isinstance(past_key_values, (list, tuple)):
+        return type(past_key_values)(tuple(t[..., -keep:, :] for t in layer) for layer in past_key_values)
+    if hasattr(past_key_values, "layers"):
+        for layer in past_key_values.layers:
+            layer.keys = layer.keys[..., -keep:, :]
+            layer.values = layer.values[..., -keep:, :]
+    else:
+        for idx in range(len(past_key_values.key_cache)):
+            past_key_values.key_cache[idx] = past_key_values.key_cache[idx][..., -keep:, :]
+            past_key_values.value_cache[idx] = past_key_values.value_cache[idx][..., -keep:, :]
+    return past_key_values
+
+@torch.no_grad()
+def evaluate_sliding_ppl(
+    model: torch.nn.Module,
+    input_ids: torch.Tensor,
+    max_length: int = 2048,
+    stride: int = 512,
+    kv_reuse: bool = True,
+    message: str = "Evaluating sliding-window perplexity"
+) -> tuple[float, float, int]:
+    """
+    Strided sliding-window perplexity over one long token stream of shape (1, seq_len).
+    Every token except the first is scored exactly once, with at most `max_length` tokens of context.
+
+    With `kv_reuse` the result is an approximation of the strided perplexity: the overlap between
+    consecutive windows is kept in the KV cache and only the `stride` new tokens are forwarded (at their
+    absolute positions), which cuts the cost by about `max_length / stride`. Cached overlap tokens keep the
+    hidden states they got in the window they were first computed in, rather than being recomputed with the
+    context of the current window, so only the first window's NLL is exact. Without `kv_reuse` every window
+    is recomputed and the result is the exact strided perplexity.
+    The same evaluator (with `trim_cache`) lives in clover/src/pca_calc.py, make fixes in both.
+    """
+    assert 0 < stride <= max_length, f"stride ({stride}) must be in (0, max_length={max_length}]"
+    sync_gpus()
+
+    start_time = time.time()
+
+    model.eval()
+    device = model.model.embed_tokens.weight.device
+    input_ids = input_ids.to(device)
+    seq_len = input_ids.size(1)
+
+    total_nll = torch.zeros((), dtype=torch.float64, device=device)
+    past_key_values = None
+    last_logits = None
+    prev_end = 0
+
+    logging.info(message)
+    for begin in tqdm(range(0, seq_len, stride), desc=message):
+        end = min(begin + max_length, seq_len)
+
+        if kv_reuse and past_key_values is not None and stride < max_length:
+            # forward only the new tokens on top of the trimmed overlap
+            new_ids = input_ids[:, prev_end:end]
+            past_len = prev_end - begin
+            past_key_values = trim_cache(past_key_values, past_len)
+            outputs = model(
+                input_ids=new_ids,
+                position_ids=torch.arange(prev_end, end, device=device).unsqueeze(0),
+                cache_position=torch.arange(past_len, past_len + new_ids.size(1), device=device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            logits = torch.cat([last_logits, outputs.logits[:, :-1]], dim=1)
+            targets = new_ids
+        else:
+            chunk_ids = input_ids[:, begin:end]
+            outputs = model(
+                input_ids=chunk_ids,
+                position_ids=torch.arange(end - begin, device=device).unsqueeze(0),
+                use_cache=kv_reuse,
+            )
+            first_target = max(prev_end, begin + 1)
+            logits = outputs.logits[:, first_target - 1 - begin : end - 1 - begin]
+            targets = input_ids[:, first_target:end]
+
+        total_nll += torch.nn.functional.cross_entropy(
+            logits.reshape(-1, logits.size(-1)).float(), targets.reshape(-1), reduction="sum"
+        ).double()
+
+        if kv_reuse:
+            past_key_values = outputs.past_key_values
+            last_logits = outputs.logits[:, -1:]
+        prev_end = end
+        if end >= seq_len:
+            break
+
+    total_tokens = seq_len - 1
+    avg_nll = total_nll / total_tokens
+    ppl = torch.exp(avg_nll)
+
+    sync_gpus()
+
+    elapsed = time.time() - start_time
+    logging.info(
+        "Time spent on evaluation: %s",
+        time.strftime("%H:%M:%S.{}".format(str(elapsed % 1)[2:])[:13], time.gmtime(elapsed)),
+    )
+
+    return ppl.item(), avg_nll.item(), total_tokens
+
+def insert_qkv_hooks(model, offloader: ActivationOffloader, batch_state: dict, fold_norm_stats: bool = False, layers=None):
+    """
+    With `fold_norm_stats`, the q_a_proj / kv_a_proj_with_mqa outputs of layers with a q_a / kv_a layernorm are folded
+    into a `RunningRMSNorm` per layer instead of being kept. Only the `layers` indices are hooked, all by default.
+    """
     query_hooks = []
     key_hooks = []
     value_hooks = []
@@ -269,31 +541,31 @@ def insert_qkv_hooks(model):
     kv_a_proj_with_mqa_outputs = {}
 
     def query_hook_fn(module, input, output, index):
-        if index not in query_outputs:
-            query_outputs[index] = []
-        query_outputs[index].append(output.to('cpu'))
+        offloader.submit(pack_tokens(output, batch_state.get("index")), append_to(query_outputs, index))
 
     def key_hook_fn(module, input, output, index):
-        if index not in key_outputs:
-            key_outputs[index] = []
-        key_outputs[index].append(output.to('cpu'))
+        offloader.submit(pack_tokens(output, batch_state.get("index")), append_to(key_outputs, index))
         
     def value_hook_fn(module, input, output, index):
-        if index not in value_outputs:
-            value_outputs[index] = []
-        value_outputs[index].append(output.to('cpu'))
+        offloader.submit(pack_tokens(output, batch_state.get("index")), append_to(value_outputs, index))
 
     def q_a_proj_hook_fn(module, input, output, index):
-        if index not in q_a_proj_outputs:
-            q_a_proj_outputs[index] = []
-        q_a_proj_outputs[index].append(output.to('cpu'))
+        offloader.submit(pack_tokens(output, batch_state.get("index")), capture_norm(q_a_proj_outputs, index, "q_a_layernorm"))
 
     def kv_a_proj_with_mqa_hook_fn(module, input, output, index):
-        if index not in kv_a_proj_with_mqa_outputs:
-            kv_a_proj_with_mqa_outputs[index] = []
-        kv_a_proj_with_mqa_outputs[index].append(output.to('cpu'))
+        offloader.submit(pack_tokens(output, batch_state.get("index")), capture_norm(kv_a_proj_with_mqa_outputs, index, "kv_a_layernorm"))
+
+    def capture_norm(outputs, index, norm_name):
+        norm = getattr(model.model.layers[index].self_attn, norm_name, None)
+        if not fold_norm_stats or norm is None:
+            return append_to(outputs, index)
+        if index not in outputs:
+            outputs[index] = RunningRMSNorm(norm.eps)
+        return outputs[index].add
 
     for idx, layer in enumerate(model.model.layers):
+        if layers is not None and idx not in layers:
+            continue
         if hasattr(layer.self_attn, "q_proj"):
             query_hook = layer.self_attn.q_proj.register_forward_hook(lambda module, input, output, idx=idx: query_hook_fn(module, input, output, idx))
             query_hooks.append(query_hook)
@@ -316,22 +588,31 @@ def insert_qkv_hooks(model):
 def get_qkv_calibrate_outputs(
     model: torch.nn.Module, 
     trainloader: DataLoader[dict[str, torch.Tensor]], 
-    message: str = "Calibrating QKV"
+    message: str = "Calibrating QKV",
+    layers=None,
 ):
     """
     Take the input signals ("activations") for a layer, run the layer forward.
+    On CPU, where the activations are consumed inline, the q_a_proj / kv_a_proj outputs are folded into
+    `RunningRMSNorm` statistics instead of being kept. Only the outputs of the `layers` indices are captured, all by
+    default.
     """
 
     start_time = time.time()
 
     model.eval()
-    query_hooks, key_hooks, value_hooks, q_a_proj_hooks, kv_a_proj_with_mqa_hooks, query_outputs, key_outputs, value_outputs, q_a_proj_outputs, kv_a_proj_with_mqa_outputs = insert_qkv_hooks(model)
-    ignore_masks = []
+    device = model.model.embed_tokens.weight.device
+    offloader = ActivationOffloader(device)
+    batch_state = {}
+    query_hooks, key_hooks, value_hooks, q_a_proj_hooks, kv_a_proj_with_mqa_hooks, query_outputs, key_outputs, value_outputs, q_a_proj_outputs, kv_a_proj_with_mqa_outputs = insert_qkv_hooks(
+        model, offloader, batch_state, fold_norm_stats=not offloader.async_copy, layers=layers
+    )
     logging.info(message)
-    for batch in tqdm(trainloader, desc=message):
-        batch = map_tensors(batch, model.model.embed_tokens.weight.device)
-        ignore_masks.append(batch["attention_mask"].to('cpu'))
+    for batch in tqdm(prefetch_batches(trainloader, device), total=len(trainloader), desc=message):
+        # padded positions are packed out by the hooks, so only real tokens are stored
+        batch_state["index"] = valid_token_index(batch.get("attention_mask"))
         model(**batch, use_cache=False)
+    offloader.close()
 
     elapsed = time.time() - start_time
     logging.info(
@@ -350,30 +631,9 @@ def get_qkv_calibrate_outputs(
     for hook in kv_a_proj_with_mqa_hooks:
         hook.remove()
 
-    for value in query_outputs.values():
-        for idx, X_batch in enumerate(value):
-            if ignore_masks:
-                X_batch[ignore_masks[idx] == 0] = 0
-
-    for value in key_outputs.values():
-        for idx, X_batch in enumerate(value):
-            if ignore_masks:
-                X_batch[ignore_masks[idx] == 0] = 0
-
-    for value in value_outputs.values():
-        for idx, X_batch in enumerate(value):
-            if ignore_masks:
-                X_batch[ignore_masks[idx] == 0] = 0
-
-    for value in q_a_proj_outputs.values():
-        for idx, X_batch in enumerate(value):
-            if ignore_masks:
-                X_batch[ignore_masks[idx] == 0] = 0
-
-    for value in kv_a_proj_with_mqa_outputs.values():
-        for idx, X_batch in enumerate(value):
-            if ignore_masks:
-                X_batch[ignore_masks[idx] == 0] = 0
+    valid_tokens = count_valid_tokens(key_outputs or kv_a_proj_with_mqa_outputs)
+    if valid_tokens:
+        logging.info(f"Valid calibration tokens per layer: {min(valid_tokens.values())} - {max(valid_tokens.values())}")
 
     qkv_outputs = {
         "query": query_outputs,
@@ -381,18 +641,29 @@ def get_qkv_calibrate_outputs(
         "value": value_outputs,
         "q_a_proj": q_a_proj_outputs,
         "kv_a_proj": kv_a_proj_with_mqa_outputs,
+        "valid_tokens": valid_tokens,
     }
     return qkv_outputs
 
 @torch.no_grad()
-def pca_calc(X: list[torch.Tensor], device: str) -> torch.Tensor:
+def pca_calc(X: list[torch.Tensor], device: str, return_eigenvalues: bool = False) -> torch.Tensor:
+    # with several workers, each one holds a shard of the calibration batches
+    return eigen_basis(all_reduce_sum(gram(X, device)), device, return_eigenvalues)
+
+@torch.no_grad()
+def gram(X: list[torch.Tensor], device: str) -> torch.Tensor:
+    """Float64 sum of X^T X over the batches of `X` held by this worker."""
     H = None
     for idx, X_batch in enumerate(X):
 
         X_batch = X_batch.double().to(device)
         H_batch = torch.sum(X_batch.mT @ X_batch, dim=0)  # sum over the batch dimension.
         H = H_batch if H is None else H + H_batch
+    return H
 
+@torch.no_grad()
+def eigen_basis(H: torch.Tensor, device: str, return_eigenvalues: bool = False) -> torch.Tensor:
+    """Eigenvectors of the damped Gram matrix `H` (modified in place), by descending eigenvalue."""
     damp = 0.01 * torch.mean(torch.diag(H))
     diag = torch.arange(H.shape[-1]).to(device)
     H[diag, diag] = H[diag, diag] + damp
@@ -400,16 +671,32 @@ def pca_calc(X: list[torch.Tensor], device: str) -> torch.Tensor:
     del H
     index = torch.argsort(X_eig[0], descending=True)
     eigen_vec = X_eig[1][:, index]
+    if return_eigenvalues:
+        return eigen_vec, X_eig[0][index]
     return eigen_vec
 
+def mean_over_workers(x: torch.Tensor) -> torch.Tensor:
+    """Mean of the per-token values `x` over the calibration tokens of all workers."""
+    if not is_distributed():
+        return x.mean()
+    total = all_reduce_sum(torch.stack([x.double().sum(), torch.tensor(x.numel(), dtype=torch.float64, device=x.device)]))
+    return (total[0] / total[1]).to(x.dtype)
+
 def statistics_qkv_rmsnorm(self_attn, q_a_outputs, kv_a_outputs):
+    """The outputs are lists of activations, or `RunningRMSNorm` statistics folded on capture."""
     if q_a_outputs is not None:
         self_attn.q_a_layernorm.weight.data.to(self_attn.q_a_proj.weight.device).to(self_attn.dtype)
-        q_a_proj = torch.cat(q_a_outputs)
-        q_a_rmsnorm = torch.rsqrt(q_a_proj.pow(2).mean(-1) + self_attn.q_a_layernorm.eps).mean()
+        if isinstance(q_a_outputs, RunningRMSNorm):
+            q_a_rmsnorm = q_a_outputs.mean()
+        else:
+            q_a_proj = torch.cat([x.reshape(-1, x.shape[-1]) for x in q_a_outputs])
+            q_a_rmsnorm = mean_over_workers(torch.rsqrt(q_a_proj.pow(2).mean(-1) + self_attn.q_a_layernorm.eps))
         self_attn.q_a_layernorm.weight.data = torch.full_like(self_attn.q_a_layernorm.weight.data, q_a_rmsnorm)
 
     self_attn.kv_a_layernorm.weight.data.to(self_attn.kv_a_proj_with_mqa.weight.device).to(self_attn.dtype)
-    kv_a_proj = torch.cat(kv_a_outputs)
-    kv_a_rmsnorm = torch.rsqrt(kv_a_proj.pow(2).mean(-1) + self_attn.kv_a_layernorm.eps).mean()
+    if isinstance(kv_a_outputs, RunningRMSNorm):
+        kv_a_rmsnorm = kv_a_outputs.mean()
+    else:
+        kv_a_proj = torch.cat([x.reshape(-1, x.shape[-1]) for x in kv_a_outputs])
+        kv_a_rmsnorm = mean_over_workers(torch.rsqrt(kv_a_proj.pow(2).mean(-1) + self_attn.kv_a_layernorm.eps))
     self_attn.kv_a_layernorm.weight.data = torch.full_like(self_attn.kv_a_layernorm.weight.data, kv_a_rmsnorm)
@@ -22,15 +22,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Inference-only DeepseekV2/DeepseekV3 model."""
-from typing import Any, Dict, Iterable, Optional, Set, Tuple, Union
+import glob
+import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import torch
+import torch.nn.functional as F
 from torch import nn
 from transformers import PretrainedConfig
 
+import vllm.envs as envs
 from vllm.attention import Attention
 from vllm.compilation.decorators import support_torch_compile
 from vllm.config import CacheConfig, ModelConfig, VllmConfig
+from vllm.logger import init_logger
 from vllm.distributed import (get_pp_group,
                               get_tensor_model_parallel_world_size,
                               tensor_model_parallel_all_reduce)
@@ -57,6 +68,12 @@ from vllm.model_executor.models.utils import (PPMissingLayer, is_pp_missing_para
                     make_empty_intermediate_tensors_factory, make_layers,
                     maybe_prefix)
 
+logger = init_logger(__name__)
+
+# Number of threads reading the safetensors shards in `load_weights`, 0 keeps
+# the iterator handed in by vLLM.
+WEIGHT_LOAD_THREADS = int(os.environ.get("TRANSMLA_WEIGHT_LOAD_THREADS", "0"))
+
 
 class DeepseekV2MLP(nn.Module):
 
@@ -219,6 +236,7 @@ class DeepseekV2MLAAttention(nn.Module):
 
         self.q_lora_rank = q_lora_rank
         self.kv_lora_rank = kv_lora_rank
+        self.quant_config = quant_config
 
         self.num_heads = num_heads
         tp_size = get_tensor_model_parallel_world_size()
@@ -318,9 +336,50 @@ class DeepseekV2MLAAttention(nn.Module):
             o_proj=self.o_proj,
         )
 
+        # Checkpoints exported with --export-absorbed carry W_UK^T·W_q and
+        # W_o·W_UV per head, computed in float64. They replace the matrices
+        # the MLA backend would otherwise absorb at startup.
+        self.absorbed_weights = getattr(config, "absorbed_weights", False)
+        if self.absorbed_weights:
+            q_input_dim = (self.hidden_size
+                           if self.q_lora_rank is None else self.q_lora_rank)
+            self.q_absorbed_proj = ColumnParallelLinear(
+                q_input_dim,
+                self.num_heads * self.kv_lora_rank,
+                bias=self.attention_bias,
+                prefix=f"{prefix}.q_absorbed_proj")
+            self.o_absorbed_proj = RowParallelLinear(
+                self.num_heads * self.kv_lora_rank,
+                self.hidden_size,
+                bias=False,
+                prefix=f"{prefix}.o_absorbed_proj")
+            impl = self.mla_attn.impl
+            self._absorb_weights = impl.process_weights_after_loading
+            impl.process_weights_after_loading = (
+                self.process_absorbed_weights)
+
         self.prefix = prefix
         self.debug_layer_idx = int(self.prefix.split(".")[-2])
 
+    def process_absorbed_weights(self, act_dtype: torch.dtype) -> None:
+        """
+        Stands in for the MLA backend's `process_weights_after_loading`.
+        The precomputed matrices are used directly when the backend would
+        absorb unquantized weights. Otherwise the backend does its own work.
+        """
+        if (not envs.VLLM_MLA_PERFORM_MATRIX_ABSORPTION
+                or self.quant_config is not None):
+            self._absorb_weights(act_dtype)
+            return
+        impl = self.mla_attn.impl
+        q_proj = self.q_proj if self.q_lora_rank is None else self.q_b_proj
+        q_proj_weight = q_proj.weight.T.view(-1, self.num_local_heads,
+                                             self.qk_head_dim)
+        impl.W_QR = q_proj_weight[..., self.qk_nope_head_dim:].flatten(
+            start_dim=1).contiguous()
+        impl.W_Q_UK = self.q_absorbed_proj.weight.T.contiguous()
+        impl.W_UV_O = self.o_absorbed_proj.weight.T.contiguous()
+
     def forward(
         self,
         positions: torch.Tensor,
@@ -537,8 +596,15 @@ class DeepseekV2ForCausalLM(nn.Module, SupportsPP):
         super().__init__()
         config = vllm_config.model_config.hf_config
         quant_config = vllm_config.quant_config
+        # Checkpoints converted with --weight-bits store qweight/scales
+        # codes that only the QuantLinear of mla.py can load.
+        if getattr(config, "weight_quant", None):
+            raise ValueError(
+                "Checkpoints converted with --weight-bits are not supported "
+                "by the vLLM registry, convert them without it.")
         self.config = config
         self.quant_config = quant_config
+        self.model_path = vllm_config.model_config.model
         self.model = DeepseekV2Model(vllm_config=vllm_config,
                                      prefix=maybe_prefix(prefix, "model"))
         if get_pp_group().is_last_rank:
@@ -599,12 +665,128 @@ class DeepseekV2ForCausalLM(nn.Module, SupportsPP):
 
     def load_weights(self, weights: Iterable[Tuple[str,
                                                    torch.Tensor]]) -> Set[str]:
-        stacked_params_mapping = [
-            # (param_name, shard_name, shard_id)
-            ("gate_up_proj", "gate_proj", 0),
-            ("gate_up_proj", "up_proj", 1),
-        ]
+        timings = {"table": 0.0, "read": 0.0, "resolve": 0.0, "copy": 0.0}
+        start = time.perf_counter()
+        params_dict = dict(self.named_parameters())
+        table = WeightNameTable(self, params_dict)
+        timings["table"] = time.perf_counter() - start
+
+        weight_files = _local_safetensors_files(self.model_path)
+        if WEIGHT_LOAD_THREADS > 0 and weight_files:
+            weights = parallel_safetensors_weights_iterator(
+                weight_files, WEIGHT_LOAD_THREADS)
+
+        loaded_params: Set[str] = set()
+        weights = iter(weights)
+        while True:
+            tic = time.perf_counter()
+            item = next(weights, None)
+            toc = time.perf_counter()
+            timings["read"] += toc - tic
+            if item is None:
+                break
+            name, loaded_weight = item
+            loaded_weight = pad_latent_weight(self.config, name,
+                                              loaded_weight)
+
+            target = table.resolve(name)
+            tic = time.perf_counter()
+            timings["resolve"] += tic - toc
+            if target is None:
+                continue
+            name, shard_id, expert_id = target
+            param = params_dict[name]
+            if expert_id is not None:
+                param.weight_loader(param,
+                                    loaded_weight,
+                                    name,
+                                    shard_id=shard_id,
+                                    expert_id=expert_id)
+            elif shard_id is not None:
+                param.weight_loader(param, loaded_weight, shard_id)
+            else:
+                weight_loader = getattr(param, "weight_loader",
+                                        default_weight_loader)
+                weight_loader(param, loaded_weight)
+            timings["copy"] += time.perf_counter() - tic
+            loaded_params.add(name)
+
+        logger.info(
+            "Loaded %d parameters in %.2fs (table %.2fs, read %.2fs, "
+            "resolve %.2fs, copy %.2fs)", len(loaded_params),
+            time.perf_counter() - start, timings["table"], timings["read"],
+            timings["resolve"], timings["copy"])
+        return loaded_params
+
+
+_LATENT_WEIGHT = re.compile(
+    r"layers\.(\d+)\.self_attn\.(kv_a_proj_with_mqa|kv_a_layernorm|kv_b_proj|"
+    r"q_absorbed_proj|o_absorbed_proj)\.(?:weight|bias)$")
 
+
+def pad_latent_weight(config: PretrainedConfig, name: str,
+                      loaded_weight: torch.Tensor) -> torch.Tensor:
+    """
+    Checkpoints converted with --kv-cache-budget give every layer its own
+    kv_lora_rank (`config.kv_lora_ranks`), but the MLA backend caches the
+    same head size in every layer. The latent of a smaller layer is padded
+    with zero channels up to `config.kv_lora_rank`: kv_a_proj_with_mqa
+    produces zeros there and kv_b_proj / the absorbed projections ignore
+    them. The kv_a_layernorm weight is scaled by sqrt(rank / kv_lora_rank)
+    to undo the longer mean inside the RMS.
+    """
+    kv_lora_ranks = getattr(config, "kv_lora_ranks", None)
+    match = _LATENT_WEIGHT.search(name) if kv_lora_ranks else None
+    if match is None:
+        return loaded_weight
+    rank = kv_lora_ranks[int(match.group(1))]
+    pad = config.kv_lora_rank - rank
+    if pad == 0:
+        return loaded_weight
+    num_heads = config.num_attention_heads
+    module = match.group(2)
+    if module == "kv_a_proj_with_mqa":
+        latent, rope = loaded_weight.split(
+            [rank, loaded_weight.shape[0] - rank])
+        return torch.cat(
+            [latent, latent.new_zeros(pad, *latent.shape[1:]), rope])
+    if module == "kv_a_layernorm":
+        scale = (rank / config.kv_lora_rank)**0.5
+        return torch.cat(
+            [loaded_weight * scale, loaded_weight.new_zeros(pad)])
+    if module == "kv_b_proj":
+        return F.pad(loaded_weight, (0, pad))
+    if module == "q_absorbed_proj":
+        # [num_heads * rank, q_input_dim] or its bias [num_heads * rank]
+        weight = loaded_weight.view(num_heads, rank, -1)
+        return F.pad(weight, (0, 0, 0, pad)).view(
+            num_heads * config.kv_lora_rank, *loaded_weight.shape[1:])
+    # o_absorbed_proj: [hidden_size, num_heads * rank]
+    weight = loaded_weight.view(loaded_weight.shape[0], num_heads, rank)
+    return F.pad(weight, (0, pad)).flatten(1)
+
+
+class WeightNameTable:
+    """
+    Maps checkpoint tensor names to (param_name, shard_id, expert_id).
+
+    The stacked and expert mappings are compiled into dicts once, expert
+    names are matched with a single regex instead of a scan over every
+    (expert, shard) pair, and each resolved name is memoized.
+    `resolve` returns None for tensors that are not loaded on this rank.
+    """
+
+    stacked_params_mapping = [
+        # (param_name, shard_name, shard_id)
+        ("gate_up_proj", "gate_proj", 0),
+        ("gate_up_proj", "up_proj", 1),
+    ]
+    expert_pattern = re.compile(r"experts\.\d+\.[^.]+\.")
+
+    def __init__(self, model: nn.Module, params_dict: Dict[str, nn.Parameter]):
+        self.model = model
+        self.config = model.config
+        self.params_dict = params_dict
         # Params for weights, fp8 weight scales, fp8 activation scales
         # (param_name, weight_name, expert_id, shard_id)
         expert_params_mapping = FusedMoE.make_expert_params_mapping(
@@ -612,78 +794,133 @@ class DeepseekV2ForCausalLM(nn.Module, SupportsPP):
             ckpt_down_proj_name="down_proj",
             ckpt_up_proj_name="up_proj",
             num_experts=getattr(self.config, "n_routed_experts", 256))
-
-        params_dict = dict(self.named_parameters())
-        loaded_params: Set[str] = set()
-        for name, loaded_weight in weights:
-            if "rotary_emb.inv_freq" in name:
+        self.expert_table: Dict[str, Tuple[str, str, int, Any]] = {}
+        for param_name, weight_name, expert_id, shard_id in expert_params_mapping:
+            self.expert_table.setdefault(
+                weight_name, (param_name, weight_name, expert_id, shard_id))
+        self.cache: Dict[str, Optional[Tuple[str, Any, Optional[int]]]] = {}
+
+    def resolve(self, name: str) -> Optional[Tuple[str, Any, Optional[int]]]:
+        if name not in self.cache:
+            self.cache[name] = self._resolve(name)
+        return self.cache[name]
+
+    def _resolve(self, name: str) -> Optional[Tuple[str, Any, Optional[int]]]:
+        params_dict = self.params_dict
+        if "rotary_emb.inv_freq" in name:
+            return None
+        if name.endswith((".qweight", ".scales")):
+            raise ValueError(
+                f"{name}: weights quantized with --weight-bits are not "
+                "supported by the vLLM registry.")
+
+        spec_layer = get_spec_layer_idx_from_weight_name(self.config, name)
+        if spec_layer is not None:
+            return None  # skip spec decode layers for main model
+
+        for (param_name, weight_name, shard_id) in self.stacked_params_mapping:
+            # Skip non-stacked layers and experts (experts handled below).
+            if weight_name not in name:
                 continue
+            # We have mlp.experts[0].gate_proj in the checkpoint.
+            # Since we handle the experts below in the expert table,
+            # we need to skip here BEFORE we update the name, otherwise
+            # name will be updated to mlp.experts[0].gate_up_proj, which
+            # will then be updated below in the expert table
+            # for mlp.experts[0].gate_gate_up_proj, which breaks load.
+            if (("mlp.experts." in name) and name not in params_dict):
+                continue
+            name = name.replace(weight_name, param_name)
+            # Skip loading extra bias for GPTQ models.
+            if name.endswith(".bias") and name not in params_dict:
+                return None
+            if is_pp_missing_parameter(name, self.model):
+                return None
+            return name, shard_id, None
+
+        match = self.expert_pattern.search(name)
+        if match is not None and match.group(0) in self.expert_table:
+            param_name, weight_name, expert_id, shard_id = self.expert_table[
+                match.group(0)]
+            name = name.replace(weight_name, param_name)
+            if is_pp_missing_parameter(name, self.model):
+                return None
+            return name, shard_id, expert_id
+
+        # Skip loading extra bias for GPTQ models.
+        if name.endswith(".bias") and name not in params_dict:
+            return None
+
+        # Remapping the name of FP8 kv-scale.
+        name = maybe_remap_kv_scale_name(name, params_dict)
+        if name is None:
+            return None
+
+        if is_pp_missing_parameter(name, self.model):
+            return None
+        return name, None, None
+
+
+def _local_safetensors_files(model_path: Optional[str]) -> List[str]:
+    if model_path is None or not os.path.isdir(model_path):
+        return []
+    index_file = os.path.join(model_path, "model.safetensors.index.json")
+    if os.path.isfile(index_file):
+        # only the shards listed in the index, like vLLM's own loader
+        with open(index_file) as f:
+            weight_map = json.load(f)["weight_map"]
+        return sorted(
+            os.path.join(model_path, weight_file)
+            for weight_file in set(weight_map.values()))
+    return sorted(glob.glob(os.path.join(model_path, "*.safetensors")))
+
+
+def parallel_safetensors_weights_iterator(
+        weight_files: List[str],
+        num_threads: int = 8) -> Iterator[Tuple[str, torch.Tensor]]:
+    """
+    Yield the tensors of `weight_files`, read by `num_threads` threads.
 
-            spec_layer = get_spec_layer_idx_from_weight_name(self.config, name)
-            if spec_layer is not None:
-                continue  # skip spec decode layers for main model
-
-            for (param_name, weight_name, shard_id) in stacked_params_mapping:
-                # Skip non-stacked layers and experts (experts handled below).
-                if weight_name not in name:
-                    continue
-                # We have mlp.experts[0].gate_proj in the checkpoint.
-                # Since we handle the experts below in expert_params_mapping,
-                # we need to skip here BEFORE we update the name, otherwise
-                # name will be updated to mlp.experts[0].gate_up_proj, which
-                # will then be updated below in expert_params_mapping
-                # for mlp.experts[0].gate_gate_up_proj, which breaks load.
-                if (("mlp.experts." in name) and name not in params_dict):
-                    continue
-                name = name.replace(weight_name, param_name)
-                # Skip loading extra bias for GPTQ models.
-                if name.endswith(".bias") and name not in params_dict:
-                    continue
-
-                if is_pp_missing_parameter(name, self):
-                    continue
-
-                param = params_dict[name]
-                weight_loader = param.weight_loader
-                weight_loader(param, loaded_weight, shard_id)
+    Every thread memory-maps the shards with its own `safe_open` handle and
+    materializes one tensor at a time. At most `2 * num_threads` tensors are
+    in flight, so host memory stays bounded however large the shards are.
+    Tensors are yielded in completion order.
+    """
+    from safetensors import safe_open
+
+    tasks = []
+    for weight_file in weight_files:
+        with safe_open(weight_file, framework="pt") as f:
+            tasks.extend((weight_file, name) for name in f.keys())
+
+    local = threading.local()
+
+    def read(task):
+        weight_file, name = task
+        handles = getattr(local, "handles", None)
+        if handles is None:
+            handles = local.handles = {}
+        if weight_file not in handles:
+            handles[weight_file] = safe_open(weight_file, framework="pt")
+        return name, handles[weight_file].get_tensor(name)
+
+    results: queue.Queue = queue.Queue()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = 0
+        tasks = iter(tasks)
+        for task in tasks:
+            executor.submit(read, task).add_done_callback(results.put)
+            pending += 1
+            if pending >= 2 * num_threads:
                 break
-            else:
-                for mapping in expert_params_mapping:
-                    param_name, weight_name, expert_id, shard_id = mapping
-                    if weight_name not in name:
-                        continue
-                    name = name.replace(weight_name, param_name)
-
-                    if is_pp_missing_parameter(name, self):
-                        continue
-
-                    param = params_dict[name]
-                    weight_loader = param.weight_loader
-                    weight_loader(param,
-                                  loaded_weight,
-                                  name,
-                                  shard_id=shard_id,
-                                  expert_id=expert_id)
-                    break
-                else:
-                    # Skip loading extra bias for GPTQ models.
-                    if name.endswith(".bias") and name not in params_dict:
-                        continue
-
-                    # Remapping the name of FP8 kv-scale.
-                    name = maybe_remap_kv_scale_name(name, params_dict)
-                    if name is None:
-                        continue
-
-                    if is_pp_missing_parameter(name, self):
-                        continue
-
-                    param = params_dict[name]
-                    weight_loader = getattr(param, "weight_loader",
-                                            default_weight_loader)
-                    weight_loader(param, loaded_weight)
-            loaded_params.add(name)
-        return loaded_params
+        while pending > 0:
+            future = results.get()
+            pending -= 1
+            task = next(tasks, None)
+            if task is not None:
+                executor.submit(read, task).add_done_callback(results.put)
+                pending += 1
+            yield future.result()
 
 
 class DeepseekV3ForCausalLM(DeepseekV2ForCausalLM):